@@ -1,8 +1,10 @@
 import os
+import json
 import configparser
 import threading
 import logging
 import time
+import atexit
 import socket  # [NEW] Thư viện để lấy IP mạng LAN
 from logging.handlers import RotatingFileHandler
 from flask import Flask, jsonify, request, render_template
@@ -35,14 +37,23 @@ login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = "Vui lòng đăng nhập để truy cập trang này."
 
-# SocketIO
-socketio = SocketIO(app, async_mode='threading', cors_allowed_origins="*")
+# SocketIO: khởi tạo trong MAIN theo [SocketIO] (async_mode do serve.py chọn, message queue Redis tùy chọn)
+socketio = SocketIO()
 
 # --- 4. Import các module (Services & Models) ---
+from flask_socketio import join_room, emit
+from telemetry_publisher import station_room
+from floor_status import FLOOR_ROOM, FLOOR_EVENT, start_floor_publisher, start_floor_aggregator
+from local_db_retention import start_retention_job
+from local_db_manager import local_db_manager
+from services.roll_sequence import roll_sequence
 from models import User
 from services.user_service import user_service 
 from services.standard_service import standard_service
 from services.redis_manager import redis_manager 
+from services.lookup_cache import get_cache_stats
+from state_manager import state_manager
+from state_store import JournalStateStore, RedisStateStore
 from modbus_poller import start_poller_thread
 
 # Import Redis Worker an toàn
@@ -86,7 +97,54 @@ def handle_internal_server_error(e):
         }), 500
     return "<h1>500 - Lỗi máy chủ nội bộ</h1><p>Vui lòng thử lại sau.</p>", 500
 
+# --- 7b. SOCKET.IO ROOMS ---
+@socketio.on('connect')
+def handle_socket_connect():
+    """HMI của trạm tự vào room của trạm để nhận dữ liệu đồng hồ mét."""
+    station_id = app.config.get('STATION_ID')
+    if station_id:
+        join_room(station_room(station_id))
+
+@socketio.on('join_station')
+def handle_join_station(data):
+    """Màn hình giám sát có thể theo dõi thêm trạm khác: emit('join_station', {station_id})."""
+    station_id = (data or {}).get('station_id')
+    if station_id:
+        join_room(station_room(station_id))
+
+@socketio.on('join_floor')
+def handle_join_floor():
+    """[NEW] Màn hình giám sát xưởng (trên Server): nhận ảnh chụp ngay, sau đó nhận các thay đổi gộp."""
+    join_room(FLOOR_ROOM)
+    aggregator = getattr(app, 'floor_aggregator', None)
+    if aggregator:
+        emit(FLOOR_EVENT, {"stations": aggregator.snapshot(), "ts": time.time(), "snapshot": True})
+
 # --- 8. API Trạng thái hệ thống (Code cũ - Giữ nguyên) ---
+def _get_worker_status():
+    if app.config.get('ROLE') != 'SERVER':
+        return "N/A (Client Mode)"
+    if not app.config.get('EMBEDDED_WORKER', True):
+        return "External (worker_pool)"
+    return "Running" if run_worker else "N/A"
+
+def _get_modbus_stats():
+    poller = getattr(app, 'poller_instance', None)
+    if not poller:
+        return None
+    try:
+        return poller.get_stats()
+    except Exception as e:
+        return {"error": str(e)}
+
+def _get_floor_stats():
+    component = getattr(app, 'floor_aggregator', None) or getattr(app, 'floor_publisher', None)
+    return component.get_stats() if component else None
+
+def _get_local_db_stats():
+    job = getattr(app, 'retention_job', None)
+    return job.get_stats() if job else None
+
 @app.route('/api/system/sync_status', methods=['GET'])
 def get_sync_status():
     """API trả về trạng thái Redis cho Frontend"""
@@ -96,10 +154,54 @@ def get_sync_status():
         "role": app.config.get('ROLE', 'UNKNOWN'),
         "redis_target": app.config.get('REDIS_HOST', 'UNKNOWN'),
         "redis_connection": "OK" if redis_alive else "DISCONNECTED",
-        "worker_status": "Running" if (run_worker and app.config.get('ROLE') == 'SERVER') else "N/A (Client Mode)",
-        "server_time": time.strftime('%H:%M:%S %d/%m/%Y')
+        "redis_health": redis_manager.get_health(),
+        "worker_status": _get_worker_status(),
+        "server_time": time.strftime('%H:%M:%S %d/%m/%Y'),
+        "lookup_cache": get_cache_stats(),
+        "modbus": _get_modbus_stats(),
+        "floor": _get_floor_stats(),
+        "local_db": _get_local_db_stats(),
+        "roll_sequence": roll_sequence.get_stats()
     })
 
+@app.route('/api/system/sessions', methods=['GET'])
+def get_active_sessions():
+    """[NEW] Tóm tắt các phiên kiểm vải đang chạy (đầy đủ các trạm khi State Backend = redis)."""
+    try:
+        states = state_manager.get_all_states()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    sessions = []
+    for station_id, s in states.items():
+        if not s:
+            continue
+        current = s.get('current_worker_details') or {}
+        sessions.append({
+            "station_id": station_id,
+            "roll_code": s.get('roll_code'),
+            "fabric_name": s.get('fabric_name'),
+            "status": s.get('status'),
+            "is_repair_mode": s.get('is_repair_mode', False),
+            "current_worker": (current.get('worker') or {}).get('name'),
+            "current_errors": len(current.get('current_errors') or []),
+            "completed_workers": len(s.get('completed_workers_log') or []),
+        })
+    return jsonify({"backend": state_manager.backend_name, "sessions": sessions})
+
+@app.route('/api/floor/status', methods=['GET'])
+def get_floor_status():
+    """[NEW] Ảnh chụp trạng thái mọi trạm (số mét, mã cây, số lỗi, công nhân)."""
+    aggregator = getattr(app, 'floor_aggregator', None)
+    if aggregator:
+        return jsonify({"source": "aggregator", "stations": aggregator.snapshot()})
+    # Không chạy Aggregator (VD: gọi từ trạm): đọc frame mới nhất trực tiếp trên Redis
+    try:
+        frames = [json.loads(raw) for raw in redis_manager.get_floor_snapshot().values()]
+    except Exception as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"source": "redis", "stations": sorted(frames, key=lambda f: f.get('station_id', ''))})
+
 # --- [NEW] CÁC HÀM HỖ TRỢ TỰ ĐỘNG NHẬN DIỆN ---
 def get_local_ip():
     """Lấy IP mạng LAN thực tế của máy"""
@@ -114,6 +216,12 @@ def get_local_ip():
         s.close()
     return IP
 
+def _resolve_path(base_dir, path):
+    """Đường dẫn tương đối trong config.ini được tính từ thư mục chứa app.py."""
+    if not path:
+        return None
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
 def detect_environment():
     """Đọc config.ini và xác định vai trò máy dựa trên IP"""
     config = configparser.ConfigParser()
@@ -124,6 +232,84 @@ def detect_environment():
     my_ip = get_local_ip()
     server_ip = config.get('Network', 'SERVER_IP', fallback='127.0.0.1')
     redis_port = config.getint('Network', 'REDIS_PORT', fallback=6379)
+    # [NEW] Giây giữa 2 lần PING nền (check_connection đọc trạng thái đã lưu, không chặn request)
+    redis_heartbeat = config.getfloat('Network', 'REDIS_HEARTBEAT', fallback=2.0)
+    # [NEW] Khối số thứ tự mã cây thuê trước từ Redis
+    sequence_settings = {
+        'block_size': config.getint('Sequence', 'BLOCK_SIZE', fallback=20),
+        'low_water': config.getint('Sequence', 'LOW_WATER', fallback=5),
+    }
+    queue_backend = config.get('Queue', 'BACKEND', fallback='list').strip().lower()
+    # [NEW] false: Server không chạy Worker trong tiến trình web (dùng workers/worker_pool.py)
+    embedded_worker = config.getboolean('Worker', 'EMBEDDED', fallback=True)
+    # [NEW] Phát dữ liệu đồng hồ mét: chỉ khi đổi > DEADBAND (mét) hoặc mỗi HEARTBEAT giây
+    modbus_settings = {
+        'deadband': config.getfloat('Modbus', 'DEADBAND', fallback=0.05),
+        'heartbeat': config.getfloat('Modbus', 'HEARTBEAT', fallback=5.0),
+        # Chu kỳ đọc thích ứng theo tốc độ máy (giây)
+        'poll_fast': config.getfloat('Modbus', 'POLL_FAST', fallback=0.2),
+        'poll_base': config.getfloat('Modbus', 'POLL_BASE', fallback=0.5),
+        'poll_idle': config.getfloat('Modbus', 'POLL_IDLE', fallback=2.0),
+        'idle_after': config.getfloat('Modbus', 'IDLE_AFTER', fallback=30.0),
+        'backoff_max': config.getfloat('Modbus', 'BACKOFF_MAX', fallback=30.0),
+        # Cổng RS-485 (trống = mặc định theo hệ điều hành) và bản đồ thanh ghi (trống = 1 đồng hồ mét)
+        'port': config.get('Modbus', 'PORT', fallback='').strip(),
+        'baudrate': config.getint('Modbus', 'BAUDRATE', fallback=9600),
+        'register_map': _resolve_path(script_dir, config.get('Modbus', 'REGISTER_MAP', fallback='').strip()),
+        # Backend: thread (mặc định) | asyncio; Truyền thông (chỉ asyncio): serial | tcp (Gateway / Simulator)
+        'backend': config.get('Modbus', 'BACKEND', fallback='thread').strip().lower(),
+        'transport': config.get('Modbus', 'TRANSPORT', fallback='serial').strip().lower(),
+        'tcp_host': config.get('Modbus', 'TCP_HOST', fallback='127.0.0.1').strip(),
+        'tcp_port': config.getint('Modbus', 'TCP_PORT', fallback=502),
+        # Transport giả lập (TRANSPORT = sim | replay, xem modbus_sim.py) - chạy thử / đo tải không cần đồng hồ thật
+        'sim_speed': config.getfloat('Modbus', 'SIM_SPEED', fallback=30.0),
+        'sim_run_seconds': config.getfloat('Modbus', 'SIM_RUN_SECONDS', fallback=0.0),
+        'sim_stop_seconds': config.getfloat('Modbus', 'SIM_STOP_SECONDS', fallback=0.0),
+        'sim_latency': config.getfloat('Modbus', 'SIM_LATENCY', fallback=0.02),
+        'sim_fault_timeout': config.getfloat('Modbus', 'SIM_FAULT_TIMEOUT', fallback=0.0),
+        'sim_fault_crc': config.getfloat('Modbus', 'SIM_FAULT_CRC', fallback=0.0),
+        'sim_fault_swap': config.getfloat('Modbus', 'SIM_FAULT_SWAP', fallback=0.0),
+        'replay_file': _resolve_path(script_dir, config.get('Modbus', 'REPLAY_FILE', fallback='').strip()),
+        'replay_speed': config.getfloat('Modbus', 'REPLAY_SPEED', fallback=1.0),
+        'replay_loop': config.getboolean('Modbus', 'REPLAY_LOOP', fallback=True),
+        'record_file': _resolve_path(script_dir, config.get('Modbus', 'RECORD_FILE', fallback='').strip()),
+        # Lọc số mét: tốc độ tối đa hợp lý (m/phút), policy khi loại mẫu (hold | interpolate), thời gian chờ về 0 sau Reset
+        'filter_max_speed': config.getfloat('Modbus', 'FILTER_MAX_SPEED', fallback=200.0),
+        'filter_policy': config.get('Modbus', 'FILTER_POLICY', fallback='hold').strip().lower(),
+        'filter_reset_window': config.getfloat('Modbus', 'FILTER_RESET_WINDOW', fallback=5.0),
+        # Số mẫu thô giữ trong RAM cho /api/meter/history (bucket 1s / 1m / 1h có dung lượng cố định)
+        'history_capacity': config.getint('Modbus', 'HISTORY_CAPACITY', fallback=7200),
+    }
+    # [NEW] Socket.IO: chế độ worker (serve.py đặt FLIS_ASYNC_MODE sau khi monkey-patch) và message queue
+    message_queue = config.get('SocketIO', 'MESSAGE_QUEUE', fallback='').strip()
+    socketio_settings = {
+        'async_mode': os.environ.get('FLIS_ASYNC_MODE') or 'threading',
+        'message_queue': message_queue,
+        'channel': config.get('SocketIO', 'CHANNEL', fallback='flis-socketio').strip(),
+    }
+    # [NEW] Giám sát xưởng: trạm phát trạng thái gọn lên Redis, Server tổng hợp
+    floor_settings = {
+        'enabled': config.getboolean('Floor', 'ENABLED', fallback=True),
+        'interval': config.getfloat('Floor', 'INTERVAL', fallback=2.0),
+        'heartbeat': config.getfloat('Floor', 'HEARTBEAT', fallback=10.0),
+        'flush_interval': config.getfloat('Floor', 'FLUSH_INTERVAL', fallback=1.0),
+        'offline_after': config.getfloat('Floor', 'OFFLINE_AFTER', fallback=30.0),
+    }
+    # [NEW] Lưu trữ / dọn CSDL cục bộ của trạm
+    retention_settings = {
+        'enabled': config.getboolean('Retention', 'ENABLED', fallback=True),
+        'days': config.getint('Retention', 'DAYS', fallback=90),
+        'archive_dir': os.path.join(script_dir, config.get('Retention', 'ARCHIVE_DIR', fallback='archive')),
+        'interval': config.getfloat('Retention', 'INTERVAL_HOURS', fallback=6.0) * 3600,
+        'batch_size': config.getint('Retention', 'BATCH_SIZE', fallback=500),
+    }
+    # [NEW] Backend lưu trạng thái phiên (memory | journal | redis)
+    state_settings = {
+        'backend': config.get('State', 'BACKEND', fallback='memory').strip().lower(),
+        'journal_dir': os.path.join(script_dir, config.get('State', 'JOURNAL_DIR', fallback='state_data')),
+        'fsync': config.getboolean('State', 'FSYNC', fallback=True),
+        'compact_every': config.getint('State', 'COMPACT_EVERY', fallback=200),
+    }
     
     # Mặc định
     role = 'CLIENT'
@@ -143,12 +329,25 @@ def detect_environment():
                 station_id = name
                 break
     
+    # MESSAGE_QUEUE = auto: dùng Redis trên Server
+    if socketio_settings['message_queue'].lower() == 'auto':
+        socketio_settings['message_queue'] = f"redis://{redis_host}:{redis_port}/0"
+
     return {
         'ROLE': role,
         'STATION_ID': station_id,
         'MY_IP': my_ip,
         'REDIS_HOST': redis_host,
-        'REDIS_PORT': redis_port
+        'REDIS_PORT': redis_port,
+        'REDIS_HEARTBEAT': redis_heartbeat,
+        'QUEUE_BACKEND': queue_backend,
+        'EMBEDDED_WORKER': embedded_worker,
+        'SOCKETIO': socketio_settings,
+        'FLOOR': floor_settings,
+        'STATE': state_settings,
+        'RETENTION': retention_settings,
+        'SEQUENCE': sequence_settings,
+        'MODBUS': modbus_settings
     }
 
 # --- 10. MAIN ENTRY POINT (Đã cập nhật Logic Tách Client/Server) ---
@@ -160,6 +359,7 @@ if __name__ == '__main__':
     app.config['STATION_ID'] = env['STATION_ID']
     app.config['ROLE'] = env['ROLE']
     app.config['REDIS_HOST'] = env['REDIS_HOST']
+    app.config['EMBEDDED_WORKER'] = env['EMBEDDED_WORKER']
     
     print(f"\n==========================================")
     print(f" KHỞI ĐỘNG HỆ THỐNG FLIS")
@@ -167,13 +367,33 @@ if __name__ == '__main__':
     print(f" Vai Trò     : {env['ROLE']}")
     print(f" Mã Trạm     : {env['STATION_ID']}")
     print(f" Redis Target: {env['REDIS_HOST']}:{env['REDIS_PORT']}")
+    print(f" Queue       : {env['QUEUE_BACKEND']}")
+    print(f" Socket.IO   : {env['SOCKETIO']['async_mode']} | MQ: {env['SOCKETIO']['message_queue'] or 'off'}")
     print(f"==========================================\n")
 
+    # 2b. Khởi tạo Socket.IO
+    # - SERVER: đăng ký message queue -> nhận frame của mọi trạm, phát tới màn hình giám sát theo room.
+    # - CLIENT: Socket.IO cục bộ KHÔNG đăng ký queue (không nhận frame của N trạm khác);
+    #   Poller đẩy frame lên queue qua 1 SocketIO chỉ-ghi (relay) -> mỗi frame đi đúng 1 lần.
+    socketio_cfg = env['SOCKETIO']
+    mq_url = socketio_cfg['message_queue'] or None
+    socketio.init_app(
+        app, async_mode=socketio_cfg['async_mode'], cors_allowed_origins="*",
+        message_queue=mq_url if env['ROLE'] == 'SERVER' else None, channel=socketio_cfg['channel']
+    )
+    telemetry_relay = None
+    if mq_url and env['ROLE'] != 'SERVER':
+        try:
+            telemetry_relay = SocketIO(message_queue=mq_url, channel=socketio_cfg['channel'])
+        except Exception as e:
+            app.logger.error(f"Không kết nối được message queue {mq_url} (chỉ phát cục bộ): {e}")
+
     # 3. Cập nhật kết nối cho Redis Manager (Quan Trọng)
     try:
         # Gán trực tiếp thông số vào object redis_manager
         redis_manager.redis_host = env['REDIS_HOST']
         redis_manager.redis_port = env['REDIS_PORT']
+        redis_manager.queue_backend = env['QUEUE_BACKEND']
         # Reset pool để nhận config mới
         redis_manager.pool = None 
         redis_manager.client = None
@@ -181,9 +401,29 @@ if __name__ == '__main__':
             app.logger.info(f">>> Kết nối Redis: THÀNH CÔNG (tới {env['REDIS_HOST']})")
         else:
             app.logger.error(f">>> KẾT NỐI REDIS: THẤT BẠI. Kiểm tra IP {env['REDIS_HOST']} hoặc FireWall.")
+        redis_manager.start_heartbeat(env['REDIS_HEARTBEAT'])
     except Exception as e:
         app.logger.error(f"Lỗi cấu hình Redis Manager: {e}")
 
+    # 3a. Cấp mã cây theo khối: trả lại phần chưa dùng khi tắt ứng dụng
+    roll_sequence.configure(env['SEQUENCE']['block_size'], env['SEQUENCE']['low_water'])
+    atexit.register(roll_sequence.release_all)
+
+    # 3b. Khôi phục trạng thái phiên đang dở (trước khi nhận request)
+    state_backend = env['STATE']['backend']
+    if state_backend in ('journal', 'redis'):
+        try:
+            if state_backend == 'redis':
+                store = RedisStateStore(redis_manager)
+            else:
+                store = JournalStateStore(env['STATE']['journal_dir'], fsync=env['STATE']['fsync'],
+                                          compact_every=env['STATE']['compact_every'])
+            t0 = time.perf_counter()
+            restored = state_manager.attach_store(store)
+            app.logger.info(f">>> [STATE] {store.name}: khôi phục {restored} phiên trong {(time.perf_counter() - t0) * 1000:.1f} ms.")
+        except Exception as e:
+            app.logger.error(f"Lỗi khởi tạo State Backend '{state_backend}' (dùng RAM): {e}")
+
     # 4. Phân chia logic khởi động theo Vai trò
     if app.config['ROLE'] == 'SERVER':
         # --- [SERVER MODE] ---
@@ -198,7 +438,9 @@ if __name__ == '__main__':
             app.logger.error(f"Lỗi khởi tạo DB: {e}")
 
         # B. Chạy Redis Worker (Consumer)
-        if run_worker:
+        if not app.config['EMBEDDED_WORKER']:
+            app.logger.info(">>> [WORKER] Persistence tắt trong tiến trình web (chạy workers/worker_pool.py).")
+        elif run_worker:
             try:
                 worker_thread = threading.Thread(target=run_worker, daemon=True, name="RedisWorker")
                 worker_thread.start()
@@ -208,18 +450,46 @@ if __name__ == '__main__':
         else:
             app.logger.warning(">>> Không tìm thấy module Worker.")
 
+        # C. Tổng hợp trạng thái các trạm cho màn hình giám sát xưởng
+        if env['FLOOR']['enabled']:
+            app.floor_aggregator = start_floor_aggregator(
+                redis_manager, socketio,
+                flush_interval=env['FLOOR']['flush_interval'], offline_after=env['FLOOR']['offline_after']
+            )
+            app.logger.info(">>> [THREAD] Floor Aggregator đã kích hoạt.")
+
     else:
         # --- [CLIENT MODE] ---
         app.config['SYNC_STATUS'] = f"Client Mode - {env['STATION_ID']}"
         
         # A. Chạy Modbus Poller (Producer)
         try:
-            app.poller_instance = start_poller_thread(socketio)
+            app.poller_instance = start_poller_thread(socketio, env['STATION_ID'], env['MODBUS'], relay=telemetry_relay)
             app.logger.info(f">>> [THREAD] Modbus Poller đã kích hoạt cho trạm {env['STATION_ID']}.")
         except Exception as e:
             app.logger.error(f"FATAL: Không thể khởi động Modbus Poller. Lỗi: {e}")
 
+        # B. Phát trạng thái trạm lên màn hình giám sát xưởng
+        if env['FLOOR']['enabled']:
+            app.floor_publisher = start_floor_publisher(
+                redis_manager, state_manager, env['STATION_ID'], getattr(app, 'poller_instance', None),
+                interval=env['FLOOR']['interval'], heartbeat=env['FLOOR']['heartbeat']
+            )
+
+        # C. Lưu trữ phiếu cũ + dọn CSDL cục bộ
+        if env['RETENTION']['enabled']:
+            app.retention_job = start_retention_job(
+                local_db_manager, env['RETENTION']['archive_dir'],
+                retention_days=env['RETENTION']['days'], interval=env['RETENTION']['interval'],
+                batch_size=env['RETENTION']['batch_size']
+            )
+            app.logger.info(">>> [THREAD] Lưu trữ CSDL cục bộ đã kích hoạt.")
+
     # 5. Chạy Web Server
     print(">>> Khởi động Flask app với SocketIO...")
     # Lưu ý: host='0.0.0.0' để cho phép truy cập từ LAN
-    socketio.run(app, debug=False, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True, use_reloader=False)
\ No newline at end of file
+    if socketio_cfg['async_mode'] == 'threading':
+        socketio.run(app, debug=False, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True, use_reloader=False)
+    else:
+        # eventlet / gevent: server WSGI bất đồng bộ (chạy qua serve.py)
+        socketio.run(app, debug=False, host='0.0.0.0', port=5000, use_reloader=False)
\ No newline at end of file
@@ -1,8 +1,10 @@
+import os
 import redis
 import psycopg2
 import json
 import time
 import sys
+import configparser
 
 # ================= CẤU HÌNH (ĐÃ CHUẨN HÓA) =================
 REDIS_CONF = {
@@ -17,12 +19,23 @@ PG_CONF = "dbname=mes_db user=postgres password=admin   host=10.17.18.202"
 
 QUEUE_NAME = "persistence_queue"
 MAX_RETRIES = 3          # Số lần thấy trùng lặp thì mới xóa
+UNIQUE_CONFLICT_INDEX = "idx_unique_prod_log"   # Streams: chỉ xóa khi lỗi Worker ghi lại đúng là vi phạm index này
+
+# [NEW] Backend hàng đợi: "list" (đoán theo chữ ký gói tin đầu Queue)
+# hoặc "stream" (dùng số lần giao thật từ XPENDING) - đọc từ [Queue] BACKEND trong config.ini
+QUEUE_BACKEND = "list"
 CHECK_INTERVAL = 5       # Giây (Thời gian ngủ giữa các lần quét)
 
 # Chế độ an toàn: True = Chỉ in ra log, không xóa DB. False = Xóa thật.
 DRY_RUN = False          
 # ============================================================
 
+def read_queue_backend(config_path=None):
+    """[Queue] BACKEND trong config.ini (giống app.py), mặc định "list"."""
+    config = configparser.ConfigParser()
+    config.read(config_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'), encoding='utf-8')
+    return config.get('Queue', 'BACKEND', fallback=QUEUE_BACKEND).strip().lower()
+
 def get_db_connection():
     try:
         return psycopg2.connect(PG_CONF)
@@ -128,5 +141,66 @@ def recover_loop():
             print(f"❌ Lỗi không xác định: {e}")
             time.sleep(10)
 
+def recover_stream_loop():
+    """
+    [NEW] Chế độ Redis Streams: Không cần đoán bằng "chữ ký".
+    XPENDING cho biết chính xác gói tin nào đã bị giao lại >= MAX_RETRIES lần.
+    Số lần giao cũng tăng khi gói bị nhận lại sau lúc Worker chết / DB mất kết nối, nên chỉ
+    chạy cứu hộ (DELETE thật) khi lỗi Worker ghi lại cho gói là vi phạm UNIQUE_CONFLICT_INDEX.
+    Các lỗi khác để nguyên: Worker tự chuyển sang Dead Letter Stream khi đạt STREAM_MAX_DELIVERIES.
+    """
+    from services.redis_manager import redis_manager, STREAM_DEAD_LETTER_NAME
+
+    redis_manager.configure(REDIS_CONF['host'], REDIS_CONF['port'])
+    print(f"🚀 FLIS Auto-Recovery (Streams) đang chạy... Dead Letter: {STREAM_DEAD_LETTER_NAME}")
+    print(f"ℹ️  Chế độ DRY_RUN: {DRY_RUN}")
+
+    handled = {}  # message_id -> times_delivered đã cứu hộ (tránh cứu lặp trong cùng 1 lần giao)
+
+    while True:
+        try:
+            poison = redis_manager.get_stream_poison_messages(MAX_RETRIES)
+            for msg in poison:
+                msg_id = msg['message_id']
+                if handled.get(msg_id) == msg['times_delivered']:
+                    continue
+                handled[msg_id] = msg['times_delivered']
+
+                payload = msg['data']
+                if not payload:
+                    continue # Gói hỏng -> Worker sẽ chuyển Dead Letter
+
+                last_error = msg.get('last_error') or ''
+                if UNIQUE_CONFLICT_INDEX not in last_error:
+                    print(f"⏭️  Bỏ qua gói tin {msg_id} (giao {msg['times_delivered']} lần): "
+                          f"lỗi gần nhất không phải {UNIQUE_CONFLICT_INDEX} ({last_error[:120] or 'chưa ghi nhận'})")
+                    continue
+
+                print(f"🔎 Gói tin {msg_id} bị giao {msg['times_delivered']} lần (consumer {msg['consumer']})")
+                for entry in payload.get('workers_log', []):
+                    w_info = entry.get('worker', {})
+                    solve_conflict({
+                        'ticket_id': payload.get('ticket_id'),
+                        'roll_id': payload.get('ticket_id'),
+                        'worker_id': w_info.get('id') if isinstance(w_info, dict) else w_info,
+                        'shift': str(entry.get('shift', '')),
+                    })
+
+            # Bỏ theo dõi các gói đã được ACK / Dead Letter
+            pending_ids = {msg['message_id'] for msg in poison}
+            handled = {k: v for k, v in handled.items() if k in pending_ids}
+
+            time.sleep(CHECK_INTERVAL)
+
+        except redis.exceptions.ConnectionError:
+            print("❌ Mất kết nối Redis. Đang thử lại...")
+            time.sleep(10)
+        except Exception as e:
+            print(f"❌ Lỗi không xác định: {e}")
+            time.sleep(10)
+
 if __name__ == "__main__":
-    recover_loop()
\ No newline at end of file
+    if read_queue_backend() == "stream":
+        recover_stream_loop()
+    else:
+        recover_loop()
\ No newline at end of file
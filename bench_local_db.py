@@ -0,0 +1,157 @@
+# --- File: bench_local_db.py ---
+"""
+Đo độ trễ lưu / đọc phiếu của CSDL cục bộ (flis_local.db) trước và sau khi tinh chỉnh SQLite.
+- legacy: mở kết nối mới cho mỗi lệnh, rollback journal (DELETE) + synchronous=FULL, không có chỉ mục phụ
+  (đúng cấu hình cũ của LocalDatabaseManager).
+- tuned : LocalDatabaseManager hiện tại (kết nối theo luồng, WAL + synchronous=NORMAL, chỉ mục).
+Chạy trên file tạm, không đụng tới flis_local.db thật. Nên chạy trên đúng loại ổ đĩa của trạm (thẻ SD / SSD).
+
+Ví dụ:
+    python bench_local_db.py
+    python bench_local_db.py --saves 500 --prefill 20000 --workers 3 --errors 15
+"""
+import io
+import os
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+
+from local_db_manager import LocalDatabaseManager
+
+NEW_INDEXES = (
+    "idx_completed_tickets_roll_code",
+    "idx_roll_production_log_ticket",
+    "idx_ticket_errors_ticket",
+    "idx_completed_tickets_unsynced",
+)
+
+class LegacyLocalDatabaseManager(LocalDatabaseManager):
+    """Cấu hình cũ: mỗi lệnh 1 kết nối mới, rollback journal, fsync đầy đủ."""
+    def _get_connection(self):
+        conn = sqlite3.connect(self.db_name)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.execute("PRAGMA synchronous = FULL")
+        return conn
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+def _make_session(index, workers, errors):
+    roll_code = f"2601BENCH{index:06d}"
+    workers_log = []
+    for w in range(workers):
+        workers_log.append({
+            "worker": {"id": f"W{w:03d}", "name": f"Công nhân {w}"},
+            "shift": str(w % 3 + 1),
+            "start_meter": w * 30.0, "end_meter": (w + 1) * 30.0, "total_meters": 30.0,
+            "meters_g1": 28.0, "meters_g2": 2.0,
+            "errors": [
+                {"error_type": f"E{e % 12}", "meter_location": w * 30.0 + e, "worker_id": f"W{w:03d}",
+                 "shift": str(w % 3 + 1), "points": 1}
+                for e in range(errors // max(workers, 1))
+            ],
+        })
+    return {
+        "ticket_id": f"bench-{index:08d}", "inspector_id": "BENCH", "machine_id": "M01",
+        "fabric_name": "Vải thử", "deployment_ticket_id": "D-BENCH", "roll_code": roll_code,
+        "completed_workers_log": workers_log,
+    }
+
+def _prefill(db_path, count, workers, errors):
+    """Tạo lịch sử `count` phiếu đã đồng bộ bằng 1 transaction (nhanh, không đo)."""
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO completed_tickets (ticket_id, inspection_date, roll_code, is_synced, status) "
+            "VALUES (?, '2025-01-01 00:00:00', ?, 1, 'DONE')",
+            [(f"hist-{i:08d}", f"2501HIST{i:06d}") for i in range(count)]
+        )
+        conn.executemany(
+            "INSERT INTO roll_production_log (ticket_id, worker_id, shift, meters_g1) VALUES (?, ?, '1', 30)",
+            [(f"hist-{i:08d}", f"W{w:03d}") for i in range(count) for w in range(workers)]
+        )
+        conn.executemany(
+            "INSERT INTO ticket_errors (ticket_id, error_type, meter_location) VALUES (?, 'E1', ?)",
+            [(f"hist-{i:08d}", float(e)) for i in range(count) for e in range(errors)]
+        )
+    conn.close()
+
+def run_profile(name, manager_cls, args, workdir):
+    db_path = os.path.join(workdir, f"{name}.db")
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet):
+        manager = manager_cls(db_path)
+    if manager_cls is LegacyLocalDatabaseManager:
+        conn = sqlite3.connect(db_path)
+        for index_name in NEW_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+        conn.close()
+    _prefill(db_path, args.prefill, args.workers, args.errors)
+
+    sessions = [_make_session(i, args.workers, args.errors) for i in range(args.saves)]
+    save_times = []
+    with contextlib.redirect_stdout(quiet):
+        for session in sessions:
+            t0 = time.perf_counter()
+            manager.save_completed_session_v2(session)
+            save_times.append(time.perf_counter() - t0)
+
+    # Đọc để in phiếu (phiếu + log công nhân + log lỗi) và sinh sequence dự phòng
+    read_times, seq_times = [], []
+    rng = random.Random(1)
+    for _ in range(args.reads):
+        ticket_id = rng.choice(sessions)["ticket_id"]
+        t0 = time.perf_counter()
+        manager.get_ticket_info_by_id(ticket_id)
+        manager.get_worker_log_by_ticket_id(ticket_id)
+        manager.get_error_log_by_ticket_id(ticket_id)
+        read_times.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        manager.get_next_sequence_by_prefix("2601BENCH")
+        seq_times.append(time.perf_counter() - t0)
+
+    manager.close()
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "profile": name,
+        "save_avg_ms": ms(sum(save_times) / len(save_times)),
+        "save_p50_ms": ms(_percentile(save_times, 0.5)),
+        "save_p95_ms": ms(_percentile(save_times, 0.95)),
+        "save_p99_ms": ms(_percentile(save_times, 0.99)),
+        "print_read_p95_ms": ms(_percentile(read_times, 0.95)),
+        "sequence_p95_ms": ms(_percentile(seq_times, 0.95)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo độ trễ CSDL cục bộ: cấu hình cũ và cấu hình tinh chỉnh")
+    parser.add_argument('--saves', type=int, default=200, help="Số phiếu lưu (đo)")
+    parser.add_argument('--reads', type=int, default=500, help="Số lần đọc phiếu để in (đo)")
+    parser.add_argument('--prefill', type=int, default=5000, help="Số phiếu lịch sử có sẵn")
+    parser.add_argument('--workers', type=int, default=3, help="Số công nhân / phiếu")
+    parser.add_argument('--errors', type=int, default=12, help="Số lỗi / phiếu")
+    parser.add_argument('--dir', default=None, help="Thư mục đặt file tạm (mặc định: thư mục tạm hệ thống)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        results = [
+            run_profile("legacy", LegacyLocalDatabaseManager, args, workdir),
+            run_profile("tuned", LocalDatabaseManager, args, workdir),
+        ]
+
+    columns = list(results[0].keys())
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[c]) for c in columns))
+    speedup = results[0]["save_avg_ms"] / max(results[1]["save_avg_ms"], 1e-9)
+    print(f"Lưu phiếu nhanh hơn: x{speedup:.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# --- File: bench_modbus_sim.py ---
+"""
+Đo tải Poller + Socket.IO với nhiều trạm giả lập trên 1 máy (không cần đồng hồ mét thật).
+Mỗi trạm = 1 Poller (TRANSPORT = sim hoặc replay) + 1 client Socket.IO (test client) ở room riêng.
+
+Ví dụ:
+    python bench_modbus_sim.py --stations 5 10 25 50 --duration 30
+    python bench_modbus_sim.py --stations 20 --backend asyncio --fault-timeout 0.02 --fault-swap 0.01
+    python bench_modbus_sim.py --stations 10 --replay traces/line1.jsonl --replay-speed 4
+"""
+import time
+import argparse
+import threading
+
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+from modbus_poller import start_poller_thread
+from telemetry_publisher import station_room
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+def _instrument_publisher(publisher, samples, lock):
+    """Đo thời gian publish (lọc deadband + fan-out Socket.IO) của 1 trạm."""
+    original = publisher.publish
+
+    def timed_publish(packet, force=False):
+        t0 = time.perf_counter()
+        frame = original(packet, force=force)
+        if frame is not None:
+            with lock:
+                samples.append(time.perf_counter() - t0)
+        return frame
+
+    publisher.publish = timed_publish
+
+def run_scenario(station_count, args):
+    app = Flask(__name__)
+    socketio = SocketIO(app, async_mode='threading')
+
+    @socketio.on('join_station')
+    def _join(station_id):
+        join_room(station_room(station_id))
+
+    settings = {
+        'backend': args.backend,
+        'transport': 'replay' if args.replay else 'sim',
+        'replay_file': args.replay,
+        'replay_speed': args.replay_speed,
+        'sim_speed': args.speed,
+        'sim_latency': args.latency,
+        'sim_run_seconds': args.run_seconds,
+        'sim_stop_seconds': args.stop_seconds,
+        'sim_fault_timeout': args.fault_timeout,
+        'sim_fault_crc': args.fault_crc,
+        'sim_fault_swap': args.fault_swap,
+        'register_map': args.register_map,
+    }
+
+    publish_samples, samples_lock = [], threading.Lock()
+    pollers, clients = [], []
+    for i in range(station_count):
+        station_id = f"BENCH{i + 1:02d}"
+        client = socketio.test_client(app)
+        client.emit('join_station', station_id)
+        clients.append(client)
+        poller = start_poller_thread(socketio, station_id, settings)
+        _instrument_publisher(poller.publisher, publish_samples, samples_lock)
+        pollers.append(poller)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    time.sleep(args.duration)
+    for poller in pollers:
+        poller.stop_polling()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    received = sum(len(c.get_received()) for c in clients)
+    emitted = sum(p.publisher.get_stats()["emitted"] for p in pollers)
+    reads = timeouts = missed = 0
+    latencies = []
+    for p in pollers:
+        stats = p.scheduler.get_stats()
+        reads += stats["reads"]
+        timeouts += stats["timeouts"]
+        missed += stats["missed_ticks"]
+        if stats["latency_ms"]["p95"] is not None:
+            latencies.append(stats["latency_ms"]["p95"])
+    for c in clients:
+        c.disconnect()
+
+    publish_p95 = _percentile(publish_samples, 0.95)
+    return {
+        "stations": station_count,
+        "reads_per_s": round(reads / wall, 1),
+        "read_p95_ms": round(max(latencies), 1) if latencies else None,
+        "timeouts": timeouts,
+        "missed_ticks": missed,
+        "frames_emitted": emitted,
+        "frames_received": received,
+        "publish_p95_ms": round(publish_p95 * 1000, 2) if publish_p95 is not None else None,
+        "cpu_pct": round(cpu / wall * 100, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo tải Modbus Poller + Socket.IO với trạm giả lập")
+    parser.add_argument('--stations', type=int, nargs='+', default=[5, 10, 25, 50])
+    parser.add_argument('--duration', type=float, default=20.0, help="Giây chạy mỗi kịch bản")
+    parser.add_argument('--backend', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--speed', type=float, default=30.0, help="m/phút")
+    parser.add_argument('--latency', type=float, default=0.02, help="Độ trễ bus giả lập (giây)")
+    parser.add_argument('--run-seconds', type=float, default=0.0)
+    parser.add_argument('--stop-seconds', type=float, default=0.0)
+    parser.add_argument('--fault-timeout', type=float, default=0.0)
+    parser.add_argument('--fault-crc', type=float, default=0.0)
+    parser.add_argument('--fault-swap', type=float, default=0.0)
+    parser.add_argument('--register-map', default=None)
+    parser.add_argument('--replay', default=None, help="File trace JSONL (thay cho đồng hồ ảo)")
+    parser.add_argument('--replay-speed', type=float, default=1.0)
+    args = parser.parse_args()
+
+    columns = ["stations", "reads_per_s", "read_p95_ms", "timeouts", "missed_ticks",
+               "frames_emitted", "frames_received", "publish_p95_ms", "cpu_pct"]
+    print(" | ".join(columns))
+    for count in args.stations:
+        result = run_scenario(count, args)
+        print(" | ".join(str(result[c]) for c in columns))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# --- File: floor_status.py ---
+"""
+Màn hình giám sát toàn xưởng.
+- Trạm (CLIENT): FloorStatusPublisher định kỳ gom 1 frame gọn (trạm, mã cây, số mét, số lỗi, công nhân)
+  từ state_manager + Poller, phát lên Redis Pub/Sub khi có thay đổi hoặc tới nhịp heartbeat.
+- Server: FloorAggregator nghe kênh, giữ frame mới nhất của từng trạm trong RAM, gộp các thay đổi
+  và phát 1 luồng Socket.IO duy nhất ('floor_status') vào room 'floor'; /api/floor/status trả ảnh chụp.
+"""
+import json
+import time
+import logging
+import threading
+
+FLOOR_ROOM = 'floor'
+FLOOR_EVENT = 'floor_status'
+DEFAULT_PUBLISH_INTERVAL = 2.0     # giây giữa 2 lần gom trạng thái trên trạm
+DEFAULT_FLOOR_HEARTBEAT = 10.0     # giây: phát lại dù không đổi (Server biết trạm còn sống)
+DEFAULT_FLUSH_INTERVAL = 1.0       # giây: Server gộp thay đổi rồi mới phát
+DEFAULT_OFFLINE_AFTER = 30.0       # giây không nhận frame -> coi trạm mất kết nối
+
+logger = logging.getLogger(__name__)
+
+def build_floor_frame(station_id, state, meter_state=None):
+    """Frame trạng thái gọn của 1 trạm (không chứa danh sách lỗi chi tiết)."""
+    meter_state = meter_state or {}
+    meters = meter_state.get('meters')
+    frame = {
+        "station_id": station_id,
+        "active": bool(state and state.get('active')),
+        "meters": meters,
+        "meter_error": meter_state.get('error'),
+    }
+    if not frame["active"]:
+        return frame
+
+    completed = state.get('completed_workers_log') or []
+    current = state.get('current_worker_details') or {}
+    defects = sum(len(entry.get('errors') or []) for entry in completed)
+    roll_meters = sum(entry.get('total_meters') or 0 for entry in completed)
+    if current:
+        defects += len(current.get('current_errors') or [])
+        if meters is not None:
+            roll_meters += max(0, meters - (current.get('start_meter') or 0))
+
+    frame.update({
+        "roll_code": state.get('roll_code'),
+        "fabric_name": state.get('fabric_name'),
+        "status": state.get('status'),
+        "repair": state.get('is_repair_mode', False),
+        "worker": (current.get('worker') or {}).get('name'),
+        "roll_meters": round(roll_meters, 2),
+        "defects": defects,
+        # Số lỗi / 100 mét của cây đang kiểm
+        "defect_rate": round(defects * 100.0 / roll_meters, 2) if roll_meters > 0 else None,
+    })
+    return frame
+
+class FloorStatusPublisher:
+    """Chạy trên trạm: phát frame trạng thái lên Redis khi đổi hoặc mỗi `heartbeat` giây."""
+    def __init__(self, redis_manager, state_manager, station_id, poller=None,
+                 interval=DEFAULT_PUBLISH_INTERVAL, heartbeat=DEFAULT_FLOOR_HEARTBEAT):
+        self.redis_manager = redis_manager
+        self.state_manager = state_manager
+        self.station_id = station_id
+        self.poller = poller
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.is_running = True
+
+        self._last_frame = None
+        self._last_publish = 0.0
+        self.published = 0
+        self.errors = 0
+
+    def publish_once(self, force=False):
+        meter_state = self.poller.get_last_state() if self.poller else None
+        frame = build_floor_frame(self.station_id, self.state_manager.get_state(self.station_id, max_age=self.heartbeat), meter_state)
+        now = time.time()
+        if not force and frame == self._last_frame and now - self._last_publish < self.heartbeat:
+            return False
+        payload = dict(frame)
+        payload["ts"] = now
+        self.redis_manager.publish_floor_status(self.station_id, json.dumps(payload, ensure_ascii=False))
+        self._last_frame = frame
+        self._last_publish = now
+        self.published += 1
+        return True
+
+    def run(self):
+        while self.is_running:
+            try:
+                self.publish_once()
+            except Exception as e:
+                # Mất Redis: bỏ qua nhịp này, lần sau phát lại đầy đủ
+                self.errors += 1
+                self._last_frame = None
+                logger.debug(f"[FLOOR] Không phát được trạng thái trạm {self.station_id}: {e}")
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.is_running = False
+
+    def get_stats(self):
+        return {"published": self.published, "errors": self.errors, "interval": self.interval}
+
+class FloorAggregator:
+    """Chạy trên Server: tổng hợp frame của mọi trạm, phát 1 luồng Socket.IO gộp."""
+    def __init__(self, redis_manager, socketio, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 offline_after=DEFAULT_OFFLINE_AFTER):
+        self.redis_manager = redis_manager
+        self.socketio = socketio
+        self.flush_interval = flush_interval
+        self.offline_after = offline_after
+        self.is_running = True
+
+        self._lock = threading.Lock()
+        self._latest = {}          # station_id -> frame
+        self._received = {}        # station_id -> giờ SERVER nhận frame (đồng hồ trạm có thể lệch, không dùng `ts`)
+        self._changed = set()
+        self._last_online = {}     # station_id -> giá trị `online` đã phát gần nhất
+        self.received = 0
+        self.emitted = 0
+        self.reconnects = 0
+
+    def _ingest(self, raw, received_at=None):
+        """`ts` của trạm chỉ dùng để sắp thứ tự frame của chính trạm đó; online/offline tính theo giờ nhận."""
+        try:
+            frame = json.loads(raw)
+            station_id = frame["station_id"]
+        except (ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            current = self._latest.get(station_id)
+            if current and current.get("ts", 0) > frame.get("ts", 0):
+                return    # Frame cũ đến trễ
+            self._latest[station_id] = frame
+            self._received[station_id] = received_at or time.time()
+            self._changed.add(station_id)
+            self.received += 1
+
+    def load_snapshot(self):
+        # Không biết giờ nhận thật của ảnh chụp -> tính từ lúc nạp: trạm đã chết sẽ chuyển offline sau offline_after
+        for raw in (self.redis_manager.get_floor_snapshot() or {}).values():
+            self._ingest(raw)
+
+    def _with_online(self, station_id, now):
+        item = dict(self._latest[station_id])
+        item["online"] = now - self._received.get(station_id, 0) < self.offline_after
+        return item
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return [self._with_online(k, now) for k in sorted(self._latest)]
+
+    def flush(self):
+        """
+        Phát các trạm đã đổi từ lần flush trước (1 gói cho cả xưởng): có frame mới, hoặc trạng thái
+        `online` khác lần phát trước (trạm ngừng gửi frame -> chuyển offline mà không có frame nào tới).
+        """
+        now = time.time()
+        with self._lock:
+            items = {k: self._with_online(k, now) for k in self._latest}
+            changed_ids = self._changed | {k for k, item in items.items()
+                                           if self._last_online.get(k) != item["online"]}
+            if not changed_ids:
+                return 0
+            changed = [items[k] for k in sorted(changed_ids)]
+            for item in changed:
+                self._last_online[item["station_id"]] = item["online"]
+            self._changed.clear()
+        try:
+            self.socketio.server.emit(FLOOR_EVENT, {"stations": changed, "ts": now}, room=FLOOR_ROOM, namespace='/')
+            self.emitted += 1
+        except Exception:
+            pass
+        return len(changed)
+
+    def run(self):
+        backoff = 1.0
+        while self.is_running:
+            pubsub = None
+            try:
+                self.load_snapshot()
+                pubsub = self.redis_manager.subscribe_floor_status()
+                backoff = 1.0
+                last_flush = time.monotonic()
+                while self.is_running:
+                    message = pubsub.get_message(timeout=self.flush_interval)
+                    if message and message.get('type') == 'message':
+                        self._ingest(message['data'])
+                    if time.monotonic() - last_flush >= self.flush_interval:
+                        self.flush()
+                        last_flush = time.monotonic()
+            except Exception as e:
+                logger.warning(f"[FLOOR] Mất kết nối kênh giám sát: {e}. Thử lại sau {backoff:.0f}s")
+                self.reconnects += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def stop(self):
+        self.is_running = False
+
+    def get_stats(self):
+        with self._lock:
+            stations = len(self._latest)
+        return {"stations": stations, "received": self.received, "emitted": self.emitted, "reconnects": self.reconnects}
+
+def start_floor_publisher(redis_manager, state_manager, station_id, poller=None, **kwargs):
+    publisher = FloorStatusPublisher(redis_manager, state_manager, station_id, poller, **kwargs)
+    threading.Thread(target=publisher.run, daemon=True, name="FloorPublisher").start()
+    return publisher
+
+def start_floor_aggregator(redis_manager, socketio, **kwargs):
+    aggregator = FloorAggregator(redis_manager, socketio, **kwargs)
+    threading.Thread(target=aggregator.run, daemon=True, name="FloorAggregator").start()
+    return aggregator
@@ -1,22 +1,63 @@
 # --- File: local_db_manager.py (UPDATED: Compatible with Gap Handling & String IDs) ---
+# (UPDATED: WAL + kết nối dùng lại theo luồng)
 
 import sqlite3
 import time
 import traceback
 import os
+import json
+import threading
+
+# Loại thay đổi ghi vào sync_outbox
+OUTBOX_OP_SESSION = 'session'          # phiếu mới: toàn bộ phiếu + log công nhân + log lỗi
+OUTBOX_OP_POST_ACTION = 'post_action'  # cập nhật notes / status sau khi hoàn tất
+
+# Cấu hình hiệu năng SQLite cho trạm
+# - WAL + synchronous=NORMAL: mỗi lần lưu chỉ ghi nối vào file -wal, không fsync 2 lần như rollback journal;
+#   đọc (in phiếu, server_sync) không chặn ghi. Mất điện chỉ có thể mất transaction cuối, không hỏng CSDL.
+# - cache_size âm = KiB; mmap_size = byte.
+SQLITE_PRAGMAS = (
+    # Phải đặt trước journal_mode trên CSDL mới; CSDL cũ phải chuyển tay 1 lần bằng ensure_incremental_vacuum()
+    # (python local_db_retention.py --convert-vacuum khi trạm nghỉ)
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+# Số câu lệnh đã biên dịch giữ lại trên mỗi kết nối (câu SQL giống hệt -> dùng lại, không parse lại)
+STATEMENT_CACHE_SIZE = 256
 
 class LocalDatabaseManager:
     def __init__(self, db_name="flis_local.db"):
         self.db_name = db_name
+        self._local = threading.local()
         self._initialize_db()
 
     def _get_connection(self):
-        """Tạo và trả về một kết nối đến CSDL SQLite."""
-        conn = sqlite3.connect(self.db_name)
-        # [UPDATED] Sử dụng Row factory để có thể truy cập cột theo tên (dict-like)
-        conn.row_factory = sqlite3.Row 
+        """
+        Kết nối SQLite của luồng hiện tại (mở 1 lần, dùng lại cho mọi lệnh sau).
+        sqlite3 không cho dùng chung 1 kết nối giữa các luồng -> mỗi luồng 1 kết nối.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, cached_statements=STATEMENT_CACHE_SIZE)
+            # [UPDATED] Sử dụng Row factory để có thể truy cập cột theo tên (dict-like)
+            conn.row_factory = sqlite3.Row 
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
         return conn
 
+    def close(self):
+        """Đóng kết nối của luồng hiện tại (lần gọi sau sẽ mở lại)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
     def _initialize_db(self):
         """Tự động tạo các bảng cần thiết nếu chưa tồn tại."""
         conn = self._get_connection()
@@ -43,6 +84,12 @@ class LocalDatabaseManager:
                 cursor.execute("ALTER TABLE completed_tickets ADD COLUMN roll_code TEXT")
             except sqlite3.OperationalError:
                 pass # Cột đã tồn tại
+            # Migration: đếm số lần đồng bộ lỗi (server_sync chế độ batch tạm gác phiếu lỗi quá nhiều lần)
+            for column in ("sync_attempts INTEGER DEFAULT 0", "sync_error TEXT"):
+                try:
+                    cursor.execute(f"ALTER TABLE completed_tickets ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass # Cột đã tồn tại
 
             # 2. Bảng log sản lượng
             # worker_id là TEXT -> Chấp nhận cả ID số, UUID, và "PENDING_NEXT_ROLL"
@@ -73,12 +120,84 @@ class LocalDatabaseManager:
                 points INTEGER DEFAULT 1,
                 FOREIGN KEY (ticket_id) REFERENCES completed_tickets (ticket_id)
             )""")
+
+            # 4. Outbox (Change Data Capture) cho server_sync
+            # change_id AUTOINCREMENT: tăng đơn điệu, không tái sử dụng kể cả khi đã xóa các dòng cũ
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sync_outbox'")
+            outbox_exists = cursor.fetchone() is not None
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_outbox (
+                change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticket_id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT,
+                created_at REAL,
+                attempts INTEGER DEFAULT 0
+            )""")
+            # Migration: outbox tạo trước khi có đếm số lần gửi lỗi
+            try:
+                cursor.execute("ALTER TABLE sync_outbox ADD COLUMN attempts INTEGER DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass # Cột đã tồn tại
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sync_outbox_ticket ON sync_outbox (ticket_id)")
+            # Thay đổi gửi lỗi quá số lần cho phép: tách khỏi hàng đợi, giữ lại để xử lý tay
+            # (phiếu vẫn is_synced = 0 nên không bị lưu trữ / xóa)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_outbox_dead (
+                change_id INTEGER PRIMARY KEY,
+                ticket_id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT,
+                attempts INTEGER,
+                last_error TEXT,
+                failed_at REAL
+            )""")
+            # High-water mark của tiến trình đồng bộ (change_id cuối cùng đã lên Server)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )""")
+            if not outbox_exists:
+                # Migration: phiếu chưa đồng bộ từ trước khi có outbox -> đưa vào hàng đợi (payload đọc lại từ bảng)
+                cursor.execute(
+                    "INSERT INTO sync_outbox (ticket_id, op, payload, created_at) "
+                    "SELECT ticket_id, ?, NULL, ? FROM completed_tickets WHERE is_synced = 0",
+                    (OUTBOX_OP_SESSION, time.time())
+                )
+
+            # Mốc sequence cao nhất theo prefix của các phiếu đã chuyển sang file lưu trữ
+            # (để sinh mã dự phòng không bị lùi về số cũ sau khi dọn bảng)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sequence_floor (
+                prefix TEXT PRIMARY KEY,
+                last_seq INTEGER NOT NULL
+            )""")
+
+            # Khối số thứ tự mã cây đã thuê từ Redis (cấp tiếp được khi mất mạng, không trùng giữa các trạm)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sequence_leases (
+                prefix TEXT NOT NULL,
+                start_seq INTEGER NOT NULL,
+                end_seq INTEGER NOT NULL,
+                next_seq INTEGER NOT NULL,
+                leased_at REAL,
+                PRIMARY KEY (prefix, start_seq)
+            )""")
+
+            # 5. Chỉ mục (ticket_id của completed_tickets đã là PRIMARY KEY)
+            # In phiếu / đồng bộ tra log con theo ticket_id; sinh sequence dự phòng tra theo roll_code
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_completed_tickets_roll_code ON completed_tickets (roll_code)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_roll_production_log_ticket ON roll_production_log (ticket_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ticket_errors_ticket ON ticket_errors (ticket_id)")
+            # Chỉ mục một phần: chỉ chứa phiếu chưa đồng bộ (server_sync chế độ batch/single)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_completed_tickets_unsynced "
+                           "ON completed_tickets (inspection_date) WHERE is_synced = 0")
             
             conn.commit()
         except Exception as e:
+            conn.rollback()
             print(f"Lỗi khởi tạo CSDL Local: {e}")
-        finally:
-            conn.close()
 
     def save_completed_session_v2(self, session_data):
         """
@@ -146,8 +265,8 @@ class LocalDatabaseManager:
                 )
 
             # Lưu lỗi (Error Log)
+            error_entries = []
             if all_errors_to_save:
-                error_entries = []
                 for error in all_errors_to_save:
                     w_id = error.get('worker_id')
                     s_id = error.get('shift')
@@ -173,6 +292,21 @@ class LocalDatabaseManager:
                     error_entries
                 )
 
+            # Outbox: cùng transaction -> phiếu đã lưu thì chắc chắn có thay đổi chờ đồng bộ
+            columns = ('ticket_id', 'inspection_date', 'inspector_id', 'machine_id', 'fabric_name',
+                       'order_number', 'deployment_ticket_id', 'notes', 'status', 'roll_code')
+            payload = dict(zip(columns, ticket_info))
+            payload['worker_log'] = [
+                {"worker_id": e[1], "shift": e[3], "meters_g1": e[7], "meters_g2": e[8]}
+                for e in worker_log_entries
+            ]
+            payload['error_log'] = [
+                {"error_type": e[1], "meter_location": e[2], "worker_id": e[3], "shift": e[4],
+                 "points_val": 1 if e[5] is None else e[5]}
+                for e in error_entries
+            ]
+            self._append_outbox(cursor, session_data['ticket_id'], OUTBOX_OP_SESSION, payload)
+
             conn.commit()
             print(f"Lưu thành công phiếu {session_data['ticket_id']} | Mã: {current_roll_code}")
             return True
@@ -181,8 +315,13 @@ class LocalDatabaseManager:
             print(f"LỖI khi lưu phiếu vào CSDL cục bộ: {e}")
             traceback.print_exc()
             return False
-        finally:
-            conn.close()
+
+    def _append_outbox(self, cursor, ticket_id, op, payload):
+        """Ghi 1 thay đổi vào sync_outbox (gọi bên trong transaction của thao tác ghi)."""
+        cursor.execute(
+            "INSERT INTO sync_outbox (ticket_id, op, payload, created_at) VALUES (?, ?, ?, ?)",
+            (ticket_id, op, json.dumps(payload, ensure_ascii=False), time.time())
+        )
 
     def update_ticket_post_action(self, ticket_id, notes, status):
         """Cập nhật trạng thái sau khi hoàn tất/nhập kho."""
@@ -193,6 +332,8 @@ class LocalDatabaseManager:
                 "UPDATE completed_tickets SET notes = ?, status = ?, is_synced = 0 WHERE ticket_id = ?",
                 (notes, status, ticket_id)
             )
+            if cursor.rowcount:
+                self._append_outbox(cursor, ticket_id, OUTBOX_OP_POST_ACTION, {"notes": notes, "status": status})
             conn.commit()
             print(f"Đã cập nhật phiếu {ticket_id} -> Status: {status}")
             return True
@@ -200,28 +341,177 @@ class LocalDatabaseManager:
             conn.rollback()
             print(f"LỖI update ticket: {e}")
             return False
-        finally:
-            conn.close()
 
     # --- Các hàm đọc dữ liệu ---
     
     def get_next_sequence_by_prefix(self, prefix):
+        """
+        Sequence tiếp theo cho prefix (dự phòng khi mất Redis + Server).
+        Dùng khoảng [prefix, prefix kế tiếp) thay cho LIKE -> đi thẳng vào chỉ mục roll_code,
+        kết hợp sequence_floor cho các phiếu đã chuyển sang lưu trữ.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT roll_code FROM completed_tickets WHERE roll_code LIKE ? ORDER BY roll_code DESC LIMIT 1", (prefix + '%',))
+            if prefix:
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                cursor.execute(
+                    "SELECT roll_code FROM completed_tickets WHERE roll_code >= ? AND roll_code < ? "
+                    "ORDER BY roll_code DESC LIMIT 1",
+                    (prefix, upper)
+                )
+            else:
+                cursor.execute("SELECT roll_code FROM completed_tickets ORDER BY roll_code DESC LIMIT 1")
             row = cursor.fetchone()
+            next_seq = 1
             if row and row['roll_code']: # Truy cập bằng tên cột nhờ row_factory
                 last_code = row['roll_code']
                 seq_part = last_code[-4:] 
                 if seq_part.isdigit():
-                    return int(seq_part) + 1
-            return 1
+                    next_seq = int(seq_part) + 1
+
+            cursor.execute("SELECT last_seq FROM sequence_floor WHERE prefix = ?", (prefix,))
+            floor = cursor.fetchone()
+            if floor:
+                next_seq = max(next_seq, floor['last_seq'] + 1)
+            return next_seq
         except Exception as e:
             print(f"Lỗi get_next_sequence local: {e}")
             return 1
-        finally:
-            conn.close()
+
+    # --- Khối số thứ tự thuê từ Redis (services/roll_sequence) ---
+
+    def load_sequence_leases(self):
+        """Các khối còn số chưa cấp: list dict (prefix, start_seq, end_seq, next_seq)."""
+        cursor = self._get_connection().cursor()
+        cursor.execute("""
+            SELECT prefix, start_seq, end_seq, next_seq FROM sequence_leases 
+            WHERE next_seq <= end_seq ORDER BY prefix, start_seq
+            """)
+        return [dict(row) for row in cursor.fetchall()]
+
+    def add_sequence_lease(self, prefix, start_seq, end_seq):
+        conn = self._get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO sequence_leases (prefix, start_seq, end_seq, next_seq, leased_at) VALUES (?, ?, ?, ?, ?)",
+            (prefix, start_seq, end_seq, start_seq, time.time())
+        )
+        conn.commit()
+
+    def advance_sequence_lease(self, prefix, start_seq, next_seq):
+        """Ghi nhận đã cấp tới next_seq - 1 (ghi trước khi trả mã -> khởi động lại không cấp trùng)."""
+        conn = self._get_connection()
+        conn.execute("UPDATE sequence_leases SET next_seq = ? WHERE prefix = ? AND start_seq = ?",
+                     (next_seq, prefix, start_seq))
+        conn.commit()
+
+    def delete_sequence_lease(self, prefix, start_seq):
+        conn = self._get_connection()
+        conn.execute("DELETE FROM sequence_leases WHERE prefix = ? AND start_seq = ?", (prefix, start_seq))
+        conn.commit()
+
+    # --- Lưu trữ / dọn dẹp (local_db_retention) ---
+
+    def get_archivable_tickets(self, cutoff, limit=500):
+        """
+        Phiếu đã đồng bộ, cũ hơn `cutoff` ('YYYY-MM-DD HH:MM:SS') và không còn thay đổi chờ trong outbox.
+        Trả về list dict đầy đủ cột, kèm 'worker_log' và 'error_log' (toàn bộ dòng con).
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM completed_tickets t
+            WHERE t.is_synced = 1 AND t.inspection_date < ?
+              AND NOT EXISTS (SELECT 1 FROM sync_outbox o WHERE o.ticket_id = t.ticket_id)
+            ORDER BY t.inspection_date
+            LIMIT ?
+            """, (cutoff, limit))
+        tickets = [dict(row) for row in cursor.fetchall()]
+        if not tickets:
+            return []
+
+        ids_json = json.dumps([t['ticket_id'] for t in tickets])
+        by_id = {t['ticket_id']: t for t in tickets}
+        for t in tickets:
+            t['worker_log'], t['error_log'] = [], []
+        for table, key in (('roll_production_log', 'worker_log'), ('ticket_errors', 'error_log')):
+            cursor.execute(
+                f"SELECT * FROM {table} WHERE ticket_id IN (SELECT value FROM json_each(?)) ORDER BY id",
+                (ids_json,)
+            )
+            for row in cursor.fetchall():
+                by_id[row['ticket_id']][key].append(dict(row))
+        return tickets
+
+    def purge_tickets(self, ticket_ids):
+        """
+        Xóa phiếu (và log con) đã được ghi ra file lưu trữ, trong 1 transaction.
+        Trước khi xóa, nâng sequence_floor theo prefix để sinh mã dự phòng không bị lùi.
+        """
+        if not ticket_ids:
+            return 0
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        ids_json = json.dumps(list(ticket_ids))
+        try:
+            cursor.execute("BEGIN TRANSACTION")
+            cursor.execute("""
+                INSERT INTO sequence_floor (prefix, last_seq)
+                SELECT substr(roll_code, 1, length(roll_code) - 4), MAX(CAST(substr(roll_code, -4) AS INTEGER))
+                FROM completed_tickets
+                WHERE ticket_id IN (SELECT value FROM json_each(?))
+                  AND roll_code GLOB '*[0-9][0-9][0-9][0-9]'
+                GROUP BY 1
+                ON CONFLICT (prefix) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)
+                """, (ids_json,))
+            cursor.execute("DELETE FROM ticket_errors WHERE ticket_id IN (SELECT value FROM json_each(?))", (ids_json,))
+            cursor.execute("DELETE FROM roll_production_log WHERE ticket_id IN (SELECT value FROM json_each(?))", (ids_json,))
+            cursor.execute("DELETE FROM completed_tickets WHERE ticket_id IN (SELECT value FROM json_each(?))", (ids_json,))
+            deleted = cursor.rowcount
+            conn.commit()
+            return deleted
+        except Exception:
+            conn.rollback()
+            raise
+
+    def ensure_incremental_vacuum(self):
+        """
+        CSDL tạo trước khi bật auto_vacuum: VACUUM 1 lần để chuyển sang INCREMENTAL. Trả về True nếu vừa chuyển.
+        VACUUM chép lại toàn bộ file và giữ khóa ghi suốt thời gian chạy (lưu phiếu sẽ lỗi "database is locked")
+        -> KHÔNG gọi tự động trong ca sản xuất; chỉ chạy tay qua `python local_db_retention.py --convert-vacuum`.
+        """
+        conn = self._get_connection()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    def incremental_vacuum(self, max_pages=None):
+        """Trả tối đa `max_pages` trang trống về hệ điều hành (None = tất cả), rồi rút gọn file WAL."""
+        conn = self._get_connection()
+        # executescript chạy lệnh tới cùng (execute() của sqlite3 chỉ step 1 lần = 1 trang)
+        if max_pages is None:
+            conn.executescript("PRAGMA incremental_vacuum;")
+        else:
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def get_storage_stats(self):
+        conn = self._get_connection()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return {
+            "incremental_vacuum": auto_vacuum == 2,
+            "size_bytes": page_size * page_count,
+            "free_bytes": page_size * freelist,
+            "tickets": conn.execute("SELECT COUNT(*) FROM completed_tickets").fetchone()[0],
+            "unsynced": conn.execute("SELECT COUNT(*) FROM completed_tickets WHERE is_synced = 0").fetchone()[0],
+            "outbox": conn.execute("SELECT COUNT(*) FROM sync_outbox").fetchone()[0],
+            "outbox_dead": conn.execute("SELECT COUNT(*) FROM sync_outbox_dead").fetchone()[0],
+        }
 
     def get_ticket_info_by_id(self, ticket_id):
         """
@@ -251,7 +541,6 @@ class LocalDatabaseManager:
         
         cursor.execute(query, (ticket_id,))
         row = cursor.fetchone()
-        conn.close()
         
         if row:
             # Chuyển đổi Row object sang dict chuẩn của Python
@@ -267,7 +556,6 @@ class LocalDatabaseManager:
             FROM roll_production_log WHERE ticket_id=? ORDER BY id
             """, (ticket_id,))
         rows = cursor.fetchall()
-        conn.close()
         # Chuyển list of Rows thành list of Dicts
         return [dict(row) for row in rows]
 
@@ -279,7 +567,6 @@ class LocalDatabaseManager:
             FROM ticket_errors WHERE ticket_id=? ORDER BY meter_location
             """, (ticket_id,))
         rows = cursor.fetchall()
-        conn.close()
         # Chuyển list of Rows thành list of Dicts
         return [dict(row) for row in rows]
 
@@ -0,0 +1,166 @@
+# --- File: local_db_retention.py ---
+"""
+Lưu trữ & dọn dẹp CSDL cục bộ của trạm (flis_local.db) để các bảng nóng luôn nhỏ.
+- Phiếu đã đồng bộ, cũ hơn `retention_days` ngày và không còn thay đổi chờ trong sync_outbox được ghi nối
+  vào file nén theo tháng: <archive_dir>/flis_archive_YYYY-MM.jsonl.gz (1 dòng JSON / phiếu, kèm log con),
+  sau đó mới xóa khỏi completed_tickets / roll_production_log / ticket_errors (sequence_floor giữ mốc mã cây).
+- Cuối mỗi lượt: incremental_vacuum trả trang trống cho hệ điều hành (giới hạn số trang / lượt) + checkpoint WAL.
+  CSDL tạo trước khi bật auto_vacuum = INCREMENTAL phải chuyển 1 lần bằng VACUUM (khóa ghi toàn bộ CSDL):
+  đây là bước bảo trì chạy tay khi trạm nghỉ, KHÔNG chạy tự động trong job:
+      python local_db_retention.py --convert-vacuum
+- Ghi file trước, xóa sau: mất điện giữa chừng thì lượt sau ghi lại các phiếu đó -> read_archive bỏ trùng theo ticket_id.
+"""
+import os
+import gzip
+import json
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+DEFAULT_RETENTION_DAYS = 90
+DEFAULT_INTERVAL = 6 * 3600.0      # giây giữa 2 lượt dọn
+DEFAULT_INITIAL_DELAY = 60.0       # chờ sau khởi động để không tranh I/O với lúc mở ca
+DEFAULT_BATCH_SIZE = 500           # phiếu / transaction xóa
+DEFAULT_VACUUM_PAGES = 2000        # trang trả lại / lượt (~8 MB với trang 4 KiB), tránh giữ khóa ghi lâu
+
+logger = logging.getLogger(__name__)
+
+def archive_path(archive_dir, inspection_date):
+    month = (inspection_date or '')[:7] or 'unknown'
+    return os.path.join(archive_dir, f"flis_archive_{month}.jsonl.gz")
+
+def read_archive(path):
+    """Đọc 1 file lưu trữ tháng (bỏ trùng theo ticket_id, bản ghi sau thắng)."""
+    tickets = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                ticket = json.loads(line)
+                tickets[ticket['ticket_id']] = ticket
+    return list(tickets.values())
+
+class LocalDbRetention:
+    def __init__(self, manager, archive_dir, retention_days=DEFAULT_RETENTION_DAYS, interval=DEFAULT_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE, vacuum_pages=DEFAULT_VACUUM_PAGES, initial_delay=DEFAULT_INITIAL_DELAY):
+        self.manager = manager
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.initial_delay = initial_delay
+        self.is_running = True
+
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.archived = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+
+    def _write_archive(self, tickets):
+        """Ghi nối các phiếu vào file tháng tương ứng, fsync trước khi cho phép xóa khỏi CSDL."""
+        by_file = {}
+        for ticket in tickets:
+            by_file.setdefault(archive_path(self.archive_dir, ticket.get('inspection_date')), []).append(ticket)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for path, items in by_file.items():
+            # Mỗi lần ghi thêm 1 gzip member; gzip.open đọc liền mạch nhiều member
+            with open(path, 'ab') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='ab') as gz:
+                    for ticket in items:
+                        gz.write((json.dumps(ticket, ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+        return list(by_file)
+
+    def run_once(self, now=None):
+        """1 lượt lưu trữ + dọn. Trả về số phiếu đã chuyển ra file."""
+        cutoff = ((now or datetime.now()) - timedelta(days=self.retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+        started = time.perf_counter()
+        moved = 0
+        with self._lock:
+            while self.is_running:
+                tickets = self.manager.get_archivable_tickets(cutoff, self.batch_size)
+                if not tickets:
+                    break
+                self._write_archive(tickets)
+                moved += self.manager.purge_tickets([t['ticket_id'] for t in tickets])
+                if len(tickets) < self.batch_size:
+                    break
+            self.manager.incremental_vacuum(self.vacuum_pages)
+
+            self.runs += 1
+            self.archived += moved
+            self.last_run = time.time()
+            self.last_duration = round(time.perf_counter() - started, 3)
+        if moved:
+            logger.info(f"[RETENTION] Đã lưu trữ {moved} phiếu cũ hơn {cutoff} ({self.last_duration}s)")
+        return moved
+
+    def run(self):
+        time.sleep(self.initial_delay)
+        try:
+            if not self.manager.get_storage_stats()["incremental_vacuum"]:
+                logger.warning("[RETENTION] CSDL cục bộ chưa bật auto_vacuum = INCREMENTAL: vẫn lưu trữ / xóa phiếu "
+                               "nhưng file không co lại. Khi trạm nghỉ, tắt ứng dụng rồi chạy: "
+                               "python local_db_retention.py --convert-vacuum")
+        except Exception as e:
+            logger.warning(f"[RETENTION] Không đọc được trạng thái auto_vacuum: {e}")
+        while self.is_running:
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"[RETENTION] Lỗi dọn CSDL cục bộ: {e}")
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.is_running = False
+
+    def get_stats(self):
+        try:
+            storage = self.manager.get_storage_stats()
+        except Exception as e:
+            storage = {"error": str(e)}
+        return {
+            "retention_days": self.retention_days,
+            "runs": self.runs,
+            "archived": self.archived,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "storage": storage,
+        }
+
+def start_retention_job(manager, archive_dir, **kwargs):
+    job = LocalDbRetention(manager, archive_dir, **kwargs)
+    threading.Thread(target=job.run, daemon=True, name="LocalDbRetention").start()
+    return job
+
+def main():
+    parser = argparse.ArgumentParser(description="Bảo trì CSDL cục bộ của trạm (chạy khi đã tắt ứng dụng trạm)")
+    parser.add_argument('--convert-vacuum', action='store_true',
+                        help="VACUUM 1 lần để chuyển CSDL cũ sang auto_vacuum = INCREMENTAL (khóa ghi toàn bộ CSDL)")
+    args = parser.parse_args()
+    if not args.convert_vacuum:
+        parser.print_help()
+        return
+
+    from local_db_manager import local_db_manager
+    before = local_db_manager.get_storage_stats()
+    started = time.perf_counter()
+    if local_db_manager.ensure_incremental_vacuum():
+        after = local_db_manager.get_storage_stats()
+        print(f"Đã chuyển sang auto_vacuum = INCREMENTAL trong {time.perf_counter() - started:.1f}s "
+              f"({before['size_bytes'] // 1024} KB -> {after['size_bytes'] // 1024} KB)")
+    else:
+        print("CSDL cục bộ đã ở chế độ auto_vacuum = INCREMENTAL, không cần chuyển.")
+    local_db_manager.close()
+
+if __name__ == '__main__':
+    main()
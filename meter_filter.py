@@ -0,0 +1,167 @@
+# --- File: meter_filter.py ---
+"""
+Lọc giá trị số mét giữa thanh ghi thô và `last_known_state` của Poller.
+1 frame hỏng (CRC lọt, đảo word) hoặc bộ đếm tràn sẽ hiện thành 1 bước nhảy khổng lồ,
+và complete_current_worker_shift / finalize_unassigned_meters sẽ ghi nó thành sản lượng.
+Các bước kiểm tra (so với giá trị đã chấp nhận gần nhất):
+- Âm: bộ đếm 32-bit tràn -> loại.
+- Đơn điệu: giảm quá `backward_tolerance` -> loại (trừ khi đang chờ Reset).
+- Tốc độ tối đa: tăng nhanh hơn `max_speed` (m/phút) -> loại.
+- Median-of-3: mẫu bị loại chỉ được chấp nhận làm mốc mới khi median của
+  (giá trị đã chấp nhận, mẫu bị loại trước, mẫu hiện tại) nghiêng về mức mới, tức 2/3 mẫu gần nhất
+  cùng xác nhận (VD: đồng hồ bị Reset tay trên thiết bị). Mẫu bị loại đơn lẻ = spike, bỏ qua.
+- Khởi động: mốc đầu tiên chỉ được chốt khi 2 mẫu liên tiếp khớp nhau.
+- Reset: sau write_reset_meter (expect_reset), giá trị về gần 0 trong `reset_window` giây được nhận ngay.
+Khi loại mẫu: policy 'hold' giữ giá trị cũ, 'interpolate' ngoại suy theo tốc độ gần nhất (tối đa `max_interpolate` giây).
+"""
+import time
+import threading
+
+POLICY_HOLD = 'hold'
+POLICY_INTERPOLATE = 'interpolate'
+
+DEFAULT_MAX_SPEED = 200.0           # m/phút: nhanh hơn máy kiểm vải thật
+DEFAULT_BACKWARD_TOLERANCE = 0.1    # m: dao động cho phép (1-2 đơn vị đếm)
+DEFAULT_RESET_WINDOW = 5.0          # giây chờ đồng hồ về 0 sau lệnh Reset
+DEFAULT_RESET_THRESHOLD = 1.0       # m: giá trị coi là "đã về 0"
+DEFAULT_MAX_INTERPOLATE = 5.0       # giây ngoại suy tối đa rồi chuyển sang giữ giá trị
+
+REJECT_REASONS = ('negative', 'backwards', 'too_fast')
+
+def _median3(a, b, c):
+    return sorted((a, b, c))[1]
+
+class MeterFilter:
+    def __init__(self, max_speed=DEFAULT_MAX_SPEED, policy=POLICY_HOLD,
+                 backward_tolerance=DEFAULT_BACKWARD_TOLERANCE, reset_window=DEFAULT_RESET_WINDOW,
+                 reset_threshold=DEFAULT_RESET_THRESHOLD, max_interpolate=DEFAULT_MAX_INTERPOLATE):
+        if policy not in (POLICY_HOLD, POLICY_INTERPOLATE):
+            raise ValueError(f"Policy lọc số mét không hợp lệ: {policy}")
+        self.max_speed = max_speed
+        self.policy = policy
+        self.backward_tolerance = backward_tolerance
+        self.reset_window = reset_window
+        self.reset_threshold = reset_threshold
+        self.max_interpolate = max_interpolate
+
+        self._lock = threading.Lock()
+        self._accepted = None       # (ts, value) đã chấp nhận gần nhất
+        self._pending = None        # (ts, value) bị loại ở lần đọc trước
+        self._rate = 0.0            # m/giây giữa 2 mẫu chấp nhận gần nhất
+        self._reset_until = 0.0
+
+        # Thống kê
+        self.accepted = 0
+        self.rejected = {reason: 0 for reason in REJECT_REASONS}
+        self.spikes = 0
+        self.rebaselines = 0
+        self.resets = 0
+        self.last_rejected = None
+
+    def expect_reset(self):
+        """Gọi trước khi ghi xung Reset: cho phép giá trị về 0 mà không bị coi là đi lùi."""
+        with self._lock:
+            self._reset_until = time.monotonic() + self.reset_window
+
+    def _check(self, prev_ts, prev_value, ts, value):
+        """Trả về lý do loại (hoặc None nếu hợp lệ) khi đi từ mẫu prev sang mẫu hiện tại."""
+        if value < 0:
+            return 'negative'
+        if value < prev_value - self.backward_tolerance:
+            return 'backwards'
+        max_step = self.max_speed / 60.0 * max(ts - prev_ts, 0.0) + self.backward_tolerance
+        if value - prev_value > max_step:
+            return 'too_fast'
+        return None
+
+    def _accept(self, ts, value):
+        if self._accepted is not None:
+            prev_ts, prev_value = self._accepted
+            if ts > prev_ts:
+                self._rate = max(0.0, (value - prev_value) / (ts - prev_ts))
+        self._accepted = (ts, value)
+        self._pending = None
+        self.accepted += 1
+        return value
+
+    def _substitute(self, ts):
+        """Giá trị thay thế cho mẫu bị loại theo policy."""
+        acc_ts, acc_value = self._accepted
+        if self.policy == POLICY_INTERPOLATE:
+            elapsed = min(ts - acc_ts, self.max_interpolate)
+            rate = min(self._rate, self.max_speed / 60.0)
+            return round(acc_value + rate * max(elapsed, 0.0), 3)
+        return acc_value
+
+    def filter(self, value, ts=None):
+        """Trả về (giá trị dùng được, lý do loại hoặc None)."""
+        if value is None:
+            return None, None
+        ts = time.monotonic() if ts is None else ts
+        with self._lock:
+            if self._accepted is None:
+                # Khởi động: cần 2 mẫu liên tiếp hợp lý mới chốt mốc (tránh lấy 1 frame hỏng làm mốc)
+                if value < 0:
+                    self.rejected['negative'] += 1
+                    return None, 'negative'
+                if self._pending is not None and self._check(*self._pending, ts, value) is None:
+                    return self._accept(ts, value), None
+                self._pending = (ts, value)
+                return None, 'warmup'
+
+            if ts <= self._reset_until and 0 <= value <= self.reset_threshold:
+                self.resets += 1
+                self._reset_until = 0.0
+                self._rate = 0.0
+                self._accepted = None
+                return self._accept(ts, value), None
+
+            acc_ts, acc_value = self._accepted
+            reason = self._check(acc_ts, acc_value, ts, value)
+            if reason is None:
+                if self._pending is not None:
+                    self.spikes += 1
+                return self._accept(ts, value), None
+
+            # Mẫu lệch: chỉ nhận làm mốc mới nếu mẫu bị loại trước đó cùng xác nhận (2/3 mẫu)
+            if self._pending is not None:
+                pend_ts, pend_value = self._pending
+                median = _median3(acc_value, pend_value, value)
+                if median != acc_value and self._check(pend_ts, pend_value, ts, value) is None:
+                    self.rebaselines += 1
+                    self._accepted = None
+                    return self._accept(ts, value), None
+
+            self.rejected[reason] += 1
+            self._pending = (ts, value)
+            self.last_rejected = {"value": value, "reason": reason, "at": time.time()}
+            return self._substitute(ts), reason
+
+    def filter_packet(self, packet):
+        """Lọc trường 'meters' của gói dữ liệu Poller. Mẫu bị loại được đánh dấu 'filtered'."""
+        if not packet or packet.get('meters') is None or packet.get('error'):
+            return packet
+        value, reason = self.filter(packet['meters'])
+        if reason == 'warmup':
+            return {}
+        if value is None:
+            return {'error': "Số mét không hợp lệ"}
+        packet = dict(packet)
+        packet['meters'] = value
+        if reason:
+            packet['filtered'] = reason
+        return packet
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "max_speed": self.max_speed,
+                "accepted": self.accepted,
+                "rejected": dict(self.rejected),
+                "rejected_total": sum(self.rejected.values()),
+                "spikes": self.spikes,
+                "rebaselines": self.rebaselines,
+                "resets": self.resets,
+                "last_rejected": self.last_rejected,
+            }
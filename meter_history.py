@@ -0,0 +1,140 @@
+# --- File: meter_history.py ---
+"""
+Lịch sử số mét trên trạm (trong RAM, dung lượng cố định).
+- Ring buffer mẫu thô (timestamp, meters) dùng array (không tạo object cho từng mẫu).
+- Gộp dần (downsample) ngay khi ghi vào các bucket 1 giây, 1 phút, 1 giờ:
+  giá trị đầu / cuối / min / max, số mẫu và số mét sản xuất (tổng các bước tăng, bỏ qua lần Reset).
+- Truy vấn qua /api/meter/history để tính mét/phút, thời gian dừng máy, đối chiếu thời điểm ghi lỗi.
+"""
+import math
+import threading
+from array import array
+
+RESOLUTION_RAW = 'raw'
+# Tên độ phân giải -> (số giây / bucket, số bucket giữ lại)
+TIERS = {
+    '1s': (1, 3600),       # 1 giờ gần nhất
+    '1m': (60, 1440),      # 24 giờ gần nhất
+    '1h': (3600, 720),     # 30 ngày gần nhất
+}
+DEFAULT_RAW_CAPACITY = 7200    # ~1 giờ ở chu kỳ 0.5s
+
+class _SampleRing:
+    """Ring buffer mẫu thô."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts = array('d', bytes(8 * capacity))
+        self.value = array('d', bytes(8 * capacity))
+        self.head = 0       # Vị trí ghi kế tiếp
+        self.size = 0
+
+    def append(self, ts, value):
+        self.ts[self.head] = ts
+        self.value[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def iter_range(self, since, until):
+        start = (self.head - self.size) % self.capacity
+        for i in range(self.size):
+            idx = (start + i) % self.capacity
+            ts = self.ts[idx]
+            if since <= ts <= until:
+                yield {"ts": ts, "meters": self.value[idx]}
+
+class _BucketRing:
+    """Ring buffer các bucket gộp theo thời gian."""
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.start = array('d', bytes(8 * capacity))
+        self.first = array('d', bytes(8 * capacity))
+        self.last = array('d', bytes(8 * capacity))
+        self.min = array('d', bytes(8 * capacity))
+        self.max = array('d', bytes(8 * capacity))
+        self.produced = array('d', bytes(8 * capacity))
+        self.count = array('l', bytes(array('l').itemsize * capacity))
+        self.head = -1      # Vị trí bucket hiện tại
+        self.size = 0
+
+    def add(self, ts, value, step):
+        bucket_start = math.floor(ts / self.resolution) * self.resolution
+        i = self.head
+        if i < 0 or bucket_start > self.start[i]:
+            i = self.head = (self.head + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.start[i] = bucket_start
+            self.first[i] = self.last[i] = self.min[i] = self.max[i] = value
+            self.produced[i] = step
+            self.count[i] = 1
+            return
+        if bucket_start < self.start[i]:
+            return    # Đồng hồ hệ thống bị chỉnh lùi: bỏ mẫu thay vì ghi sai bucket
+        self.last[i] = value
+        if value < self.min[i]: self.min[i] = value
+        if value > self.max[i]: self.max[i] = value
+        self.produced[i] += step
+        self.count[i] += 1
+
+    def iter_range(self, since, until):
+        if self.head < 0:
+            return
+        start = (self.head - self.size + 1) % self.capacity
+        for k in range(self.size):
+            i = (start + k) % self.capacity
+            bucket_start = self.start[i]
+            if since <= bucket_start + self.resolution and bucket_start <= until:
+                yield {
+                    "ts": bucket_start,
+                    "first": self.first[i],
+                    "last": self.last[i],
+                    "min": self.min[i],
+                    "max": self.max[i],
+                    "produced": round(self.produced[i], 3),
+                    "samples": self.count[i],
+                }
+
+class MeterHistory:
+    def __init__(self, raw_capacity=DEFAULT_RAW_CAPACITY):
+        self._lock = threading.Lock()
+        self._raw = _SampleRing(raw_capacity)
+        self._tiers = {name: _BucketRing(res, cap) for name, (res, cap) in TIERS.items()}
+        self._last_value = None
+        self.total_samples = 0
+
+    def record(self, ts, meters):
+        """Ghi 1 mẫu. `produced` chỉ cộng các bước tăng (giảm = Reset đồng hồ, không tính là sản lượng âm)."""
+        if meters is None:
+            return
+        with self._lock:
+            step = 0.0
+            if self._last_value is not None and meters > self._last_value:
+                step = meters - self._last_value
+            self._last_value = meters
+            self._raw.append(ts, meters)
+            for tier in self._tiers.values():
+                tier.add(ts, meters, step)
+            self.total_samples += 1
+
+    def query(self, resolution='1s', since=0.0, until=float('inf'), limit=None):
+        """Trả về danh sách mẫu / bucket theo thứ tự thời gian (mới nhất ở cuối)."""
+        with self._lock:
+            if resolution == RESOLUTION_RAW:
+                rows = list(self._raw.iter_range(since, until))
+            elif resolution in self._tiers:
+                rows = list(self._tiers[resolution].iter_range(since, until))
+            else:
+                raise ValueError(f"Độ phân giải không hợp lệ: {resolution}. Chọn: raw, {', '.join(TIERS)}")
+        if limit:
+            rows = rows[-limit:]
+        return rows
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                "total_samples": self.total_samples,
+                "raw": {"size": self._raw.size, "capacity": self._raw.capacity},
+            }
+            for name, tier in self._tiers.items():
+                stats[name] = {"size": tier.size, "capacity": tier.capacity}
+            return stats
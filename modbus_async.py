@@ -0,0 +1,288 @@
+# --- File: modbus_async.py ---
+"""
+Backend asyncio cho Poller đồng hồ mét ([Modbus] BACKEND = asyncio).
+- Chạy 1 event loop riêng trong luồng daemon; đọc, xung Reset và phát Socket.IO là các coroutine độc lập.
+- Xung Reset (bật coil -> chờ 0.5s -> tắt coil) không chặn vòng đọc: trong lúc chờ, các lệnh đọc vẫn chạy.
+- Truyền thông: RS-485 (AsyncModbusSerialClient) hoặc Modbus TCP qua Gateway (AsyncModbusTcpClient).
+- Dùng chung bản đồ thanh ghi (modbus_engine), bộ lập lịch (poll_scheduler) và lớp phát (telemetry_publisher)
+  với ModbusPoller đồng bộ -> giao diện với Flask giống hệt (get_last_state, write_reset_meter, get_stats...).
+
+Chạy thử không cần phần cứng: TRANSPORT = sim | replay (modbus_sim.py), hoặc bật 1 Modbus TCP
+simulator (VD: pymodbus.simulator) rồi đặt TRANSPORT = tcp, TCP_HOST / TCP_PORT trỏ tới simulator.
+"""
+import time
+import asyncio
+import threading
+
+from pymodbus.client import AsyncModbusSerialClient, AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusException, ModbusIOException
+
+from telemetry_publisher import TelemetryPublisher, DEFAULT_DEADBAND, DEFAULT_HEARTBEAT
+from poll_scheduler import PollScheduler, DEFAULT_FAST_INTERVAL, DEFAULT_IDLE_INTERVAL, DEFAULT_IDLE_AFTER, DEFAULT_BACKOFF_MAX
+from meter_history import MeterHistory
+from meter_filter import MeterFilter
+from modbus_engine import (
+    ModbusPollingEngine, ModbusReadError, load_register_map, response_values, timeout_error, METER_POINT,
+    KIND_INPUT, KIND_HOLDING, KIND_COIL,
+)
+from modbus_sim import SIM_TRANSPORTS
+from modbus_poller import COM_PORT, POLL_INTERVAL, MODBUS_SLAVE_ID, RESET_REGISTER, RESET_PULSE_SECONDS
+
+TRANSPORT_SERIAL = 'serial'
+TRANSPORT_TCP = 'tcp'
+CALL_TIMEOUT = 5.0      # Giây chờ tối đa khi luồng Flask gọi vào event loop
+
+async def execute_block_async(client, slave_id, block):
+    """Bản asyncio của modbus_engine.execute_block."""
+    if block.kind == KIND_INPUT:
+        return await client.read_input_registers(address=block.start, count=block.count, device_id=slave_id)
+    if block.kind == KIND_HOLDING:
+        return await client.read_holding_registers(address=block.start, count=block.count, device_id=slave_id)
+    if block.kind == KIND_COIL:
+        return await client.read_coils(address=block.start, count=block.count, device_id=slave_id)
+    return await client.read_discrete_inputs(address=block.start, count=block.count, device_id=slave_id)
+
+class AsyncModbusPoller:
+    def __init__(self, socketio, station_id=None, settings=None, relay=None):
+        self.socketio = socketio
+        self.station_id = station_id
+        self.settings = settings or {}
+        self.publisher = TelemetryPublisher(
+            socketio, station_id,
+            deadband=self.settings.get('deadband', DEFAULT_DEADBAND),
+            heartbeat=self.settings.get('heartbeat', DEFAULT_HEARTBEAT),
+            relay=relay,
+        )
+        self.scheduler = PollScheduler(
+            fast_interval=self.settings.get('poll_fast', DEFAULT_FAST_INTERVAL),
+            base_interval=self.settings.get('poll_base', POLL_INTERVAL),
+            idle_interval=self.settings.get('poll_idle', DEFAULT_IDLE_INTERVAL),
+            idle_after=self.settings.get('idle_after', DEFAULT_IDLE_AFTER),
+            backoff_max=self.settings.get('backoff_max', DEFAULT_BACKOFF_MAX),
+        )
+        self.engine = ModbusPollingEngine(load_register_map(self.settings.get('register_map') or None))
+        meter_device = self.engine.meter_device
+        self.meter_slave_id = meter_device.slave_id if meter_device else MODBUS_SLAVE_ID
+
+        self.transport = self.settings.get('transport') or TRANSPORT_SERIAL
+        if self.transport == TRANSPORT_TCP:
+            self.target = f"{self.settings.get('tcp_host', '127.0.0.1')}:{self.settings.get('tcp_port', 502)}"
+        elif self.transport in SIM_TRANSPORTS:
+            self.target = self.transport
+        else:
+            self.target = self.settings.get('port') or COM_PORT
+
+        self.last_known_state = {'meters': 0.0, 'error': 'Chưa kết nối'}
+        # Lịch sử số mét (ring buffer + bucket 1s / 1m / 1h) cho /api/meter/history
+        self.history = MeterHistory(self.settings.get('history_capacity', 7200))
+        # Lọc số mét (đơn điệu, tốc độ tối đa, median-of-3, Reset) trước khi dùng để tính sản lượng
+        self.meter_filter = MeterFilter(
+            max_speed=self.settings.get('filter_max_speed', 200.0),
+            policy=self.settings.get('filter_policy', 'hold'),
+            reset_window=self.settings.get('filter_reset_window', 5.0),
+        )
+        self.is_running = True
+        self.loop = None
+        self.client = None
+        self._bus_lock = None     # asyncio.Lock: tuần tự hóa từng giao dịch trên bus (tạo trong event loop)
+        self._publish_queue = None    # asyncio.Queue: 1 consumer duy nhất phát frame -> seq lên dây đúng thứ tự
+        self._started = threading.Event()
+
+    # --- VÒNG ĐỜI ---
+    def _create_client(self):
+        if self.transport in SIM_TRANSPORTS:
+            from modbus_sim import AsyncSimClient, create_sim_client
+            return AsyncSimClient(create_sim_client(self.settings, self.engine.devices, RESET_REGISTER))
+        if self.transport == TRANSPORT_TCP:
+            return AsyncModbusTcpClient(
+                self.settings.get('tcp_host', '127.0.0.1'), port=self.settings.get('tcp_port', 502), timeout=1
+            )
+        return AsyncModbusSerialClient(
+            port=self.target, baudrate=self.settings.get('baudrate', 9600), stopbits=2,
+            bytesize=8, parity='N', timeout=1
+        )
+
+    def run(self):
+        """Điểm vào của luồng daemon: tạo event loop riêng và chạy vòng đọc."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._bus_lock = asyncio.Lock()
+        self._publish_queue = asyncio.Queue()
+        self.client = self._create_client()
+        publisher_task = self.loop.create_task(self._publish_worker())
+        self._started.set()
+        try:
+            self.loop.run_until_complete(self.polling_loop())
+        finally:
+            publisher_task.cancel()
+            try:
+                self.loop.run_until_complete(publisher_task)
+            except asyncio.CancelledError:
+                pass
+            if self.client:
+                self.client.close()
+            self.loop.close()
+
+    def stop_polling(self):
+        self.is_running = False
+
+    def get_last_state(self):
+        return self.last_known_state
+
+    def get_stats(self):
+        return {
+            "backend": "asyncio",
+            "transport": self.transport,
+            "target": self.target,
+            "scheduler": self.scheduler.get_stats(),
+            "publisher": self.publisher.get_stats(),
+            "history": self.history.get_stats(),
+            "filter": self.meter_filter.get_stats(),
+            "devices": self.engine.get_plan_summary(),
+            "sim": self.client.get_stats() if hasattr(self.client, 'get_stats') else None,
+        }
+
+    # --- COROUTINES ---
+    async def _connect(self):
+        connected = await self.client.connect()
+        if not connected:
+            self.last_known_state['error'] = f"Lỗi kết nối {self.target}"
+            return False
+        self.last_known_state['error'] = None
+        return True
+
+    async def _publish(self, packet, force=False):
+        """Xếp frame vào hàng đợi phát (không chờ fan-out Socket.IO)."""
+        await self._publish_queue.put((packet, force))
+
+    async def _publish_worker(self):
+        """
+        Consumer DUY NHẤT của hàng đợi phát: gọi publisher.publish lần lượt trong executor
+        (fan-out không chặn event loop). Nhiều lệnh phát song song trong thread pool có thể
+        đưa frame lên dây sai thứ tự seq -> HMI đếm nhầm mất frame và số mét nhảy lùi.
+        """
+        while True:
+            packet, force = await self._publish_queue.get()
+            try:
+                await self.loop.run_in_executor(None, lambda: self.publisher.publish(packet, force=force))
+            except Exception:
+                pass
+
+    async def _poll_device(self, device):
+        """Slave không phản hồi (client async NÉM ModbusIOException) -> ModbusReadError của riêng thiết bị."""
+        result = {}
+        for block in device.blocks:
+            try:
+                async with self._bus_lock:
+                    response = await execute_block_async(self.client, device.slave_id, block)
+            except ModbusIOException as e:
+                raise timeout_error(device.slave_id, block, e) from e
+            result.update(block.decode(response_values(block, response)))
+        return result
+
+    async def _poll_tick(self):
+        meter_device = self.engine.meter_device
+        meter_polled = False
+        meter_error = None
+
+        for device in self.engine.due_devices():
+            t_read = time.perf_counter()
+            try:
+                result = await self._poll_device(device)
+                self.engine.apply_result(device, result)
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=True)
+            except ModbusReadError as re_err:
+                self.engine.apply_result(device, error=re_err)
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=False, timeout=re_err.timeout)
+                if device is meter_device:
+                    meter_error = "Lỗi đọc Modbus"
+            except ModbusException as me:
+                # Lỗi cổng / kết nối (ConnectionException...) -> polling_loop đóng bus và kết nối lại
+                self.engine.apply_result(device, error=me)
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=False)
+                raise
+            if device is meter_device:
+                meter_polled = True
+
+        if not meter_polled:
+            return {}
+        return self.engine.build_packet(meter_error)
+
+    async def polling_loop(self):
+        if not await self._connect():
+            await self._publish(self.last_known_state)
+
+        while self.is_running:
+            data_packet = {}
+            try:
+                if not self.client.connected:
+                    if not await self._connect():
+                        await asyncio.sleep(self.scheduler.reconnect_delay())
+                        continue
+                    self.scheduler.on_connected()
+
+                data_packet = self.meter_filter.filter_packet(await self._poll_tick())
+
+            except ModbusException:
+                data_packet = {'error': "Lỗi Modbus"}
+                self.client.close()
+            except Exception:
+                data_packet = {'error': "Lỗi không xác định"}
+                self.client.close()
+
+            if data_packet:
+                self.scheduler.note_value(data_packet.get('meters'))
+                self.history.record(time.time(), data_packet.get('meters'))
+                self.last_known_state = data_packet
+                # Không chờ phát xong mới đọc tiếp (consumer phát theo đúng thứ tự xếp hàng)
+                self._publish_queue.put_nowait((data_packet, False))
+
+            await asyncio.sleep(self.scheduler.next_sleep())
+
+    async def _reset_pulse(self):
+        if not self.client or not self.client.connected:
+            return False
+        self.meter_filter.expect_reset()
+        async with self._bus_lock:
+            await self.client.write_coil(address=RESET_REGISTER, value=True, device_id=self.meter_slave_id)
+        # Lock được nhả trong lúc giữ xung -> vòng đọc không bị chặn
+        await asyncio.sleep(RESET_PULSE_SECONDS)
+        async with self._bus_lock:
+            await self.client.write_coil(address=RESET_REGISTER, value=False, device_id=self.meter_slave_id)
+        await self._read_and_emit_once()
+        return True
+
+    async def _read_and_emit_once(self):
+        meter_device = self.engine.meter_device
+        if not meter_device:
+            return
+        result = await self._poll_device(meter_device)
+        self.engine.apply_result(meter_device, result)
+        value, _ = self.meter_filter.filter(result.get(METER_POINT))
+        await self._publish({'meters': value, 'error': None}, force=True)
+
+    # --- GỌI TỪ LUỒNG FLASK ---
+    def _call(self, coro_factory):
+        if not self._started.wait(CALL_TIMEOUT) or not self.loop or self.loop.is_closed():
+            return None
+        future = asyncio.run_coroutine_threadsafe(coro_factory(), self.loop)
+        return future.result(timeout=CALL_TIMEOUT)
+
+    def write_reset_meter(self):
+        try:
+            return bool(self._call(self._reset_pulse))
+        except Exception:
+            return False
+
+    def read_and_emit_once(self):
+        try:
+            self._call(self._read_and_emit_once)
+        except Exception:
+            pass
+
+def start_async_poller(socketio, station_id=None, settings=None, relay=None):
+    poller_instance = AsyncModbusPoller(socketio, station_id, settings, relay)
+    thread = threading.Thread(target=poller_instance.run, name="ModbusAsyncPoller")
+    thread.daemon = True
+    thread.start()
+    return poller_instance
@@ -0,0 +1,254 @@
+# --- File: modbus_engine.py ---
+"""
+Engine đọc Modbus nhiều thiết bị (nhiều Slave RS-485 trên cùng 1 bus) theo bản đồ thanh ghi.
+- Mỗi thiết bị khai báo danh sách điểm đo: đồng hồ mét, tốc độ, lý do dừng, trạng thái coil...
+- Các thanh ghi liền kề (cùng loại) được gộp thành 1 lệnh đọc duy nhất cho mỗi thiết bị.
+- Các thiết bị được đọc xoay vòng (round-robin) trong cùng 1 luồng; thiết bị phụ có thể đọc thưa hơn (`every`).
+Phần lập kế hoạch đọc / giải mã không phụ thuộc client -> dùng chung cho backend đồng bộ và asyncio.
+"""
+import json
+
+from pymodbus.exceptions import ModbusIOException
+
+METER_POINT = 'meters'       # Tên điểm đo số mét (ModbusPoller dùng giá trị này)
+
+KIND_INPUT = 'input'         # Input Register (FC4)
+KIND_HOLDING = 'holding'     # Holding Register (FC3)
+KIND_COIL = 'coil'           # Coil (FC1)
+KIND_DISCRETE = 'discrete'   # Discrete Input (FC2)
+
+# Giới hạn số phần tử / 1 lệnh đọc theo chuẩn Modbus
+MAX_REGISTERS_PER_READ = 125
+MAX_BITS_PER_READ = 2000
+# Cho phép gộp qua khoảng trống nhỏ (đọc thừa vài thanh ghi rẻ hơn thêm 1 lượt hỏi-đáp trên bus)
+DEFAULT_MAX_GAP = 4
+
+_TYPE_WIDTH = {'uint16': 1, 'int16': 1, 'uint32': 2, 'int32': 2, 'bool': 1}
+
+# Bản đồ mặc định = cấu hình cũ của modbus_poller.py (Slave 1, Input Register 1003-1004, Low Word First, / 10)
+DEFAULT_REGISTER_MAP = {
+    "devices": [
+        {
+            "name": "meter_counter",
+            "slave_id": 1,
+            "every": 1,
+            "points": [
+                {"name": METER_POINT, "kind": KIND_INPUT, "address": 1003, "type": "int32",
+                 "word_order": "low_first", "divisor": 10}
+            ]
+        }
+    ]
+}
+
+class RegisterPoint:
+    def __init__(self, name, kind, address, type='uint16', word_order='low_first', scale=1.0, divisor=1):
+        if kind not in (KIND_INPUT, KIND_HOLDING, KIND_COIL, KIND_DISCRETE):
+            raise ValueError(f"Loại thanh ghi không hợp lệ: {kind}")
+        if kind in (KIND_COIL, KIND_DISCRETE):
+            type = 'bool'
+        if type not in _TYPE_WIDTH:
+            raise ValueError(f"Kiểu dữ liệu không hợp lệ: {type}")
+        self.name = name
+        self.kind = kind
+        self.address = int(address)
+        self.type = type
+        self.word_order = word_order
+        self.scale = scale
+        self.divisor = divisor
+        self.width = _TYPE_WIDTH[type]
+
+    def decode(self, values):
+        """Giải mã giá trị từ các word / bit đã đọc (values có độ dài = width)."""
+        if self.type == 'bool':
+            return bool(values[0])
+        if self.width == 1:
+            raw = values[0]
+            if self.type == 'int16' and raw > 32767:
+                raw -= 65536
+        else:
+            low, high = (values[0], values[1]) if self.word_order == 'low_first' else (values[1], values[0])
+            raw = (high << 16) | low
+            if self.type == 'int32' and raw > 2147483647:
+                raw -= 4294967296
+        # Chia trước (divisor) để giữ đúng kết quả như công thức cũ `signed / 10.0`
+        if self.divisor != 1:
+            raw = raw / self.divisor
+        return raw * self.scale if self.scale != 1 else raw
+
+class ReadBlock:
+    """1 lệnh đọc Modbus (1 loại thanh ghi, dải địa chỉ liên tục) phục vụ nhiều điểm đo."""
+    def __init__(self, kind, start, count, points):
+        self.kind = kind
+        self.start = start
+        self.count = count
+        self.points = points
+
+    def decode(self, values):
+        result = {}
+        for p in self.points:
+            offset = p.address - self.start
+            result[p.name] = p.decode(values[offset:offset + p.width])
+        return result
+
+class DeviceSpec:
+    def __init__(self, name, slave_id, points, every=1, max_gap=DEFAULT_MAX_GAP):
+        self.name = name
+        self.slave_id = int(slave_id)
+        self.points = points
+        self.every = max(1, int(every))
+        self.blocks = build_read_plan(points, max_gap)
+
+    @classmethod
+    def from_dict(cls, data, max_gap=DEFAULT_MAX_GAP):
+        points = [RegisterPoint(
+            p['name'], p.get('kind', KIND_INPUT), p['address'], p.get('type', 'uint16'),
+            p.get('word_order', 'low_first'), p.get('scale', 1.0), p.get('divisor', 1)
+        ) for p in data.get('points', [])]
+        return cls(data.get('name') or f"slave_{data['slave_id']}", data['slave_id'], points,
+                   data.get('every', 1), max_gap)
+
+def build_read_plan(points, max_gap=DEFAULT_MAX_GAP):
+    """Gộp các điểm đo cùng loại, địa chỉ liền kề (hoặc cách nhau <= max_gap) thành các ReadBlock."""
+    blocks = []
+    by_kind = {}
+    for p in points:
+        by_kind.setdefault(p.kind, []).append(p)
+
+    for kind, items in by_kind.items():
+        limit = MAX_BITS_PER_READ if kind in (KIND_COIL, KIND_DISCRETE) else MAX_REGISTERS_PER_READ
+        items.sort(key=lambda p: p.address)
+        current = [items[0]]
+        start = items[0].address
+        end = start + items[0].width
+        for p in items[1:]:
+            new_end = max(end, p.address + p.width)
+            if p.address - end <= max_gap and new_end - start <= limit:
+                current.append(p)
+                end = new_end
+            else:
+                blocks.append(ReadBlock(kind, start, end - start, current))
+                current, start, end = [p], p.address, p.address + p.width
+        blocks.append(ReadBlock(kind, start, end - start, current))
+    return blocks
+
+def load_register_map(path=None):
+    """Đọc bản đồ thanh ghi (JSON). Không có file -> bản đồ mặc định (1 đồng hồ mét)."""
+    data = DEFAULT_REGISTER_MAP
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    max_gap = data.get('max_gap', DEFAULT_MAX_GAP)
+    devices = [DeviceSpec.from_dict(d, max_gap) for d in data.get('devices', [])]
+    if not devices:
+        raise ValueError("Bản đồ thanh ghi không có thiết bị nào.")
+    return devices
+
+class ModbusReadError(Exception):
+    """Thiết bị trả về mã lỗi Modbus (hoặc không phản hồi) cho 1 lệnh đọc."""
+    def __init__(self, message, timeout=False):
+        super().__init__(message)
+        self.timeout = timeout
+
+def execute_block(client, slave_id, block):
+    """Thực thi 1 ReadBlock bằng client pymodbus đồng bộ. Trả về list word / bit."""
+    if block.kind == KIND_INPUT:
+        response = client.read_input_registers(address=block.start, count=block.count, device_id=slave_id)
+    elif block.kind == KIND_HOLDING:
+        response = client.read_holding_registers(address=block.start, count=block.count, device_id=slave_id)
+    elif block.kind == KIND_COIL:
+        response = client.read_coils(address=block.start, count=block.count, device_id=slave_id)
+    else:
+        response = client.read_discrete_inputs(address=block.start, count=block.count, device_id=slave_id)
+    return response
+
+def timeout_error(slave_id, block, error):
+    """
+    pymodbus 3.11 NÉM ModbusIOException ("No response received after N retries") khi Slave không phản hồi
+    -> đổi thành lỗi của riêng thiết bị đó để 1 Slave chết không làm đóng cả bus.
+    """
+    return ModbusReadError(f"Slave {slave_id} không phản hồi khi đọc {block.kind}@{block.start}: {error}", timeout=True)
+
+def response_values(block, response):
+    if response.isError():
+        timeout = isinstance(response, ModbusIOException)
+        raise ModbusReadError(f"Slave {'không phản hồi' if timeout else 'trả lỗi'} khi đọc {block.kind}@{block.start}", timeout)
+    if block.kind in (KIND_COIL, KIND_DISCRETE):
+        return response.bits[:block.count]
+    return response.registers
+
+class ModbusPollingEngine:
+    """
+    Đọc xoay vòng các thiết bị trên 1 bus. Mỗi nhịp (tick) đọc các thiết bị đến lượt
+    (tick % every == 0), thứ tự bắt đầu xoay vòng để không thiết bị nào luôn bị đọc sau cùng.
+    """
+    def __init__(self, devices):
+        self.devices = devices
+        self.values = {}             # Giá trị mới nhất của mọi điểm đo
+        self.device_errors = {}      # device.name -> thông báo lỗi (None nếu OK)
+        self._tick = 0
+        self._rr_offset = 0
+        self.meter_device = next((d for d in devices if any(p.name == METER_POINT for p in d.points)), None)
+
+    def due_devices(self):
+        """Danh sách thiết bị cần đọc ở nhịp hiện tại, theo thứ tự round-robin."""
+        n = len(self.devices)
+        order = [self.devices[(self._rr_offset + i) % n] for i in range(n)]
+        due = [d for d in order if self._tick % d.every == 0]
+        self._tick += 1
+        self._rr_offset = (self._rr_offset + 1) % n
+        return due
+
+    def poll_device(self, client, device, lock=None):
+        """
+        Đọc toàn bộ block của 1 thiết bị (đồng bộ). Lỗi Modbus -> ghi nhận vào device_errors rồi ném lại.
+        Slave không phản hồi / trả lỗi -> ModbusReadError; chỉ lỗi cổng (ConnectionException...) mới ném nguyên gốc.
+        """
+        result = {}
+        try:
+            for block in device.blocks:
+                try:
+                    if lock is not None:
+                        with lock:
+                            response = execute_block(client, device.slave_id, block)
+                    else:
+                        response = execute_block(client, device.slave_id, block)
+                except ModbusIOException as e:
+                    raise timeout_error(device.slave_id, block, e) from e
+                result.update(block.decode(response_values(block, response)))
+        except Exception as e:
+            self.device_errors[device.name] = str(e) or e.__class__.__name__
+            raise
+        self.device_errors[device.name] = None
+        self.values.update(result)
+        return result
+
+    def apply_result(self, device, result=None, error=None):
+        """Dùng cho backend asyncio: ghi nhận kết quả đọc của 1 thiết bị."""
+        if error is not None:
+            self.device_errors[device.name] = str(error) or error.__class__.__name__
+            return
+        self.device_errors[device.name] = None
+        self.values.update(result or {})
+
+    def build_packet(self, meter_error=None):
+        """Gói dữ liệu phát lên HMI sau 1 nhịp có đọc đồng hồ mét."""
+        if meter_error:
+            return {'error': meter_error}
+        packet = {'meters': self.values.get(METER_POINT), 'error': None}
+        points = {k: v for k, v in self.values.items() if k != METER_POINT}
+        if points:
+            packet['points'] = points
+        device_errors = {k: v for k, v in self.device_errors.items() if v}
+        if device_errors:
+            packet['device_errors'] = device_errors
+        return packet
+
+    def get_plan_summary(self):
+        return [{
+            "device": d.name,
+            "slave_id": d.slave_id,
+            "every": d.every,
+            "reads": [{"kind": b.kind, "start": b.start, "count": b.count,
+                       "points": [p.name for p in b.points]} for b in d.blocks],
+            "error": self.device_errors.get(d.name),
+        } for d in self.devices]
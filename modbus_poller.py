@@ -1,10 +1,18 @@
 # modbus_poller.py (FINAL: Low Word First + Keep / 100)
+# [UPDATED] Đọc theo bản đồ thanh ghi (modbus_engine): nhiều Slave trên 1 bus, gộp thanh ghi liền kề.
 import time
 from threading import Thread, Lock
 from pymodbus.client import ModbusSerialClient
-from pymodbus.exceptions import ModbusException
+from pymodbus.exceptions import ModbusException, ModbusIOException
 import platform
 
+from telemetry_publisher import TelemetryPublisher, DEFAULT_DEADBAND, DEFAULT_HEARTBEAT
+from poll_scheduler import PollScheduler, DEFAULT_FAST_INTERVAL, DEFAULT_IDLE_INTERVAL, DEFAULT_IDLE_AFTER, DEFAULT_BACKOFF_MAX
+from meter_history import MeterHistory
+from meter_filter import MeterFilter
+from modbus_sim import SIM_TRANSPORTS, RecordingClient, create_sim_client
+from modbus_engine import ModbusPollingEngine, ModbusReadError, load_register_map, METER_POINT
+
 # --- CẤU HÌNH ---
 if platform.system() == 'Windows':
     COM_PORT = 'COM6' 
@@ -12,27 +20,68 @@ else:
     COM_PORT = '/dev/ttyUSB0'
 
 MODBUS_SLAVE_ID = 1
-POLL_INTERVAL = 0.5 
+POLL_INTERVAL = 0.5     # Chu kỳ cơ bản (PollScheduler điều chỉnh nhanh/chậm theo tốc độ máy)
 
 # --- CẤU HÌNH THANH GHI ---
+# Mặc định (không khai báo REGISTER_MAP): Slave 1, Input Register 1003-1004 (Low Word First, / 10)
 METER_REGISTER = 1003  # Address 1003
-RESET_REGISTER = 0     # Reset 0
+RESET_REGISTER = 0     # Reset 0 (Coil trên thiết bị chứa điểm đo 'meters')
+RESET_PULSE_SECONDS = 0.5
 
 class ModbusPoller:
-    def __init__(self, socketio):
+    def __init__(self, socketio, station_id=None, settings=None, relay=None):
         self.socketio = socketio
-        self.client = ModbusSerialClient(
-            port=COM_PORT, baudrate=9600, stopbits=2, 
-            bytesize=8, parity='N', timeout=1
+        self.station_id = station_id
+        self.settings = settings or {}
+        self.publisher = TelemetryPublisher(
+            socketio, station_id,
+            deadband=self.settings.get('deadband', DEFAULT_DEADBAND),
+            heartbeat=self.settings.get('heartbeat', DEFAULT_HEARTBEAT),
+            relay=relay,
         )
+        self.scheduler = PollScheduler(
+            fast_interval=self.settings.get('poll_fast', DEFAULT_FAST_INTERVAL),
+            base_interval=self.settings.get('poll_base', POLL_INTERVAL),
+            idle_interval=self.settings.get('poll_idle', DEFAULT_IDLE_INTERVAL),
+            idle_after=self.settings.get('idle_after', DEFAULT_IDLE_AFTER),
+            backoff_max=self.settings.get('backoff_max', DEFAULT_BACKOFF_MAX),
+        )
+        self.engine = ModbusPollingEngine(load_register_map(self.settings.get('register_map') or None))
+        meter_device = self.engine.meter_device
+        self.meter_slave_id = meter_device.slave_id if meter_device else MODBUS_SLAVE_ID
+        self.port = self.settings.get('port') or COM_PORT
+        self.client = self._create_client()
         self.last_known_state = {'meters': 0.0, 'error': 'Chưa kết nối'}
+        # Lịch sử số mét (ring buffer + bucket 1s / 1m / 1h) cho /api/meter/history
+        self.history = MeterHistory(self.settings.get('history_capacity', 7200))
+        # Lọc số mét (đơn điệu, tốc độ tối đa, median-of-3, Reset) trước khi dùng để tính sản lượng
+        self.meter_filter = MeterFilter(
+            max_speed=self.settings.get('filter_max_speed', 200.0),
+            policy=self.settings.get('filter_policy', 'hold'),
+            reset_window=self.settings.get('filter_reset_window', 5.0),
+        )
         self.is_running = True
         self.lock = Lock()
 
+    def _create_client(self):
+        """RS-485 thật, hoặc transport giả lập (TRANSPORT = sim | replay, xem modbus_sim.py)."""
+        transport = self.settings.get('transport')
+        if transport in SIM_TRANSPORTS:
+            self.port = transport
+            return create_sim_client(self.settings, self.engine.devices, RESET_REGISTER)
+        client = ModbusSerialClient(
+            port=self.port, baudrate=self.settings.get('baudrate', 9600), stopbits=2, 
+            bytesize=8, parity='N', timeout=1
+        )
+        if self.settings.get('record_file'):
+            # Ghi trace thanh ghi để phát lại bằng TRANSPORT = replay
+            return RecordingClient(client, self.settings['record_file'])
+        return client
+
     def connect(self):
         #print(f"[MODBUS CONNECT] Đang cố gắng kết nối đến cổng {COM_PORT}...")
         if not self.client.connect():
-            self.last_known_state['error'] = f"Lỗi kết nối {COM_PORT}"
+            self.last_known_state['error'] = f"Lỗi kết nối {self.port}"
             return False
         #print("[MODBUS CONNECT] Kết nối Modbus thành công.")
         self.last_known_state['error'] = None
@@ -48,75 +97,97 @@ class ModbusPoller:
     def get_last_state(self):
         return self.last_known_state
 
+    def get_stats(self):
+        """Thống kê Poller (độ trễ đọc, timeout, chu kỳ hiện tại, số frame phát)."""
+        return {
+            "scheduler": self.scheduler.get_stats(),
+            "publisher": self.publisher.get_stats(),
+            "history": self.history.get_stats(),
+            "filter": self.meter_filter.get_stats(),
+            "devices": self.engine.get_plan_summary(),
+            "sim": self.client.get_stats() if hasattr(self.client, 'get_stats') else None,
+        }
+
     def polling_loop(self):
         #print("[MODBUS POLLING] Bắt đầu polling_loop...")
         if not self.client.connected:
             if not self.connect():
-                self.socketio.server.emit('modbus_data', self.last_known_state)
+                self.publisher.publish(self.last_known_state)
 
         while self.is_running:
             data_packet = {}
+            t_read = time.perf_counter()
             try:
                 if not self.client.connected:
                     if not self.connect():
-                        time.sleep(2)
+                        time.sleep(self.scheduler.reconnect_delay())
                         continue
+                    self.scheduler.on_connected()
 
-                with self.lock:
-                    # Đọc 2 thanh ghi từ 1003
-                    response = self.client.read_input_registers(
-                        address=METER_REGISTER,
-                        count=2, 
-                        device_id=MODBUS_SLAVE_ID
-                    )
-
-                if response.isError():
-                    data_packet['error'] = "Lỗi đọc Modbus"
-                else:
-                    regs = response.registers
-                    
-                    # SỬA: Đảo Word (Little Endian Word Swap)
-                    # regs[0] là thanh ghi 1003 (Low Word)
-                    # regs[1] là thanh ghi 1004 (High Word)
-                    # Công thức: (High * 65536) + Low
-                    raw_32bit = (regs[1] << 16) | regs[0]
-                    
-                    # Xử lý số âm 32-bit
-                    if raw_32bit > 2147483647: 
-                        signed_val = raw_32bit - 4294967296
-                    else:
-                        signed_val = raw_32bit
-
-                    # GIỮ NGUYÊN: Chia 100 theo yêu cầu
-                    value_in_meters = signed_val / 10.0
-                    
-                    data_packet = {'meters': value_in_meters, 'error': None}
+                data_packet = self.meter_filter.filter_packet(self._poll_devices())
 
             except ModbusException as me:
+                # Lỗi cấp bus / cổng (không phải lỗi của 1 Slave) -> đóng cổng, kết nối lại
                 data_packet = {'error': f"Lỗi Modbus"}
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=False, timeout=isinstance(me, ModbusIOException))
                 self.client.close()
             except Exception as e:
                 data_packet = {'error': f"Lỗi không xác định"}
                 self.client.close()
 
             if data_packet:
-                self.socketio.server.emit('modbus_data', data_packet)
+                self.scheduler.note_value(data_packet.get('meters'))
+                self.history.record(time.time(), data_packet.get('meters'))
+                self.publisher.publish(data_packet)
                 self.last_known_state = data_packet
 
-            time.sleep(POLL_INTERVAL)
+            time.sleep(self.scheduler.next_sleep())
+
+    def _poll_devices(self):
+        """
+        Đọc các thiết bị đến lượt trong nhịp này (round-robin trên cùng bus).
+        Lỗi của 1 Slave (kể cả timeout, engine đổi thành ModbusReadError) không làm đóng cổng;
+        chỉ gói tin của đồng hồ mét mới mang trạng thái lỗi. Lỗi cổng / kết nối mới được ném ra polling_loop.
+        Trả về gói dữ liệu để phát (rỗng nếu nhịp này không đọc đồng hồ mét).
+        """
+        meter_device = self.engine.meter_device
+        meter_polled = False
+        meter_error = None
+
+        for device in self.engine.due_devices():
+            t_read = time.perf_counter()
+            try:
+                self.engine.poll_device(self.client, device, self.lock)
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=True)
+            except ModbusReadError as re_err:
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=False, timeout=re_err.timeout)
+                if device is meter_device:
+                    meter_error = "Lỗi đọc Modbus"
+            except ModbusException as me:
+                self.scheduler.record_read(time.perf_counter() - t_read, ok=False, timeout=isinstance(me, ModbusIOException))
+                raise
+            if device is meter_device:
+                meter_polled = True
+
+        if not meter_polled:
+            return {}
+        return self.engine.build_packet(meter_error)
 
     def write_reset_meter(self):
         #print("\n[MODBUS WRITE] Nhận được yêu cầu RESET số mét.")
         if not self.client.connected:
             return False
         try:
+            self.meter_filter.expect_reset()
+            # Chỉ giữ lock trong từng lệnh ghi: luồng đọc vẫn chạy trong lúc giữ xung Reset
             with self.lock:
                 # 1. Bật Coil 0
-                self.client.write_coil(address=RESET_REGISTER, value=True, device_id=MODBUS_SLAVE_ID)
-                # 2. Giữ
-                time.sleep(0.5)
+                self.client.write_coil(address=RESET_REGISTER, value=True, device_id=self.meter_slave_id)
+            # 2. Giữ
+            time.sleep(RESET_PULSE_SECONDS)
+            with self.lock:
                 # 3. Tắt Coil 0
-                self.client.write_coil(address=RESET_REGISTER, value=False, device_id=MODBUS_SLAVE_ID)
+                self.client.write_coil(address=RESET_REGISTER, value=False, device_id=self.meter_slave_id)
 
             #print("[MODBUS WRITE] >> Reset thành công.")
             self.read_and_emit_once()
@@ -129,21 +200,28 @@ class ModbusPoller:
     def read_and_emit_once(self):
         try:
             if not self.client.connected: return
-            with self.lock:
-                response = self.client.read_input_registers(address=METER_REGISTER, count=2, device_id=MODBUS_SLAVE_ID)
-            if not response.isError():
-                regs = response.registers
-                # Áp dụng logic Low Word First + Chia 100
-                raw = (regs[1] << 16) | regs[0]
-                signed = raw - 4294967296 if raw > 2147483647 else raw
-                val = signed / 10.0
-                
-                self.socketio.server.emit('modbus_data', {'meters': val, 'error': None})
+            meter_device = self.engine.meter_device
+            if not meter_device: return
+            result = self.engine.poll_device(self.client, meter_device, self.lock)
+            val, _ = self.meter_filter.filter(result.get(METER_POINT))
+
+            # Luôn phát ngay sau Reset để HMI cập nhật về 0
+            self.publisher.publish({'meters': val, 'error': None}, force=True)
         except Exception:
             pass
 
-def start_poller_thread(socketio):
-    poller_instance = ModbusPoller(socketio)
+def start_poller_thread(socketio, station_id=None, settings=None, relay=None):
+    """
+    Khởi động Poller theo [Modbus] BACKEND: 'thread' (mặc định, ModbusSerialClient đồng bộ)
+    hoặc 'asyncio' (modbus_async.AsyncModbusPoller, hỗ trợ RS-485 và Modbus TCP qua Gateway).
+    relay: SocketIO chỉ-ghi (message queue) để chuyển tiếp dữ liệu lên Server.
+    """
+    settings = settings or {}
+    if settings.get('backend') == 'asyncio':
+        from modbus_async import start_async_poller
+        return start_async_poller(socketio, station_id, settings, relay)
+
+    poller_instance = ModbusPoller(socketio, station_id, settings, relay)
     thread = Thread(target=poller_instance.polling_loop)
     thread.daemon = True
     thread.start()
@@ -0,0 +1,358 @@
+# --- File: modbus_sim.py ---
+"""
+Transport Modbus giả lập (không cần đồng hồ mét thật trên /dev/ttyUSB0).
+- TRANSPORT = sim: đồng hồ mét ảo chạy với tốc độ cấu hình (m/phút), có thể dừng/chạy theo chu kỳ,
+  tiêm lỗi: timeout, lỗi CRC, giá trị bị đảo word (Low/High).
+- TRANSPORT = replay: phát lại trace thanh ghi đã ghi (JSONL), có thể lặp vòng và tua nhanh.
+- RecordingClient: bọc client thật để ghi trace (dùng cho replay sau này).
+Client giả lập có cùng giao diện với ModbusSerialClient / AsyncModbusSerialClient mà Poller dùng,
+nên ModbusPoller, get_current_meter() và luồng chia cây / giao ca chạy nguyên vẹn.
+
+Định dạng trace (mỗi dòng 1 JSON):
+    {"t": 0.52, "slave_id": 1, "kind": "input", "address": 1003, "values": [1234, 0]}
+t = giây tính từ đầu trace; values = danh sách word (hoặc bit với coil / discrete).
+"""
+import json
+import time
+import random
+import asyncio
+import threading
+
+from pymodbus.exceptions import ModbusIOException
+
+from modbus_engine import METER_POINT, KIND_COIL, KIND_DISCRETE, KIND_INPUT, KIND_HOLDING
+
+TRANSPORT_SIM = 'sim'
+TRANSPORT_REPLAY = 'replay'
+SIM_TRANSPORTS = (TRANSPORT_SIM, TRANSPORT_REPLAY)
+
+DEFAULT_SIM_SPEED = 30.0       # m/phút
+DEFAULT_SIM_LATENCY = 0.02     # giây / 1 lượt hỏi-đáp (≈ RS-485 9600 baud)
+DEFAULT_SIM_TIMEOUT = 1.0      # Thời gian chờ khi tiêm lỗi timeout (= timeout của client thật)
+
+class SimResponse:
+    """Phản hồi đọc thành công (giống pymodbus: registers / bits / isError())."""
+    def __init__(self, registers=None, bits=None):
+        self.registers = registers or []
+        self.bits = bits or []
+
+    def isError(self):
+        return False
+
+def encode_point(point, value):
+    """Ngược với RegisterPoint.decode: giá trị kỹ thuật -> danh sách word / bit."""
+    if point.type == 'bool':
+        return [bool(value)]
+    raw = value
+    if point.scale != 1:
+        raw = raw / point.scale
+    if point.divisor != 1:
+        raw = raw * point.divisor
+    raw = int(round(raw))
+    if point.width == 1:
+        return [raw & 0xFFFF]
+    raw &= 0xFFFFFFFF
+    low, high = raw & 0xFFFF, (raw >> 16) & 0xFFFF
+    return [low, high] if point.word_order == 'low_first' else [high, low]
+
+class RegisterStore:
+    """Bộ nhớ thanh ghi theo (slave_id, kind, address)."""
+    def __init__(self):
+        self._data = {}
+
+    def write(self, slave_id, kind, address, values):
+        for i, v in enumerate(values):
+            self._data[(slave_id, kind, address + i)] = v
+
+    def read(self, slave_id, kind, address, count):
+        default = False if kind in (KIND_COIL, KIND_DISCRETE) else 0
+        return [self._data.get((slave_id, kind, address + i), default) for i in range(count)]
+
+    def has_slave(self, slave_id):
+        return any(key[0] == slave_id for key in self._data)
+
+class FaultInjector:
+    """Xác suất (0-1) cho từng loại lỗi trên mỗi lượt đọc."""
+    def __init__(self, timeout=0.0, crc=0.0, word_swap=0.0, seed=None):
+        self.timeout = timeout
+        self.crc = crc
+        self.word_swap = word_swap
+        self._rng = random.Random(seed)
+        self.counts = {"timeout": 0, "crc": 0, "word_swap": 0}
+
+    def pick(self):
+        r = self._rng.random()
+        if r < self.timeout:
+            self.counts["timeout"] += 1
+            return "timeout"
+        r -= self.timeout
+        if r < self.crc:
+            self.counts["crc"] += 1
+            return "crc"
+        r -= self.crc
+        if r < self.word_swap:
+            self.counts["word_swap"] += 1
+            return "word_swap"
+        return None
+
+class _BaseSimClient:
+    """Phần chung: kết nối giả, độ trễ bus, tiêm lỗi, thống kê."""
+    def __init__(self, latency=DEFAULT_SIM_LATENCY, faults=None, timeout=DEFAULT_SIM_TIMEOUT):
+        self.latency = latency
+        self.faults = faults or FaultInjector()
+        self.timeout = timeout
+        self.connected = False
+        self.store = RegisterStore()
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def connect(self):
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def _refresh(self):
+        """Cập nhật thanh ghi trước mỗi lượt đọc (lớp con ghi đè)."""
+
+    def _transact(self, kind, address, count, slave_id):
+        """Trả về (delay, response). Không ngủ ở đây để dùng chung cho đồng bộ / asyncio."""
+        with self._lock:
+            self.requests += 1
+            if not self.connected:
+                return 0.0, ModbusIOException("Simulator chưa kết nối")
+            self._refresh()
+            if not self.store.has_slave(slave_id):
+                return self.timeout, ModbusIOException(f"Slave {slave_id} không phản hồi")
+            fault = self.faults.pick()
+            if fault == "timeout":
+                return self.timeout, ModbusIOException("Timeout (giả lập)")
+            if fault == "crc":
+                # pymodbus bỏ frame sai CRC và báo lỗi IO như mất phản hồi
+                return self.latency, ModbusIOException("CRC sai (giả lập)")
+            values = self.store.read(slave_id, kind, address, count)
+            if fault == "word_swap" and kind not in (KIND_COIL, KIND_DISCRETE):
+                for i in range(0, len(values) - 1, 2):
+                    values[i], values[i + 1] = values[i + 1], values[i]
+        if kind in (KIND_COIL, KIND_DISCRETE):
+            return self.latency, SimResponse(bits=values)
+        return self.latency, SimResponse(registers=values)
+
+    def _write_coil(self, address, value, slave_id):
+        with self._lock:
+            if not self.connected:
+                return 0.0, ModbusIOException("Simulator chưa kết nối")
+            self.store.write(slave_id, KIND_COIL, address, [bool(value)])
+            self._on_coil(slave_id, address, bool(value))
+        return self.latency, SimResponse(bits=[bool(value)])
+
+    def _on_coil(self, slave_id, address, value):
+        pass
+
+    # --- Giao diện đồng bộ (giống ModbusSerialClient) ---
+    def _sync(self, result):
+        delay, response = result
+        if delay:
+            time.sleep(delay)
+        return response
+
+    def read_input_registers(self, address, count=1, device_id=1):
+        return self._sync(self._transact(KIND_INPUT, address, count, device_id))
+
+    def read_holding_registers(self, address, count=1, device_id=1):
+        return self._sync(self._transact(KIND_HOLDING, address, count, device_id))
+
+    def read_coils(self, address, count=1, device_id=1):
+        return self._sync(self._transact(KIND_COIL, address, count, device_id))
+
+    def read_discrete_inputs(self, address, count=1, device_id=1):
+        return self._sync(self._transact(KIND_DISCRETE, address, count, device_id))
+
+    def write_coil(self, address, value, device_id=1):
+        return self._sync(self._write_coil(address, value, device_id))
+
+    def get_stats(self):
+        return {"requests": self.requests, "faults": dict(self.faults.counts)}
+
+class SimulatedMeterClient(_BaseSimClient):
+    """
+    Đồng hồ mét ảo theo bản đồ thanh ghi: số mét tăng theo `speed` (m/phút).
+    run_seconds / stop_seconds > 0: máy chạy - dừng xen kẽ (để thử chế độ idle của PollScheduler).
+    Coil `reset_coil` trên thiết bị đồng hồ mét đang bật -> số mét giữ ở 0 (như Reset thật).
+    """
+    def __init__(self, devices, speed=DEFAULT_SIM_SPEED, run_seconds=0.0, stop_seconds=0.0,
+                 reset_coil=0, start_meters=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.devices = devices
+        self.speed = speed
+        self.run_seconds = run_seconds
+        self.stop_seconds = stop_seconds
+        self.reset_coil = reset_coil
+        self.meters = start_meters
+        self._reset_held = False
+        self._last_tick = time.monotonic()
+        self._started = self._last_tick
+        self.meter_device = next((d for d in devices if any(p.name == METER_POINT for p in d.points)), None)
+        self._refresh()
+
+    def is_running(self, now):
+        if self.run_seconds <= 0 or self.stop_seconds <= 0:
+            return self.speed > 0
+        phase = (now - self._started) % (self.run_seconds + self.stop_seconds)
+        return phase < self.run_seconds
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._reset_held:
+            self.meters = 0.0
+        elif self.is_running(now):
+            self.meters += self.speed / 60.0 * (now - self._last_tick)
+        self._last_tick = now
+        for device in self.devices:
+            for point in device.points:
+                if point.name == METER_POINT:
+                    value = self.meters
+                elif point.type == 'bool':
+                    value = self.is_running(now)
+                else:
+                    value = self.speed if self.is_running(now) else 0
+                self.store.write(device.slave_id, point.kind, point.address, encode_point(point, value))
+
+    def _on_coil(self, slave_id, address, value):
+        if self.meter_device and slave_id == self.meter_device.slave_id and address == self.reset_coil:
+            self._refresh()
+            self._reset_held = value
+            if value:
+                self.meters = 0.0
+
+class ReplayClient(_BaseSimClient):
+    """Phát lại trace thanh ghi. speed = hệ số tua (2.0 = nhanh gấp đôi); loop = lặp lại từ đầu khi hết."""
+    def __init__(self, trace_path, speed=1.0, loop=True, **kwargs):
+        super().__init__(**kwargs)
+        self.trace = load_trace(trace_path)
+        if not self.trace:
+            raise ValueError(f"Trace rỗng: {trace_path}")
+        self.speed = speed
+        self.loop = loop
+        self.duration = self.trace[-1]["t"]
+        self._pos = 0
+        self._cycle_start = time.monotonic()
+        self._refresh()
+
+    def _refresh(self):
+        elapsed = (time.monotonic() - self._cycle_start) * self.speed
+        if self.loop and self.duration > 0 and elapsed > self.duration:
+            self._cycle_start = time.monotonic()
+            self._pos = 0
+            elapsed = 0.0
+        while self._pos < len(self.trace) and self.trace[self._pos]["t"] <= elapsed:
+            entry = self.trace[self._pos]
+            self.store.write(entry["slave_id"], entry["kind"], entry["address"], entry["values"])
+            self._pos += 1
+
+def load_trace(path):
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda e: e["t"])
+    return entries
+
+class RecordingClient:
+    """Bọc client Modbus thật: chuyển tiếp mọi lệnh và ghi các lượt đọc thành công vào file trace."""
+    def __init__(self, client, trace_path):
+        self.client = client
+        self._file = open(trace_path, 'a', encoding='utf-8')
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _record(self, kind, address, device_id, response):
+        if response.isError():
+            return response
+        values = response.bits if kind in (KIND_COIL, KIND_DISCRETE) else response.registers
+        entry = {"t": round(time.monotonic() - self._start, 3), "slave_id": device_id,
+                 "kind": kind, "address": address, "values": list(values)}
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+        return response
+
+    def read_input_registers(self, address, count=1, device_id=1):
+        return self._record(KIND_INPUT, address, device_id, self.client.read_input_registers(address=address, count=count, device_id=device_id))
+
+    def read_holding_registers(self, address, count=1, device_id=1):
+        return self._record(KIND_HOLDING, address, device_id, self.client.read_holding_registers(address=address, count=count, device_id=device_id))
+
+    def read_coils(self, address, count=1, device_id=1):
+        return self._record(KIND_COIL, address, device_id, self.client.read_coils(address=address, count=count, device_id=device_id))
+
+    def read_discrete_inputs(self, address, count=1, device_id=1):
+        return self._record(KIND_DISCRETE, address, device_id, self.client.read_discrete_inputs(address=address, count=count, device_id=device_id))
+
+    def close(self):
+        self.client.close()
+        with self._lock:
+            self._file.close()
+
+class AsyncSimClient:
+    """Bản asyncio (giống AsyncModbusSerialClient): độ trễ / timeout giả lập bằng asyncio.sleep."""
+    def __init__(self, sim):
+        self.sim = sim
+
+    @property
+    def connected(self):
+        return self.sim.connected
+
+    async def connect(self):
+        return self.sim.connect()
+
+    def close(self):
+        self.sim.close()
+
+    async def _async(self, result):
+        delay, response = result
+        if delay:
+            await asyncio.sleep(delay)
+        return response
+
+    async def read_input_registers(self, address, count=1, device_id=1):
+        return await self._async(self.sim._transact(KIND_INPUT, address, count, device_id))
+
+    async def read_holding_registers(self, address, count=1, device_id=1):
+        return await self._async(self.sim._transact(KIND_HOLDING, address, count, device_id))
+
+    async def read_coils(self, address, count=1, device_id=1):
+        return await self._async(self.sim._transact(KIND_COIL, address, count, device_id))
+
+    async def read_discrete_inputs(self, address, count=1, device_id=1):
+        return await self._async(self.sim._transact(KIND_DISCRETE, address, count, device_id))
+
+    async def write_coil(self, address, value, device_id=1):
+        return await self._async(self.sim._write_coil(address, value, device_id))
+
+    def get_stats(self):
+        return self.sim.get_stats()
+
+def create_sim_client(settings, devices, reset_coil=0):
+    """Tạo client giả lập (đồng bộ) theo settings [Modbus] (TRANSPORT = sim | replay)."""
+    faults = FaultInjector(
+        timeout=settings.get('sim_fault_timeout', 0.0),
+        crc=settings.get('sim_fault_crc', 0.0),
+        word_swap=settings.get('sim_fault_swap', 0.0),
+        seed=settings.get('sim_seed'),
+    )
+    common = {"latency": settings.get('sim_latency', DEFAULT_SIM_LATENCY), "faults": faults}
+    if settings.get('transport') == TRANSPORT_REPLAY:
+        return ReplayClient(settings['replay_file'], speed=settings.get('replay_speed', 1.0),
+                            loop=settings.get('replay_loop', True), **common)
+    return SimulatedMeterClient(
+        devices, speed=settings.get('sim_speed', DEFAULT_SIM_SPEED),
+        run_seconds=settings.get('sim_run_seconds', 0.0), stop_seconds=settings.get('sim_stop_seconds', 0.0),
+        reset_coil=reset_coil, **common
+    )
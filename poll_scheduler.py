@@ -0,0 +1,142 @@
+# --- File: poll_scheduler.py ---
+"""
+Bộ lập lịch đọc Modbus cho ModbusPoller.
+- Giữ nhịp cố định: thời gian ngủ = chu kỳ - thời gian đọc (bù độ trễ đọc).
+- Chu kỳ thích ứng: đọc nhanh khi đồng hồ mét đang chạy, chậm lại khi máy đứng yên.
+- Kết nối lại theo exponential backoff + jitter (tránh nhiều trạm cùng dồn vào bus/cổng).
+- Thống kê độ trễ đọc / timeout / lỗi (hiển thị qua /api/system/sync_status).
+"""
+import time
+import random
+import threading
+from collections import deque
+
+DEFAULT_FAST_INTERVAL = 0.2    # Máy đang chạy
+DEFAULT_BASE_INTERVAL = 0.5    # Vừa dừng / chưa rõ
+DEFAULT_IDLE_INTERVAL = 2.0    # Đứng yên lâu
+DEFAULT_IDLE_AFTER = 30.0      # Giây không đổi giá trị -> coi là đứng yên
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 30.0
+LATENCY_WINDOW = 200           # Số lần đọc gần nhất dùng để tính thống kê
+
+class PollScheduler:
+    def __init__(self, fast_interval=DEFAULT_FAST_INTERVAL, base_interval=DEFAULT_BASE_INTERVAL,
+                 idle_interval=DEFAULT_IDLE_INTERVAL, idle_after=DEFAULT_IDLE_AFTER,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX):
+        self.fast_interval = fast_interval
+        self.base_interval = base_interval
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._next_deadline = None
+        self._last_value = None
+        self._last_change = time.monotonic()
+        self._reconnect_attempts = 0
+        self._last_backoff = 0.0
+
+        # Thống kê
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.reads = 0
+        self.read_errors = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.missed_ticks = 0
+
+    # --- CHU KỲ THÍCH ỨNG ---
+    def note_value(self, value):
+        """Ghi nhận giá trị vừa đọc để xác định máy đang chạy hay đứng yên."""
+        if value is None:
+            return
+        with self._lock:
+            if value != self._last_value:
+                self._last_value = value
+                self._last_change = time.monotonic()
+
+    def current_interval(self):
+        idle_for = time.monotonic() - self._last_change
+        if idle_for < self.base_interval * 2:
+            return self.fast_interval
+        if idle_for >= self.idle_after:
+            return self.idle_interval
+        return self.base_interval
+
+    def mode(self):
+        interval = self.current_interval()
+        if interval == self.fast_interval:
+            return "running"
+        if interval == self.idle_interval:
+            return "idle"
+        return "normal"
+
+    def next_sleep(self):
+        """
+        Thời gian cần ngủ tới lần đọc kế tiếp (đã trừ thời gian đọc).
+        Nếu bị trễ quá 1 chu kỳ (bus chậm / timeout): bỏ các nhịp đã lỡ, không đọc dồn.
+        """
+        now = time.monotonic()
+        interval = self.current_interval()
+        with self._lock:
+            if self._next_deadline is None:
+                self._next_deadline = now
+            self._next_deadline += interval
+            if self._next_deadline < now:
+                self.missed_ticks += int((now - self._next_deadline) // interval) + 1
+                self._next_deadline = now + interval
+            # Đổi sang chế độ nhanh hơn giữa chừng: không chờ hết chu kỳ chậm cũ
+            if self._next_deadline - now > interval:
+                self._next_deadline = now + interval
+            return max(0.0, self._next_deadline - now)
+
+    # --- THỐNG KÊ ĐỌC ---
+    def record_read(self, latency, ok=True, timeout=False):
+        with self._lock:
+            self.reads += 1
+            self._latencies.append(latency)
+            if not ok:
+                self.read_errors += 1
+            if timeout:
+                self.timeouts += 1
+
+    # --- KẾT NỐI LẠI ---
+    def reconnect_delay(self):
+        """Exponential backoff với jitter (0.5x - 1x) cho lần kết nối lại kế tiếp."""
+        with self._lock:
+            delay = min(self.backoff_max, self.backoff_base * (2 ** self._reconnect_attempts))
+            delay *= random.uniform(0.5, 1.0)
+            self._reconnect_attempts += 1
+            self._last_backoff = delay
+            self._next_deadline = None
+            return delay
+
+    def on_connected(self):
+        with self._lock:
+            if self._reconnect_attempts:
+                self.reconnects += 1
+            self._reconnect_attempts = 0
+
+    def get_stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            count = len(latencies)
+            stats = {
+                "mode": None,
+                "interval": None,
+                "reads": self.reads,
+                "read_errors": self.read_errors,
+                "timeouts": self.timeouts,
+                "missed_ticks": self.missed_ticks,
+                "reconnects": self.reconnects,
+                "reconnect_attempts": self._reconnect_attempts,
+                "last_backoff": round(self._last_backoff, 2),
+                "latency_ms": {
+                    "avg": round(sum(latencies) / count * 1000, 1) if count else None,
+                    "p95": round(latencies[min(count - 1, int(count * 0.95))] * 1000, 1) if count else None,
+                    "max": round(latencies[-1] * 1000, 1) if count else None,
+                },
+            }
+        stats["mode"] = self.mode()
+        stats["interval"] = self.current_interval()
+        return stats
@@ -16,6 +16,7 @@ from services.user_service import user_service
 from services.standard_service import standard_service
 from services.label import print_ticket_label
 from services.redis_manager import redis_manager # Redis Manager
+from services.roll_sequence import roll_sequence
 from . import api_ins_bp
 
 # --- Helpers ---
@@ -24,6 +25,11 @@ def get_current_meter():
         return current_app.poller_instance.get_last_state().get('meters', 0)
     return 0
 
+def get_meter_history(resolution, since, limit):
+    if hasattr(current_app, 'poller_instance') and current_app.poller_instance:
+        return current_app.poller_instance.history.query(resolution, since=since, limit=limit)
+    return []
+
 def _extract_item_identifier(fabric_name):
     if not fabric_name: return "00"
     parts = fabric_name.split('.')
@@ -125,6 +131,22 @@ def sync_to_redis(state_data):
     except Exception as e:
         current_app.logger.error(f"REDIS SYNC ERROR: {str(e)}")
 
+def _state_response(station_id, delta):
+    """
+    [NEW] Phản hồi cho các thao tác thay đổi phiên.
+    Client gửi kèm `version` đang giữ: nếu đúng bằng version ngay trước thao tác -> chỉ trả delta,
+    ngược lại (client cũ / lệch version / thao tác không tạo delta) -> trả toàn bộ state.
+    """
+    body = request.get_json(silent=True) or {}
+    client_version = body.get('version')
+    if delta and client_version is not None:
+        try:
+            if int(client_version) == delta['base_version']:
+                return jsonify(delta)
+        except (TypeError, ValueError):
+            pass
+    return jsonify(state_manager.get_state(station_id))
+
 # --- Printing Logic ---
 def perform_printing(ticket_id):
     try:
@@ -144,8 +166,7 @@ def perform_printing(ticket_id):
         inspector_name = "N/A"
         if inspector_id:
             try:
-                user_info = user_service.get_user_by_id(inspector_id)
-                if user_info: inspector_name = user_info[1]
+                inspector_name = user_service.get_personnel_name(inspector_id) or "N/A"
             except: pass
         
         logs = local_db_manager.get_worker_log_by_ticket_id(ticket_id)
@@ -179,6 +200,24 @@ def perform_printing(ticket_id):
 
 # --- API ROUTES ---
 
+@api_ins_bp.route('/api/meter/history')
+@login_required
+def meter_history():
+    """
+    [NEW] Lịch sử số mét của trạm.
+    Tham số: resolution = raw | 1s | 1m | 1h (mặc định 1s), minutes (khoảng thời gian gần nhất), limit.
+    Mỗi bucket có first/last/min/max và `produced` (số mét sản xuất trong bucket, bỏ qua Reset).
+    """
+    resolution = request.args.get('resolution', '1s')
+    try:
+        minutes = float(request.args.get('minutes', 0) or 0)
+        limit = int(request.args.get('limit', 0) or 0) or None
+        since = time.time() - minutes * 60 if minutes > 0 else 0.0
+        samples = get_meter_history(resolution, since, limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"resolution": resolution, "count": len(samples), "samples": samples})
+
 @api_ins_bp.route('/api/standard/details/<int:standard_id>')
 @login_required
 def get_standard_details(standard_id):
@@ -201,11 +240,9 @@ def set_default_standard():
 def update_session_settings():
     station_id = current_app.config['STATION_ID']
     data = request.json
-    current_state = state_manager.get_state(station_id)
+    current_state = state_manager.update_settings(
+        station_id, data.get('standard_id'), data.get('unit', 'm'), data.get('min_length', 0))
     if current_state:
-        current_state['standard_id'] = data.get('standard_id')
-        current_state['unit'] = data.get('unit', 'm')
-        current_state['min_length'] = data.get('min_length', 0)
         return jsonify({"status": "success", "state": current_state})
     return jsonify({"error": "No active session"}), 400
 
@@ -244,10 +281,7 @@ def mark_error_as_fixed_route():
     try:
         error_id = str(request.json.get('error_id'))
         station_id = current_app.config['STATION_ID']
-        current_state = state_manager.get_state(station_id)
-        if current_state and current_state.get('current_worker_details'):
-            for err in current_state['current_worker_details'].get('current_errors', []):
-                if str(err.get('id')) == error_id: err['is_fixed'] = True
+        state_manager.mark_error_fixed(station_id, error_id)
         if not error_id.startswith('err_'): inspection_service.mark_error_as_fixed(error_id)
         return jsonify({"status": "success", "message": "Đã sửa lỗi.", "id": error_id})
     except Exception as e: return jsonify({"error": str(e)}), 500
@@ -256,10 +290,8 @@ def mark_error_as_fixed_route():
 @login_required
 def action_downgrade():
     station_id = current_app.config['STATION_ID']
-    s = state_manager.get_state(station_id)
-    if not s or not s['active']: return jsonify({"error": "No active session"}), 400
-    s['status'] = 'DOWNGRADED'
-    s['notes'] = (s.get('notes', '') + " " + request.json.get('notes', '') + " [ĐÃ HẠ LOẠI]").strip()
+    s = state_manager.downgrade(station_id, request.json.get('notes', ''))
+    if not s: return jsonify({"error": "No active session"}), 400
     return jsonify({"status": "success", "state": s})
 
 @api_ins_bp.route('/api/action/repair', methods=['POST'])
@@ -341,21 +373,22 @@ def start_worker_shift():
         worker = user_service.get_worker_info_by_barcode(data.get('worker_id'))
         if not worker: return jsonify({"error": "Không tìm thấy CN"}), 404
         worker_obj = {"id": worker[0], "name": worker[1]}
-        state_manager.assign_new_worker(st_id, worker_obj, data.get('shift'), get_current_meter())
+        delta = state_manager.assign_new_worker(st_id, worker_obj, data.get('shift'), get_current_meter())
         
         curr = state_manager.get_state(st_id)
         if curr and curr.get('ticket_id'):
             inspection_service.update_pending_worker_from_previous_roll(curr['ticket_id'], worker_obj)
             
-        return jsonify(state_manager.get_state(st_id))
+        return _state_response(st_id, delta)
     except Exception as e: return jsonify({"error": str(e)}), 500
 
 @api_ins_bp.route('/api/worker/end_shift', methods=['POST'])
 @login_required
 def end_worker_shift():
     try:
-        state_manager.complete_current_worker_shift(current_app.config['STATION_ID'], float(request.json.get('meters_g1', 0)), float(request.json.get('meters_g2', 0)), get_current_meter())
-        return jsonify(state_manager.get_state(current_app.config['STATION_ID']))
+        st_id = current_app.config['STATION_ID']
+        delta = state_manager.complete_current_worker_shift(st_id, float(request.json.get('meters_g1', 0)), float(request.json.get('meters_g2', 0)), get_current_meter())
+        return _state_response(st_id, delta)
     except Exception as e: return jsonify({"error": str(e)}), 400
 
 @api_ins_bp.route('/api/log_error', methods=['POST'])
@@ -376,19 +409,29 @@ def log_error():
         "error_type": data.get('error_type'), 
         "points": int(data.get('points', 1)), 
         "meter_location": get_current_meter(), 
+        "logged_at": time.time(),
         "worker_id": wid, 
         "shift": shift,
         "is_fixed": False
     }
     if s.get('is_repair_mode'): err['is_new'] = True
-    state_manager.log_error_for_current_worker(st_id, err)
-    return jsonify(state_manager.get_state(st_id))
+    delta = state_manager.log_error_for_current_worker(st_id, err)
+    return _state_response(st_id, delta)
 
 @api_ins_bp.route('/api/delete_error', methods=['POST'])
 @login_required
 def delete_error():
-    state_manager.delete_error_for_current_worker(current_app.config['STATION_ID'], request.json.get('error_id'))
-    return jsonify(state_manager.get_state(current_app.config['STATION_ID']))
+    st_id = current_app.config['STATION_ID']
+    delta = state_manager.delete_error_for_current_worker(st_id, request.json.get('error_id'))
+    return _state_response(st_id, delta)
+
+@api_ins_bp.route('/api/session/state')
+@login_required
+def get_session_state():
+    """[NEW] Toàn bộ state của phiên (Frontend gọi để đồng bộ lại khi version bị lệch)."""
+    s = state_manager.get_state(current_app.config['STATION_ID'])
+    if not s: return jsonify({"error": "Phiên làm việc không tồn tại."}), 400
+    return jsonify(s)
 
 @api_ins_bp.route('/api/save_inspection', methods=['POST'])
 @login_required
@@ -486,27 +529,7 @@ def api_split_roll():
         now = datetime.now()
         prefix = f"{now.strftime('%y%m')}{_extract_item_identifier(fabric_name)}"
 
-        sequence = None
-        try:
-            # [PRIORITY 1] Redis Atomic
-            sequence = redis_manager.get_next_roll_sequence(prefix)
-        except Exception as e:
-            current_app.logger.error(f"REDIS SPLIT ERROR: {e}")
-            # [PRIORITY 2] Server DB Fallback
-            try:
-                sequence = inspection_service.get_next_sequence_from_server(prefix)
-            except: pass
-        
-        # [PRIORITY 3] Local Fallback
-        if sequence is None:
-             sequence = local_db_manager.get_next_sequence_by_prefix(prefix) or 1
-
-        # Safe Format
-        try:
-            seq_int = int(sequence)
-            final_roll_code = f"{prefix}{seq_int:04d}"
-        except:
-             final_roll_code = f"{prefix}{str(sequence).zfill(4)}"
+        final_roll_code = roll_sequence.next_roll_code(prefix)
         
         # [CRITICAL] Sync Redis sau khi đã có roll_code của cây tiếp theo
         sync_to_redis(current_state)
@@ -565,30 +588,12 @@ def update_inspection_fabric():
     try:
         if not s.get('is_manual'): 
             machine_service.update_fabric_id_for_deployment(s['deployment_ticket_id'], new_fab)
-        state_manager.update_fabric_name(st_id, new_fab)
-        
         now = datetime.now()
         prefix = f"{now.strftime('%y%m')}{_extract_item_identifier(new_fab)}"
         
-        sequence = None
-        try:
-            # [PRIORITY 1] Redis Atomic
-            sequence = redis_manager.get_next_roll_sequence(prefix)
-        except Exception as e:
-            current_app.logger.error(f"REDIS UPDATE FABRIC ERROR: {e}")
-            # [PRIORITY 2] Fallback DB
-            try:
-                sequence = inspection_service.get_next_sequence_from_server(prefix)
-            except: pass
-        
-        if sequence is None:
-             sequence = local_db_manager.get_next_sequence_by_prefix(prefix) or 1
-
-        try:
-            seq_int = int(sequence)
-            s['roll_code'] = f"{prefix}{seq_int:04d}"
-        except:
-             s['roll_code'] = f"{prefix}{str(sequence).zfill(4)}"
+        # Cấp mã trước (không lặp lại khi thao tác phải chạy lại do xung đột version)
+        new_roll_code = roll_sequence.next_roll_code(prefix)
+        state_manager.update_fabric_name(st_id, new_fab, new_roll_code)
 
         return jsonify(state_manager.get_state(st_id))
     except Exception as e: return jsonify({"error": str(e)}), 500
@@ -665,8 +670,7 @@ def finish_repair_session():
     
     try:
         init_err = s.get('initial_error_count', 0)
-        curr_err = s.get('current_worker_details', {}).get('current_errors', [])
-        rem_err = sum(1 for e in curr_err if not e.get('is_fixed'))
+        rem_err = state_manager.get_defect_summary(st_id)['open_count']
         
         r_info = inspection_service.get_roll_details_by_roll_number(s['ticket_id'])
         if not r_info: return jsonify({"error": "Roll not found DB"}), 400
@@ -13,7 +13,7 @@ from services.pallet_service import pallet_service
 from services.report_service import report_service
 from services.user_service import user_service
 from services.inspection_service import inspection_service
-from services.redis_manager import redis_manager # [NEW] Import để xử lý Atomic Sequence
+from services.roll_sequence import roll_sequence # [NEW] Khối số thứ tự mã cây thuê từ Redis
 from . import view_bp
 
 # --- Helper ---
@@ -105,33 +105,8 @@ def inspection_page():
     item_identifier = _extract_item_identifier(fabric_name)
     prefix = f"{yy}{mm}{item_identifier}"
 
-    sequence = None
-    try:
-        # [PRIORITY 1] Atomic Increment via Redis
-        # Redis đảm bảo tính duy nhất, trả về ngay số tiếp theo (có thể là string '0001')
-        sequence = redis_manager.get_next_roll_sequence(prefix)
-    except Exception as e:
-        current_app.logger.error(f"REDIS SEQUENCE ERROR: {e}")
-        # [PRIORITY 2] Fallback to Server DB (Old Method)
-        # Nếu Redis chết, gọi API cũ để lấy số từ Database (thường trả về int)
-        try:
-            sequence = inspection_service.get_next_sequence_from_server(prefix)
-        except Exception as db_err:
-             current_app.logger.error(f"DB SEQUENCE ERROR: {db_err}")
-
-    # [PRIORITY 3] Local DB Fallback (Khi mất mạng hoàn toàn)
-    if sequence is None:
-        sequence = local_db_manager.get_next_sequence_by_prefix(prefix)
-        if not sequence: sequence = 1
-
-    # Format: Prefix + 4 số thứ tự
-    # Lưu ý: Ép kiểu int(sequence) trước khi format để tránh lỗi nếu Redis trả về string
-    try:
-        seq_int = int(sequence)
-        roll_code = f"{prefix}{seq_int:04d}"
-    except (ValueError, TypeError):
-        # Fallback an toàn nếu sequence bị lỗi định dạng lạ
-        roll_code = f"{prefix}{str(sequence).zfill(4)}"
+    # Số thứ tự: khối đã thuê từ Redis (cấp được cả khi mất mạng) -> fallback Server DB / CSDL cục bộ
+    roll_code = roll_sequence.next_roll_code(prefix)
 
     # 3. Khởi tạo Session
     state_manager.start_session_v2(
@@ -174,29 +149,7 @@ def start_manual_inspection():
     item_identifier = _extract_item_identifier(fabric_name)
     prefix = f"{yy}{mm}{item_identifier}"
     
-    sequence = None
-    try:
-        # [PRIORITY 1] Atomic Increment via Redis
-        sequence = redis_manager.get_next_roll_sequence(prefix)
-    except Exception as e:
-        current_app.logger.error(f"REDIS SEQUENCE ERROR (MANUAL): {e}")
-        # [PRIORITY 2] Fallback to Server DB
-        try:
-            sequence = inspection_service.get_next_sequence_from_server(prefix)
-        except Exception:
-            pass
-
-    # [PRIORITY 3] Fallback to Local DB
-    if sequence is None:
-        sequence = local_db_manager.get_next_sequence_by_prefix(prefix)
-        if not sequence: sequence = 1
-            
-    # Format mã cây
-    try:
-        seq_int = int(sequence)
-        roll_code = f"{prefix}{seq_int:04d}"
-    except (ValueError, TypeError):
-        roll_code = f"{prefix}{str(sequence).zfill(4)}"
+    roll_code = roll_sequence.next_roll_code(prefix)
 
     state_manager.start_manual_session(
         station_id=station_id, ticket_id=ticket_id, inspector_id=current_user.id,
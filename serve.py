@@ -0,0 +1,56 @@
+# --- File: serve.py ---
+"""
+Chạy FLIS ở chế độ production cho Socket.IO.
+- Đọc [SocketIO] ASYNC_MODE trong config.ini (hoặc tham số dòng lệnh): threading | eventlet | gevent.
+- Với eventlet / gevent: monkey-patch thư viện chuẩn TRƯỚC khi import app (socket, threading, redis...),
+  sau đó chạy app.py như `python app.py` (cùng logic nhận diện Server / Trạm).
+Cần cài thêm: pip install -r requirements-server.txt  (eventlet / gevent + psycogreen cho psycopg2)
+
+Ví dụ:
+    python serve.py              # theo config.ini
+    python serve.py eventlet     # ghi đè chế độ
+Lưu ý: trên trạm có đồng hồ mét RS-485 nên giữ threading (pyserial là I/O chặn);
+eventlet / gevent dành cho Server, nơi nhiều màn hình giám sát cùng kết nối.
+"""
+import os
+import sys
+import runpy
+import configparser
+
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+
+def read_async_mode():
+    if len(sys.argv) > 1:
+        return sys.argv[1].strip().lower()
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'), encoding='utf-8')
+    return config.get('SocketIO', 'ASYNC_MODE', fallback='threading').strip().lower()
+
+def patch(async_mode):
+    """
+    Monkey-patch thư viện chuẩn + psycopg2.
+    psycopg2 là C extension, monkey-patch không làm nó nhường luồng: thiếu psycogreen thì mỗi truy vấn
+    Postgres (route Flask, RedisWorker nhúng) chặn cả hub và mọi client Socket.IO -> không cho chạy.
+    """
+    if async_mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+        from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    elif async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+if __name__ == '__main__':
+    mode = read_async_mode()
+    if mode not in ASYNC_MODES:
+        sys.exit(f"ASYNC_MODE không hợp lệ: {mode}. Chọn: {', '.join(ASYNC_MODES)}")
+    try:
+        patch(mode)
+    except ImportError as e:
+        sys.exit(f"Chưa cài thư viện cho chế độ '{mode}': {e}")
+    os.environ['FLIS_ASYNC_MODE'] = mode
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    runpy.run_module('app', run_name='__main__', alter_sys=True)
@@ -1,5 +1,7 @@
 # server_sync.py
 # (UPDATED: Auto-Increment on Duplicate Roll Code & UUID Support)
+# (UPDATED: Batch mode - N phiếu / 1 transaction, execute_values)
+# (UPDATED: Outbox mode - đồng bộ theo change_id từ sync_outbox)
 
 import sqlite3
 import psycopg2
@@ -8,6 +10,8 @@ import time
 import traceback
 import sys
 import re  # [NEW] Thư viện để xử lý chuỗi và số
+import json
+from local_db_manager import OUTBOX_OP_SESSION, OUTBOX_OP_POST_ACTION
 
 # --- CẤU HÌNH ---
 LOCAL_DB_PATH = "flis_local.db"
@@ -19,19 +23,36 @@ PG_DB_PARAMS = {
 }
 # Tốc độ đồng bộ (giây). 
 SYNC_INTERVAL_SECONDS = 3 
+# Chế độ đồng bộ:
+# 'outbox' (đọc thay đổi từ sync_outbox theo high-water mark), 'batch' (quét is_synced = 0, N phiếu / 1 transaction)
+# hoặc 'single' (từng phiếu như cũ)
+SYNC_MODE = "outbox"
+SYNC_MODES = ("outbox", "batch", "single")
+SYNC_BATCH_SIZE = 200
+OUTBOX_HWM_KEY = "outbox_hwm"
+# Thay đổi outbox gửi lỗi dữ liệu quá số lần này -> chuyển sang sync_outbox_dead (không thử lại mãi mãi)
+OUTBOX_MAX_ATTEMPTS = 20
+# Chế độ batch: phiếu lỗi quá số lần này bị tạm gác (không lấy vào lô nữa, vẫn is_synced = 0)
+SYNC_MAX_ATTEMPTS = 20
 
-def get_unsynced_tickets(local_conn):
+def get_unsynced_tickets(local_conn, ticket_ids=None):
     """
     Lấy các phiếu chưa đồng bộ từ SQLite (is_synced = 0).
+    ticket_ids: chỉ lấy trong danh sách này (dùng khi 1 lô batch bị lỗi và phải chạy lại từng phiếu).
     """
     cursor = local_conn.cursor()
-    cursor.execute("""
+    sql = """
         SELECT 
             ticket_id, roll_code, inspection_date, inspector_id, machine_id, fabric_name,
             order_number, deployment_ticket_id, notes, status
         FROM completed_tickets 
         WHERE is_synced = 0
-    """)
+    """
+    params = ()
+    if ticket_ids is not None:
+        sql += " AND ticket_id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps([str(t) for t in ticket_ids]),)
+    cursor.execute(sql, params)
     columns = [description[0] for description in cursor.description]
     return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
@@ -123,30 +144,144 @@ def generate_next_roll_code(pg_conn, original_code):
             return new_code  # Mã này sạch, dùng được
         
         # Nếu trùng, thực hiện +1
-        # Tìm nhóm số ở cuối chuỗi
-        match = re.search(r'(\d+)$', new_code)
-        if match:
-            number_str = match.group(1)
-            number_len = len(number_str)
-            current_val = int(number_str)
-            
-            # Tăng 1
-            next_val = current_val + 1
-            
-            # Ghép lại chuỗi mới (giữ nguyên độ dài số 0 đằng trước bằng zfill)
-            prefix = new_code[:match.start()]
-            new_code = f"{prefix}{str(next_val).zfill(number_len)}"
-            
-            print(f"    [AUTO-FIX] Mã {original_code} bị trùng -> Thử mã mới: {new_code}")
+        new_code = increment_roll_code(new_code)
+        print(f"    [AUTO-FIX] Mã {original_code} bị trùng -> Thử mã mới: {new_code}")
+
+def increment_roll_code(code):
+    """Tăng nhóm số ở cuối mã thêm 1 (giữ độ dài số 0 đằng trước). VD: 2601ABC0001 -> 2601ABC0002"""
+    match = re.search(r'(\d+)$', code)
+    if match:
+        number_str = match.group(1)
+        prefix = code[:match.start()]
+        return f"{prefix}{str(int(number_str) + 1).zfill(len(number_str))}"
+    # Trường hợp mã không kết thúc bằng số, thêm suffix _1
+    return f"{code}_1"
+
+def sync_single_ticket(local_conn, pg_conn, ticket_data, outbox_snapshot):
+    """
+    Đồng bộ 1 phiếu (mỗi phiếu 1 transaction). Dùng cho chế độ 'single' và khi 1 lô bị lỗi.
+    outbox_snapshot: change_id lớn nhất của sync_outbox TRƯỚC khi đọc phiếu (xem get_outbox_snapshot).
+    """
+    local_uuid = str(ticket_data['ticket_id'])
+    original_roll_code = ticket_data.get('roll_code', local_uuid)
+    
+    current_status = ticket_data.get('status', 'PENDING')
+    current_notes = ticket_data.get('notes', '')
+    deployment_ticket_id = ticket_data.get('deployment_ticket_id')
+
+    print(f"--> Đang Sync phiếu {local_uuid} (Gốc: {original_roll_code})...")
+    
+    if not deployment_ticket_id:
+        print(f"    [SKIP] Thiếu Lệnh Triển Khai.")
+        mark_ticket_as_synced(local_conn, local_uuid, outbox_snapshot)
+        return
+
+    deployment_info = get_deployment_info_from_pg(pg_conn, deployment_ticket_id)
+    if not deployment_info:
+        print(f"    [SKIP] Lệnh Triển Khai không tồn tại.")
+        return
+
+    worker_log, error_log = get_data_for_ticket(local_conn, local_uuid)
+
+    try:
+        pg_cursor = pg_conn.cursor()
+        
+        # --- LOGIC MỚI: XỬ LÝ TRÙNG TÊN ---
+        # Kiểm tra xem UUID này đã có trên Server chưa
+        pg_cursor.execute("SELECT roll_number FROM fabric_rolls WHERE id = %s", (local_uuid,))
+        existing_row = pg_cursor.fetchone()
+        
+        final_roll_code = original_roll_code
+        
+        if existing_row:
+            # Nếu phiếu này đã tồn tại (Sync lại), giữ nguyên mã đang có trên Server
+            # Để tránh việc đổi lại mã mà Server đã fix trước đó
+            final_roll_code = existing_row[0]
         else:
-            # Trường hợp mã không kết thúc bằng số, thêm suffix _1
-            new_code = f"{new_code}_1"
+            # Nếu là Insert mới -> Phải check trùng mã với các phiếu KHÁC
+            # Gọi hàm generate_next_roll_code để tự động +1 nếu cần
+            final_roll_code = generate_next_roll_code(pg_conn, original_roll_code)
+        
+        # Bắt đầu Transaction
+        pg_cursor.execute("BEGIN")
+
+        # 1. Master Ticket
+        master_ticket_id = get_or_create_master_ticket(pg_conn, deployment_ticket_id, ticket_data, deployment_info)
+
+        # 2. Fabric Roll (Upsert)
+        # Lưu ý: Nếu conflict ID (đã tồn tại), ta update status/notes nhưng KHÔNG update roll_number
+        pg_cursor.execute(
+            """
+            INSERT INTO fabric_rolls 
+            (id, ticket_id, roll_number, meters_grade1, meters_grade2, status, notes) 
+            VALUES (%s, %s, %s, 0, 0, %s, %s)
+            ON CONFLICT (id) DO UPDATE 
+            SET status = EXCLUDED.status,
+                notes = EXCLUDED.notes,
+                ticket_id = EXCLUDED.ticket_id,
+                roll_number = fabric_rolls.roll_number 
+            RETURNING id
+            """,
+            (local_uuid, master_ticket_id, final_roll_code, current_status, current_notes)
+        )
+        
+        roll_id = pg_cursor.fetchone()[0]
+
+        # 3. Production Logs (Workers)
+        total_g1, total_g2 = 0, 0
+        production_ids = {} 
+        for worker in worker_log:
+            total_g1 += worker.get('meters_g1', 0)
+            total_g2 += worker.get('meters_g2', 0)
+            pg_cursor.execute("""
+                INSERT INTO individual_productions (roll_id, worker_id, shift, production_date, meters_grade1, meters_grade2) 
+                VALUES (%s, %s, %s, %s, %s, %s) 
+                ON CONFLICT (roll_id, worker_id, shift) DO UPDATE 
+                SET meters_grade1 = EXCLUDED.meters_grade1, meters_grade2 = EXCLUDED.meters_grade2, production_date = EXCLUDED.production_date
+                RETURNING id
+                """, (roll_id, worker['worker_id'], worker['shift'], ticket_data['inspection_date'], worker['meters_g1'], worker['meters_g2'])
+            )
+            prod_id = pg_cursor.fetchone()[0]
+            production_ids[(worker['worker_id'], worker['shift'])] = prod_id
+        
+        # 4. Errors
+        if error_log:
+            for error in error_log:
+                prod_id_key = (error['worker_id'], error['shift'])
+                if prod_id_key in production_ids:
+                    prod_id = production_ids[prod_id_key]
+                    pg_cursor.execute("""
+                        INSERT INTO production_errors (production_id, error_type, occurrences, meter_location, points, is_fixed) 
+                        VALUES (%s, %s, 1, %s, %s, FALSE)
+                        ON CONFLICT (production_id, error_type) DO NOTHING
+                        """, (prod_id, error['error_type'], error['meter_location'], error.get('points_val', 1))
+                    )
+        
+        # 5. Update Total Meters
+        pg_cursor.execute("UPDATE fabric_rolls SET meters_grade1 = %s, meters_grade2 = %s WHERE id = %s", (total_g1, total_g2, roll_id))
+
+        pg_conn.commit()
+        mark_ticket_as_synced(local_conn, local_uuid, outbox_snapshot)
+        
+        if final_roll_code != original_roll_code:
+            print(f"    -> [OK] Đồng bộ xong. (Đã tự động đổi tên: {original_roll_code} -> {final_roll_code})")
+        else:
+            print(f"    -> [OK] Đồng bộ xong {local_uuid}.")
+
+    except Exception as e:
+        pg_conn.rollback()
+        if "unique_roll_number" in str(e):
+            print(f"    [RETRY] Đụng độ mã (Unique Constraint), sẽ thử lại lần sau...")
+        else:
+            print(f"    -> [ERROR] Lỗi Sync phiếu {local_uuid}: {e}")
+            traceback.print_exc()
 
 def sync_data():
     local_conn = sqlite3.connect(LOCAL_DB_PATH)
     pg_conn = None
     
     try:
+        outbox_snapshot = get_outbox_snapshot(local_conn)
         unsynced_tickets = get_unsynced_tickets(local_conn)
         if not unsynced_tickets:
             return
@@ -155,119 +290,7 @@ def sync_data():
         pg_conn = psycopg2.connect(**PG_DB_PARAMS)
 
         for ticket_data in unsynced_tickets:
-            local_uuid = str(ticket_data['ticket_id'])
-            original_roll_code = ticket_data.get('roll_code', local_uuid)
-            
-            current_status = ticket_data.get('status', 'PENDING')
-            current_notes = ticket_data.get('notes', '')
-            deployment_ticket_id = ticket_data.get('deployment_ticket_id')
-
-            print(f"--> Đang Sync phiếu {local_uuid} (Gốc: {original_roll_code})...")
-            
-            if not deployment_ticket_id:
-                print(f"    [SKIP] Thiếu Lệnh Triển Khai.")
-                mark_ticket_as_synced(local_conn, local_uuid) 
-                continue
-
-            deployment_info = get_deployment_info_from_pg(pg_conn, deployment_ticket_id)
-            if not deployment_info:
-                print(f"    [SKIP] Lệnh Triển Khai không tồn tại.")
-                continue
-
-            worker_log, error_log = get_data_for_ticket(local_conn, local_uuid)
-
-            try:
-                pg_cursor = pg_conn.cursor()
-                
-                # --- LOGIC MỚI: XỬ LÝ TRÙNG TÊN ---
-                # Kiểm tra xem UUID này đã có trên Server chưa
-                pg_cursor.execute("SELECT roll_number FROM fabric_rolls WHERE id = %s", (local_uuid,))
-                existing_row = pg_cursor.fetchone()
-                
-                final_roll_code = original_roll_code
-                
-                if existing_row:
-                    # Nếu phiếu này đã tồn tại (Sync lại), giữ nguyên mã đang có trên Server
-                    # Để tránh việc đổi lại mã mà Server đã fix trước đó
-                    final_roll_code = existing_row[0]
-                else:
-                    # Nếu là Insert mới -> Phải check trùng mã với các phiếu KHÁC
-                    # Gọi hàm generate_next_roll_code để tự động +1 nếu cần
-                    final_roll_code = generate_next_roll_code(pg_conn, original_roll_code)
-                
-                # Bắt đầu Transaction
-                pg_cursor.execute("BEGIN")
-
-                # 1. Master Ticket
-                master_ticket_id = get_or_create_master_ticket(pg_conn, deployment_ticket_id, ticket_data, deployment_info)
-
-                # 2. Fabric Roll (Upsert)
-                # Lưu ý: Nếu conflict ID (đã tồn tại), ta update status/notes nhưng KHÔNG update roll_number
-                pg_cursor.execute(
-                    """
-                    INSERT INTO fabric_rolls 
-                    (id, ticket_id, roll_number, meters_grade1, meters_grade2, status, notes) 
-                    VALUES (%s, %s, %s, 0, 0, %s, %s)
-                    ON CONFLICT (id) DO UPDATE 
-                    SET status = EXCLUDED.status,
-                        notes = EXCLUDED.notes,
-                        ticket_id = EXCLUDED.ticket_id,
-                        roll_number = fabric_rolls.roll_number 
-                    RETURNING id
-                    """,
-                    (local_uuid, master_ticket_id, final_roll_code, current_status, current_notes)
-                )
-                
-                roll_id = pg_cursor.fetchone()[0]
-
-                # 3. Production Logs (Workers)
-                total_g1, total_g2 = 0, 0
-                production_ids = {} 
-                for worker in worker_log:
-                    total_g1 += worker.get('meters_g1', 0)
-                    total_g2 += worker.get('meters_g2', 0)
-                    pg_cursor.execute("""
-                        INSERT INTO individual_productions (roll_id, worker_id, shift, production_date, meters_grade1, meters_grade2) 
-                        VALUES (%s, %s, %s, %s, %s, %s) 
-                        ON CONFLICT (roll_id, worker_id, shift) DO UPDATE 
-                        SET meters_grade1 = EXCLUDED.meters_grade1, meters_grade2 = EXCLUDED.meters_grade2, production_date = EXCLUDED.production_date
-                        RETURNING id
-                        """, (roll_id, worker['worker_id'], worker['shift'], ticket_data['inspection_date'], worker['meters_g1'], worker['meters_g2'])
-                    )
-                    prod_id = pg_cursor.fetchone()[0]
-                    production_ids[(worker['worker_id'], worker['shift'])] = prod_id
-                
-                # 4. Errors
-                if error_log:
-                    for error in error_log:
-                        prod_id_key = (error['worker_id'], error['shift'])
-                        if prod_id_key in production_ids:
-                            prod_id = production_ids[prod_id_key]
-                            pg_cursor.execute("""
-                                INSERT INTO production_errors (production_id, error_type, occurrences, meter_location, points, is_fixed) 
-                                VALUES (%s, %s, 1, %s, %s, FALSE)
-                                ON CONFLICT (production_id, error_type) DO NOTHING
-                                """, (prod_id, error['error_type'], error['meter_location'], error.get('points_val', 1))
-                            )
-                
-                # 5. Update Total Meters
-                pg_cursor.execute("UPDATE fabric_rolls SET meters_grade1 = %s, meters_grade2 = %s WHERE id = %s", (total_g1, total_g2, roll_id))
-
-                pg_conn.commit()
-                mark_ticket_as_synced(local_conn, local_uuid)
-                
-                if final_roll_code != original_roll_code:
-                    print(f"    -> [OK] Đồng bộ xong. (Đã tự động đổi tên: {original_roll_code} -> {final_roll_code})")
-                else:
-                    print(f"    -> [OK] Đồng bộ xong {local_uuid}.")
-
-            except Exception as e:
-                pg_conn.rollback()
-                if "unique_roll_number" in str(e):
-                    print(f"    [RETRY] Đụng độ mã (Unique Constraint), sẽ thử lại lần sau...")
-                else:
-                    print(f"    -> [ERROR] Lỗi Sync phiếu {local_uuid}: {e}")
-                    traceback.print_exc()
+            sync_single_ticket(local_conn, pg_conn, ticket_data, outbox_snapshot)
 
     except (Exception, psycopg2.Error) as e:
         print(f"Lỗi kết nối Server DB: {e}")
@@ -275,23 +298,564 @@ def sync_data():
         if local_conn: local_conn.close()
         if pg_conn: pg_conn.close()
 
-def mark_ticket_as_synced(local_conn, ticket_id):
+# ==================== CHẾ ĐỘ BATCH ====================
+# Sau khi mất mạng, trạm phải đẩy lại hàng trăm phiếu: thay vì mỗi phiếu ~10 round-trip + 1 commit,
+# lô N phiếu chỉ tốn 1 truy vấn SQLite, vài lệnh execute_values trong 1 transaction Postgres
+# và 1 lệnh UPDATE SQLite.
+
+def _select_tickets_with_logs(local_conn, where_sql, params):
+    """SELECT phiếu KÈM log công nhân + log lỗi trong 1 truy vấn (JSON1)."""
+    cursor = local_conn.cursor()
+    cursor.execute(f"""
+        SELECT 
+            t.ticket_id, t.roll_code, t.inspection_date, t.inspector_id, t.machine_id, t.fabric_name,
+            t.order_number, t.deployment_ticket_id, t.notes, t.status,
+            (SELECT json_group_array(json_object(
+                        'worker_id', w.worker_id, 'shift', w.shift,
+                        'meters_g1', w.meters_g1, 'meters_g2', w.meters_g2))
+             FROM roll_production_log w WHERE w.ticket_id = t.ticket_id) AS worker_log,
+            (SELECT json_group_array(json_object(
+                        'error_type', e.error_type, 'meter_location', e.meter_location,
+                        'worker_id', e.worker_id, 'shift', e.shift,
+                        'points_val', COALESCE(e.points, 1)))
+             FROM ticket_errors e WHERE e.ticket_id = t.ticket_id) AS error_log
+        FROM completed_tickets t
+        {where_sql}
+    """, params)
+    columns = [description[0] for description in cursor.description]
+    tickets = []
+    for row in cursor.fetchall():
+        ticket = dict(zip(columns, row))
+        ticket['worker_log'] = json.loads(ticket['worker_log'] or '[]')
+        ticket['error_log'] = json.loads(ticket['error_log'] or '[]')
+        tickets.append(ticket)
+    return tickets
+
+def get_unsynced_batch(local_conn, limit):
+    """
+    Lấy tối đa `limit` phiếu chưa đồng bộ kèm log công nhân + log lỗi.
+    Phiếu từng lỗi xếp sau phiếu mới (không chặn đầu hàng đợi); lỗi đủ SYNC_MAX_ATTEMPTS lần thì bị gác lại.
+    """
+    return _select_tickets_with_logs(
+        local_conn,
+        "WHERE t.is_synced = 0 AND COALESCE(t.sync_attempts, 0) < ? "
+        "ORDER BY COALESCE(t.sync_attempts, 0), t.inspection_date LIMIT ?",
+        (SYNC_MAX_ATTEMPTS, limit))
+
+def record_sync_failures(local_conn, failures):
+    """Tăng số lần lỗi của các phiếu ({ticket_id: lỗi}). Trả về các phiếu vừa bị gác (đủ SYNC_MAX_ATTEMPTS)."""
+    if not failures:
+        return []
+    with local_conn:
+        local_conn.executemany(
+            "UPDATE completed_tickets SET sync_attempts = COALESCE(sync_attempts, 0) + 1, sync_error = ? "
+            "WHERE ticket_id = ?",
+            [(str(error)[:1000], str(ticket_id)) for ticket_id, error in failures.items()]
+        )
+        rows = local_conn.execute(
+            "SELECT ticket_id FROM completed_tickets WHERE ticket_id IN (SELECT value FROM json_each(?)) "
+            "AND sync_attempts >= ?",
+            (json.dumps([str(t) for t in failures]), SYNC_MAX_ATTEMPTS)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def get_outbox_snapshot(local_conn):
+    """change_id lớn nhất hiện có trong sync_outbox - lấy TRƯỚC khi đọc phiếu ở chế độ batch / single."""
+    return local_conn.execute("SELECT COALESCE(MAX(change_id), 0) FROM sync_outbox").fetchone()[0]
+
+def mark_tickets_as_synced(local_conn, ticket_ids, outbox_snapshot):
+    """
+    Đánh dấu cả lô đã đồng bộ (json_each: không vướng giới hạn số tham số), trong 1 transaction:
+    - Xóa các dòng sync_outbox của các phiếu này có change_id <= outbox_snapshot (đã nằm trong dữ liệu vừa gửi),
+      để outbox không phình ra và không chặn lưu trữ khi chạy chế độ batch / single.
+    - Phiếu có thay đổi ghi SAU snapshot (VD: post_action trong lúc đang gửi) giữ is_synced = 0 -> lượt sau gửi tiếp.
+    """
+    if not ticket_ids:
+        return
+    ids_json = json.dumps([str(t) for t in ticket_ids])
+    with local_conn:
+        local_conn.execute(
+            "DELETE FROM sync_outbox WHERE ticket_id IN (SELECT value FROM json_each(?)) AND change_id <= ?",
+            (ids_json, outbox_snapshot)
+        )
+        local_conn.execute("""
+            UPDATE completed_tickets SET is_synced = 1 
+            WHERE ticket_id IN (SELECT value FROM json_each(?))
+              AND NOT EXISTS (SELECT 1 FROM sync_outbox o WHERE o.ticket_id = completed_tickets.ticket_id)
+            """, (ids_json,))
+
+def resolve_roll_codes_batch(pg_cursor, candidates):
+    """
+    Chốt mã cây cho các cây MỚI của lô. candidates: {local_uuid: mã gốc}.
+    1 truy vấn lấy các mã đã có trên Server; chỉ khi trùng mới dò thêm từng mã (+1),
+    đồng thời tránh 2 phiếu trong cùng lô nhận cùng 1 mã.
+    """
+    if not candidates:
+        return {}
+    pg_cursor.execute("SELECT roll_number FROM fabric_rolls WHERE roll_number = ANY(%s)",
+                      (list(set(candidates.values())),))
+    taken = {row[0] for row in pg_cursor.fetchall()}
+    resolved = {}
+    for local_uuid, original_code in candidates.items():
+        final_code = original_code
+        while final_code in taken:
+            final_code = increment_roll_code(final_code)
+            if final_code not in taken:
+                pg_cursor.execute("SELECT 1 FROM fabric_rolls WHERE roll_number = %s", (final_code,))
+                if pg_cursor.fetchone():
+                    taken.add(final_code)
+        taken.add(final_code)
+        resolved[local_uuid] = final_code
+    return resolved
+
+_fabric_roll_id_type = None
+
+def fabric_roll_id_type(pg_cursor):
+    """
+    Kiểu cột fabric_rolls.id trên Server (uuid hoặc text...), đọc 1 lần từ catalog.
+    Dùng để ép kiểu THAM SỐ (id = ANY(%s::uuid[])) thay vì ép cột (id::text) làm mất chỉ mục khóa chính.
+    """
+    global _fabric_roll_id_type
+    if _fabric_roll_id_type is None:
+        pg_cursor.execute("""
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute 
+            WHERE attrelid = 'fabric_rolls'::regclass AND attname = 'id'
+            """)
+        _fabric_roll_id_type = pg_cursor.fetchone()[0]
+    return _fabric_roll_id_type
+
+def push_batch(pg_conn, tickets, commit=True):
+    """
+    Đẩy 1 lô phiếu lên Server trong ĐÚNG 1 transaction.
+    Trả về (danh sách ticket_id được đánh dấu synced, số phiếu đổi mã).
+    Lỗi giữa chừng -> rollback toàn bộ lô (không phiếu nào bị ghi dở).
+    commit=False: người gọi ghi thêm vào cùng transaction rồi tự commit.
+    """
+    done_ids = []
+    pg_cursor = pg_conn.cursor()
+
+    # Phiếu thiếu Lệnh Triển Khai: bỏ qua nhưng vẫn đánh dấu (giống chế độ single)
+    deployment_ids = {t['deployment_ticket_id'] for t in tickets if t.get('deployment_ticket_id')}
+    for t in tickets:
+        if not t.get('deployment_ticket_id'):
+            print(f"    [SKIP] {t['ticket_id']}: Thiếu Lệnh Triển Khai.")
+            done_ids.append(t['ticket_id'])
+
+    deployments = {}
+    if deployment_ids:
+        with pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute("""
+                SELECT ticket_id, fabric_id, order_number 
+                FROM deployment_orders 
+                WHERE ticket_id = ANY(%s)
+                """, (list(deployment_ids),))
+            deployments = {row['ticket_id']: row for row in cur.fetchall()}
+
+    ready = []
+    for t in tickets:
+        if not t.get('deployment_ticket_id'):
+            continue
+        if t['deployment_ticket_id'] not in deployments:
+            print(f"    [SKIP] {t['ticket_id']}: Lệnh Triển Khai không tồn tại.")
+            continue
+        t['ticket_id'] = str(t['ticket_id'])
+        ready.append(t)
+    if not ready:
+        return done_ids, 0
+
+    # Cây đã có trên Server giữ nguyên mã (ép kiểu phía tham số -> vẫn dùng được chỉ mục khóa chính)
+    pg_cursor.execute(f"SELECT id::text, roll_number FROM fabric_rolls WHERE id = ANY(%s::{fabric_roll_id_type(pg_cursor)}[])",
+                      ([t['ticket_id'] for t in ready],))
+    existing = dict(pg_cursor.fetchall())
+    final_codes = resolve_roll_codes_batch(
+        pg_cursor, {t['ticket_id']: t['roll_code'] for t in ready if t['ticket_id'] not in existing})
+    final_codes.update(existing)
+
+    # 1. Master Tickets (cùng logic gộp notes như get_or_create_master_ticket)
+    master_rows = []
+    for t in ready:
+        deployment_info = deployments[t['deployment_ticket_id']]
+        master_rows.append((t['ticket_id'], t.get('inspection_date'), t['machine_id'],
+                            deployment_info['fabric_id'], deployment_info['order_number'],
+                            t['deployment_ticket_id'], t['inspector_id'], t.get('notes', '')))
+    psycopg2.extras.execute_values(pg_cursor, """
+        INSERT INTO inspection_tickets 
+        (ticket_id, inspection_date, machine_id, fabric_id, order_number, deployment_ticket_id, inspector_id, notes) 
+        VALUES %s
+        ON CONFLICT (ticket_id) DO UPDATE 
+        SET inspection_date = EXCLUDED.inspection_date,
+            notes = CASE 
+                WHEN inspection_tickets.notes IS NULL OR inspection_tickets.notes = '' THEN EXCLUDED.notes
+                WHEN position(EXCLUDED.notes in inspection_tickets.notes) > 0 THEN inspection_tickets.notes 
+                ELSE CONCAT(inspection_tickets.notes, ' | ', EXCLUDED.notes)
+            END
+        """, master_rows)
+
+    # 2. Fabric Rolls: tổng mét tính sẵn, KHÔNG đổi roll_number của cây đã có
+    roll_rows = []
+    production_rows = {}
+    for t in ready:
+        total_g1 = sum(w.get('meters_g1') or 0 for w in t['worker_log'])
+        total_g2 = sum(w.get('meters_g2') or 0 for w in t['worker_log'])
+        roll_rows.append((t['ticket_id'], t['ticket_id'], final_codes[t['ticket_id']],
+                          total_g1, total_g2, t.get('status', 'PENDING'), t.get('notes', '')))
+        for w in t['worker_log']:
+            # 1 lệnh ON CONFLICT DO UPDATE không được chạm 1 dòng 2 lần -> gộp trùng, dòng sau thắng
+            production_rows[(t['ticket_id'], str(w['worker_id']), str(w['shift']))] = (
+                t['ticket_id'], w['worker_id'], w['shift'], t['inspection_date'], w['meters_g1'], w['meters_g2'])
+    psycopg2.extras.execute_values(pg_cursor, """
+        INSERT INTO fabric_rolls 
+        (id, ticket_id, roll_number, meters_grade1, meters_grade2, status, notes) 
+        VALUES %s
+        ON CONFLICT (id) DO UPDATE 
+        SET status = EXCLUDED.status,
+            notes = EXCLUDED.notes,
+            ticket_id = EXCLUDED.ticket_id,
+            meters_grade1 = EXCLUDED.meters_grade1,
+            meters_grade2 = EXCLUDED.meters_grade2,
+            roll_number = fabric_rolls.roll_number 
+        """, roll_rows)
+
+    # 3. Production Logs (Workers)
+    production_ids = {}
+    if production_rows:
+        returned = psycopg2.extras.execute_values(pg_cursor, """
+            INSERT INTO individual_productions (roll_id, worker_id, shift, production_date, meters_grade1, meters_grade2) 
+            VALUES %s 
+            ON CONFLICT (roll_id, worker_id, shift) DO UPDATE 
+            SET meters_grade1 = EXCLUDED.meters_grade1, meters_grade2 = EXCLUDED.meters_grade2, production_date = EXCLUDED.production_date
+            RETURNING id, roll_id, worker_id, shift
+            """, list(production_rows.values()), fetch=True)
+        production_ids = {(str(roll_id), str(worker_id), str(shift)): prod_id
+                          for prod_id, roll_id, worker_id, shift in returned}
+
+    # 4. Errors
+    error_rows = []
+    for t in ready:
+        for error in t['error_log']:
+            prod_id = production_ids.get((t['ticket_id'], str(error['worker_id']), str(error['shift'])))
+            if prod_id is not None:
+                error_rows.append((prod_id, error['error_type'], error['meter_location'], error.get('points_val', 1)))
+    if error_rows:
+        psycopg2.extras.execute_values(pg_cursor, """
+            INSERT INTO production_errors (production_id, error_type, occurrences, meter_location, points, is_fixed) 
+            VALUES %s
+            ON CONFLICT (production_id, error_type) DO NOTHING
+            """, error_rows, template="(%s, %s, 1, %s, %s, FALSE)")
+
+    if commit:
+        pg_conn.commit()
+
+    renamed = 0
+    for t in ready:
+        if t['ticket_id'] not in existing and final_codes[t['ticket_id']] != t['roll_code']:
+            renamed += 1
+            print(f"    [AUTO-FIX] {t['ticket_id']}: {t['roll_code']} -> {final_codes[t['ticket_id']]}")
+    done_ids.extend(t['ticket_id'] for t in ready)
+    return done_ids, renamed
+
+def push_tickets_isolated(pg_conn, tickets):
+    """
+    Lô bị lỗi: chạy lại từng phiếu trong 1 transaction, mỗi phiếu 1 SAVEPOINT -> phiếu lỗi chỉ rollback chính nó.
+    Trả về (done_ids, renamed, {ticket_id: lỗi}).
+    """
+    done_ids, renamed, failures = [], 0, {}
+    pg_cursor = pg_conn.cursor()
+    for ticket in tickets:
+        pg_cursor.execute("SAVEPOINT sp_ticket")
+        try:
+            ids, count = push_batch(pg_conn, [ticket], commit=False)
+            pg_cursor.execute("RELEASE SAVEPOINT sp_ticket")
+            done_ids.extend(ids)
+            renamed += count
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except Exception as e:
+            pg_cursor.execute("ROLLBACK TO SAVEPOINT sp_ticket")
+            print(f"    -> [ERROR] Phiếu {ticket['ticket_id']}: {e}")
+            failures[str(ticket['ticket_id'])] = e
+    pg_conn.commit()
+    return done_ids, renamed, failures
+
+def sync_data_batch(batch_size=SYNC_BATCH_SIZE):
+    """
+    Đồng bộ 1 lô tối đa `batch_size` phiếu. Trả về số phiếu đã xử lý (để vòng lặp biết còn tồn đọng);
+    0 nếu không phiếu nào đi được (chờ chu kỳ sau, không quay vòng nóng).
+    """
+    local_conn = sqlite3.connect(LOCAL_DB_PATH)
+    pg_conn = None
+    tickets = []
+
+    try:
+        started = time.perf_counter()
+        outbox_snapshot = get_outbox_snapshot(local_conn)
+        tickets = get_unsynced_batch(local_conn, batch_size)
+        if not tickets:
+            return 0
+
+        print(f"\n[{time.strftime('%H:%M:%S')}] [BATCH] Đồng bộ lô {len(tickets)} phiếu...")
+        pg_conn = psycopg2.connect(**PG_DB_PARAMS)
+
+        failures = {}
+        try:
+            done_ids, renamed = push_batch(pg_conn, tickets)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except Exception as e:
+            # 1 phiếu lỗi làm hỏng cả lô -> rollback, tách từng phiếu (SAVEPOINT) để các phiếu khác vẫn đi được
+            pg_conn.rollback()
+            print(f"    [BATCH] Lỗi lô ({e}), tách lỗi từng phiếu...")
+            done_ids, renamed, failures = push_tickets_isolated(pg_conn, tickets)
+
+        mark_tickets_as_synced(local_conn, done_ids, outbox_snapshot)
+        # Phiếu lỗi dữ liệu / Lệnh Triển Khai chưa có: tăng số lần lỗi, xếp sau phiếu mới, đủ ngưỡng thì gác lại
+        done = {str(t) for t in done_ids}
+        for t in tickets:
+            if str(t['ticket_id']) not in done and str(t['ticket_id']) not in failures:
+                failures[str(t['ticket_id'])] = "Lệnh Triển Khai không tồn tại trên Server"
+        for ticket_id in record_sync_failures(local_conn, failures):
+            print(f"    -> [PARKED] Phiếu {ticket_id} lỗi {SYNC_MAX_ATTEMPTS} lần, tạm gác "
+                  f"(sửa dữ liệu rồi chạy: python server_sync.py requeue-dead)")
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        print(f"    -> [OK] {len(done_ids)}/{len(tickets)} phiếu trong {elapsed:.2f}s "
+              f"({len(done_ids) / elapsed:.1f} phiếu/s, đổi mã: {renamed})")
+
+    except (Exception, psycopg2.Error) as e:
+        print(f"Lỗi kết nối Server DB: {e}")
+        return 0
+    finally:
+        if local_conn: local_conn.close()
+        if pg_conn: pg_conn.close()
+    return len(tickets) if done_ids else 0
+
+# ==================== CHẾ ĐỘ OUTBOX (CDC) ====================
+# local_db_manager ghi mỗi thay đổi vào sync_outbox trong CÙNG transaction với thao tác lưu.
+# Tiến trình đồng bộ đọc tiếp từ high-water mark (change_id đã lên Server), chỉ đẩy phần thay đổi:
+# - 'session': phiếu mới, payload có sẵn log công nhân + log lỗi (không đọc lại bảng con).
+# - 'post_action': chỉ cập nhật notes / status (trước đây bị mất nếu phiếu đã sync).
+# Ghi lên Server là idempotent (upsert), nên nếu lưu mốc thất bại sau khi commit thì phát lại vẫn an toàn.
+
+def get_high_water_mark(local_conn):
+    row = local_conn.execute("SELECT value FROM sync_state WHERE name = ?", (OUTBOX_HWM_KEY,)).fetchone()
+    return row[0] if row else 0
+
+def read_outbox(local_conn, after_change_id, limit):
+    """Các thay đổi sau mốc, theo thứ tự change_id (quét theo khóa chính)."""
+    return local_conn.execute("""
+        SELECT change_id, ticket_id, op, payload, attempts 
+        FROM sync_outbox 
+        WHERE change_id > ? 
+        ORDER BY change_id 
+        LIMIT ?
+        """, (after_change_id, limit)).fetchall()
+
+def fold_changes(local_conn, changes):
+    """
+    Gộp các thay đổi theo phiếu, theo thứ tự change_id.
+    Trả về (sessions: {ticket_id: phiếu đầy đủ}, post_actions: {ticket_id: {notes, status}}).
+    post_action đến sau session trong cùng lô được gộp luôn vào session.
+    """
+    # Thay đổi không có payload (migration / thử lại) -> đọc trạng thái hiện tại từ bảng, 1 truy vấn
+    missing = sorted({ticket_id for _, ticket_id, op, payload, _ in changes
+                      if op == OUTBOX_OP_SESSION and not payload})
+    snapshots = {}
+    if missing:
+        snapshots = {t['ticket_id']: t for t in _select_tickets_with_logs(
+            local_conn, "WHERE t.ticket_id IN (SELECT value FROM json_each(?))", (json.dumps(missing),))}
+
+    sessions, post_actions = {}, {}
+    for _, ticket_id, op, payload, _ in changes:
+        data = json.loads(payload) if payload else None
+        if op == OUTBOX_OP_SESSION:
+            ticket = data or snapshots.get(ticket_id)
+            if ticket is None:
+                continue    # Phiếu không còn trong CSDL cục bộ
+            sessions[ticket_id] = ticket
+            post_actions.pop(ticket_id, None)
+        elif op == OUTBOX_OP_POST_ACTION and data is not None:
+            if ticket_id in sessions:
+                sessions[ticket_id].update(data)
+            else:
+                post_actions[ticket_id] = data
+    return sessions, post_actions
+
+def push_post_actions(pg_cursor, post_actions):
+    """Cập nhật notes / status cho các phiếu đã có trên Server (gộp notes như get_or_create_master_ticket)."""
+    if not post_actions:
+        return
+    rows = [(ticket_id, action.get('notes') or '', action.get('status')) for ticket_id, action in post_actions.items()]
+    psycopg2.extras.execute_values(pg_cursor, f"""
+        UPDATE fabric_rolls AS f 
+        SET status = v.status, notes = v.notes
+        FROM (VALUES %s) AS v(id, notes, status)
+        WHERE f.id = v.id::{fabric_roll_id_type(pg_cursor)}
+        """, rows)
+    psycopg2.extras.execute_values(pg_cursor, """
+        UPDATE inspection_tickets AS t 
+        SET notes = CASE 
+                WHEN t.notes IS NULL OR t.notes = '' THEN v.notes
+                WHEN position(v.notes in t.notes) > 0 THEN t.notes 
+                ELSE CONCAT(t.notes, ' | ', v.notes)
+            END
+        FROM (VALUES %s) AS v(ticket_id, notes)
+        WHERE t.ticket_id = v.ticket_id
+        """, [(ticket_id, notes) for ticket_id, notes, _ in rows])
+
+def commit_outbox_progress(local_conn, last_change_id, synced_ids, failed=None):
+    """
+    1 transaction SQLite: lưu mốc mới, xếp lại các phiếu phải thử lại (payload NULL -> đọc lại lúc gửi),
+    dọn outbox đã xử lý, đánh dấu is_synced cho phiếu không còn thay đổi nào chờ.
+    failed: (change, lỗi) - gửi lỗi dữ liệu hoặc Lệnh Triển Khai chưa có -> xếp lại với attempts + 1;
+    đạt OUTBOX_MAX_ATTEMPTS thì chuyển sang sync_outbox_dead (phiếu giữ is_synced = 0, chờ xử lý tay
+    rồi requeue_dead_changes).
+    """
+    now = time.time()
+    retry, dead = [], []
+    for (change_id, ticket_id, op, payload, attempts), error in failed or ():
+        attempts = (attempts or 0) + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            dead.append((change_id, ticket_id, op, payload, attempts, str(error)[:1000], now))
+        else:
+            retry.append((ticket_id, OUTBOX_OP_SESSION, now, attempts))
+    with local_conn:
+        local_conn.executemany(
+            "INSERT INTO sync_outbox (ticket_id, op, payload, created_at, attempts) VALUES (?, ?, NULL, ?, ?)", retry
+        )
+        local_conn.executemany(
+            "INSERT OR REPLACE INTO sync_outbox_dead (change_id, ticket_id, op, payload, attempts, last_error, failed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", dead
+        )
+        local_conn.execute(
+            "INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (OUTBOX_HWM_KEY, last_change_id))
+        local_conn.execute("DELETE FROM sync_outbox WHERE change_id <= ?", (last_change_id,))
+        if synced_ids:
+            local_conn.execute("""
+                UPDATE completed_tickets SET is_synced = 1 
+                WHERE ticket_id IN (SELECT value FROM json_each(?))
+                  AND NOT EXISTS (SELECT 1 FROM sync_outbox o WHERE o.ticket_id = completed_tickets.ticket_id)
+                """, (json.dumps(sorted(synced_ids)),))
+    for change_id, ticket_id, _, _, attempts, error, _ in dead:
+        print(f"    -> [DEAD] Thay đổi #{change_id} (phiếu {ticket_id}) lỗi {attempts} lần: {error}. "
+              f"Chuyển sang sync_outbox_dead (sửa dữ liệu rồi chạy: python server_sync.py requeue-dead)")
+
+def apply_outbox_changes(local_conn, pg_conn, changes):
+    """Đẩy 1 nhóm thay đổi trong 1 transaction Postgres rồi lưu mốc. Trả về (số phiếu đã đồng bộ, đổi mã)."""
+    sessions, post_actions = fold_changes(local_conn, changes)
+    done_ids, renamed = [], 0
+    if sessions:
+        done_ids, renamed = push_batch(pg_conn, list(sessions.values()), commit=False)
+    push_post_actions(pg_conn.cursor(), post_actions)
+    pg_conn.commit()
+
+    done = {str(ticket_id) for ticket_id in done_ids}
+    # Lệnh Triển Khai chưa có trên Server -> xếp lại cuối hàng đợi, mang theo số lần thử của phiếu
+    # (thay đổi cuối cùng, attempts lớn nhất trong lô) -> đủ OUTBOX_MAX_ATTEMPTS thì vào sync_outbox_dead
+    last_change, attempts = {}, {}
+    for change in changes:
+        last_change[change[1]] = change
+        attempts[change[1]] = max(attempts.get(change[1], 0), change[4] or 0)
+    deferred = [(last_change[ticket_id][:4] + (attempts[ticket_id],), "Lệnh Triển Khai chưa có trên Server")
+                for ticket_id in sessions if str(ticket_id) not in done]
+    synced = done | {str(ticket_id) for ticket_id in post_actions}
+    commit_outbox_progress(local_conn, changes[-1][0], synced, deferred)
+    return len(synced), renamed
+
+def sync_outbox_batch(batch_size=SYNC_BATCH_SIZE):
+    """Đồng bộ tối đa `batch_size` thay đổi kể từ high-water mark. Trả về số thay đổi đã đọc."""
+    local_conn = sqlite3.connect(LOCAL_DB_PATH)
+    pg_conn = None
+
+    try:
+        started = time.perf_counter()
+        changes = read_outbox(local_conn, get_high_water_mark(local_conn), batch_size)
+        if not changes:
+            return 0
+
+        print(f"\n[{time.strftime('%H:%M:%S')}] [OUTBOX] {len(changes)} thay đổi "
+              f"(#{changes[0][0]} -> #{changes[-1][0]})...")
+        pg_conn = psycopg2.connect(**PG_DB_PARAMS)
+
+        try:
+            synced, renamed = apply_outbox_changes(local_conn, pg_conn, changes)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except Exception as e:
+            # Lỗi dữ liệu: tách từng thay đổi; thay đổi lỗi được xếp lại cuối hàng đợi, không chặn các thay đổi sau
+            pg_conn.rollback()
+            print(f"    [OUTBOX] Lỗi lô ({e}), xử lý từng thay đổi...")
+            for change in changes:
+                try:
+                    apply_outbox_changes(local_conn, pg_conn, [change])
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except Exception as change_error:
+                    pg_conn.rollback()
+                    print(f"    -> [ERROR] Thay đổi #{change[0]} (phiếu {change[1]}): {change_error}.")
+                    commit_outbox_progress(local_conn, change[0], (), [(change, change_error)])
+            return 0
+
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        print(f"    -> [OK] {synced} phiếu trong {elapsed:.2f}s "
+              f"({synced / elapsed:.1f} phiếu/s, đổi mã: {renamed}, mốc: #{changes[-1][0]})")
+        return len(changes)
+
+    except (Exception, psycopg2.Error) as e:
+        print(f"Lỗi kết nối Server DB: {e}")
+        return 0
+    finally:
+        if local_conn: local_conn.close()
+        if pg_conn: pg_conn.close()
+
+def mark_ticket_as_synced(local_conn, ticket_id, outbox_snapshot):
     try:
-        cursor = local_conn.cursor()
-        cursor.execute("UPDATE completed_tickets SET is_synced = 1 WHERE ticket_id = ?", (ticket_id,))
-        local_conn.commit()
+        mark_tickets_as_synced(local_conn, [ticket_id], outbox_snapshot)
     except Exception as e:
         print(f"Lỗi update flag synced: {e}")
 
-def run_sync_loop():
-    print(f"[Sync Thread] Bắt đầu tiến trình đồng bộ (Chu kỳ: {SYNC_INTERVAL_SECONDS}s)...")
+def requeue_dead_changes(local_conn):
+    """
+    Đưa các thay đổi trong sync_outbox_dead về lại cuối outbox và bỏ gác các phiếu chế độ batch
+    (sau khi đã sửa dữ liệu). Trả về số thay đổi đưa về outbox.
+    """
+    with local_conn:
+        local_conn.execute("UPDATE completed_tickets SET sync_attempts = 0, sync_error = NULL WHERE sync_attempts > 0")
+        moved = local_conn.execute("""
+            INSERT INTO sync_outbox (ticket_id, op, payload, created_at, attempts) 
+            SELECT ticket_id, op, payload, ?, 0 FROM sync_outbox_dead ORDER BY change_id
+            """, (time.time(),)).rowcount
+        local_conn.execute("DELETE FROM sync_outbox_dead")
+    return moved
+
+def run_sync_loop(mode=SYNC_MODE, batch_size=SYNC_BATCH_SIZE):
+    print(f"[Sync Thread] Bắt đầu tiến trình đồng bộ (Chu kỳ: {SYNC_INTERVAL_SECONDS}s, Chế độ: {mode})...")
     while True:
+        backlog = False
         try:
-            sync_data()
+            # Lô đầy -> còn tồn đọng, đồng bộ tiếp ngay không chờ chu kỳ
+            if mode == "outbox":
+                backlog = sync_outbox_batch(batch_size) >= batch_size
+            elif mode == "batch":
+                backlog = sync_data_batch(batch_size) >= batch_size
+            else:
+                sync_data()
         except Exception as e:
             print(f"[Sync Thread] Lỗi nghiêm trọng: {e}")
             traceback.print_exc()
-        time.sleep(SYNC_INTERVAL_SECONDS)
+        if not backlog:
+            time.sleep(SYNC_INTERVAL_SECONDS)
 
 if __name__ == "__main__":
-    run_sync_loop()
\ No newline at end of file
+    # python server_sync.py [outbox|batch|single] [batch_size]
+    # python server_sync.py requeue-dead   (gửi lại các thay đổi trong sync_outbox_dead)
+    mode = sys.argv[1].strip().lower() if len(sys.argv) > 1 else SYNC_MODE
+    if mode == "requeue-dead":
+        conn = sqlite3.connect(LOCAL_DB_PATH)
+        try:
+            print(f"Đã đưa {requeue_dead_changes(conn)} thay đổi từ sync_outbox_dead về outbox.")
+        finally:
+            conn.close()
+        sys.exit(0)
+    if mode not in SYNC_MODES:
+        sys.exit(f"Chế độ đồng bộ không hợp lệ: {mode}. Chọn: {' | '.join(SYNC_MODES)}")
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else SYNC_BATCH_SIZE
+    run_sync_loop(mode, batch_size)
\ No newline at end of file
@@ -0,0 +1,102 @@
+# --- File: services/circuit_breaker.py ---
+"""
+Circuit Breaker cho kết nối ra ngoài (Redis...).
+- CLOSED: gọi bình thường; lỗi kết nối liên tiếp >= failure_threshold -> OPEN.
+- OPEN: từ chối ngay (không chờ timeout) trong reset_timeout giây (tăng gấp đôi mỗi lần thử lại thất bại).
+- HALF_OPEN: cho đúng 1 lệnh thăm dò đi qua; thành công -> CLOSED, thất bại -> OPEN.
+"""
+import time
+import threading
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 5.0
+DEFAULT_MAX_RESET_TIMEOUT = 60.0
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, max_reset_timeout=DEFAULT_MAX_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+
+        self._lock = threading.Lock()
+        self.state = STATE_CLOSED
+        self._failures = 0
+        self._current_timeout = reset_timeout
+        self._open_until = 0.0
+        self._probe_started = None
+
+        # Thống kê
+        self.rejected = 0
+        self.trips = 0
+        self.last_error = None
+        self.last_change = time.time()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.last_change = time.time()
+
+    def allow(self):
+        """True nếu được phép gọi. Không có I/O -> chi phí vài micro giây."""
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == STATE_OPEN:
+                if now < self._open_until:
+                    self.rejected += 1
+                    return False
+                self._set_state(STATE_HALF_OPEN)
+                self._probe_started = now
+                return True
+            # HALF_OPEN: chỉ 1 lệnh thăm dò; lệnh thăm dò treo quá lâu thì cho lệnh khác thử
+            if self._probe_started is not None and now - self._probe_started < self._current_timeout:
+                self.rejected += 1
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self):
+        """Trả về True nếu vừa phục hồi (OPEN / HALF_OPEN -> CLOSED)."""
+        with self._lock:
+            recovered = self.state != STATE_CLOSED
+            self._failures = 0
+            self._current_timeout = self.reset_timeout
+            self._probe_started = None
+            self._set_state(STATE_CLOSED)
+            return recovered
+
+    def record_failure(self, error=None):
+        """Trả về True nếu vừa ngắt mạch (-> OPEN)."""
+        with self._lock:
+            self.last_error = str(error) if error else None
+            self._failures += 1
+            if self.state == STATE_HALF_OPEN:
+                # Thăm dò thất bại: mở lại, thời gian chờ tăng gấp đôi
+                self._current_timeout = min(self._current_timeout * 2, self.max_reset_timeout)
+            elif self.state == STATE_OPEN or self._failures < self.failure_threshold:
+                return False
+            self._open_until = time.monotonic() + self._current_timeout
+            self._probe_started = None
+            self.trips += 1
+            self._set_state(STATE_OPEN)
+            return True
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "state": self.state,
+                "failures": self._failures,
+                "retry_in": round(max(0.0, self._open_until - time.monotonic()), 1) if self.state == STATE_OPEN else 0,
+                "rejected": self.rejected,
+                "trips": self.trips,
+                "last_error": self.last_error,
+                "since": self.last_change,
+            }
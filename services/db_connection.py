@@ -30,6 +30,29 @@ except Exception as e:
     print(f"CRITICAL ERROR (db_connection_pool_init): {e}")
     raise e
 
+def init_db_pool(minconn=MIN_CONN, maxconn=MAX_CONN):
+    """
+    [NEW] Tạo lại Pool với kích thước mới.
+    Dùng trong tiến trình Worker con (workers/worker_pool.py): mỗi tiến trình cần Pool riêng, nhỏ.
+    """
+    global db_pool
+    db_pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **PG_DB_PARAMS)
+    logger.info(f"Connection Pool re-initialized (Min: {minconn}, Max: {maxconn}).")
+    return db_pool
+
+def close_db_pool():
+    """
+    [NEW] Đóng toàn bộ kết nối của Pool hiện tại.
+    Tiến trình cha gọi hàm này TRƯỚC khi fork để tiến trình con không dùng chung socket Postgres.
+    """
+    global db_pool
+    if db_pool:
+        try:
+            db_pool.closeall()
+        except Exception as e:
+            logger.error(f"ERROR (close_db_pool): {e}")
+        db_pool = None
+
 def db_get_connection():
     """
     Lấy một kết nối từ pool.
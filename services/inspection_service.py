@@ -3,6 +3,7 @@ import psycopg2
 import psycopg2.extras
 import logging
 from services.db_connection import db_get_connection, db_release_connection
+from services.lookup_cache import fabric_id_cache, personnel_name_cache
 
 logger = logging.getLogger(__name__)
 
@@ -137,11 +138,7 @@ class InspectionService:
             """, (calc_total_g1, calc_total_g2, roll_id))
             
             # BƯỚC 3: Update inspection_tickets
-            fabric_id = None
-            if main_info.get('fabric_name'):
-                cursor.execute("SELECT id FROM fabrics WHERE fabric_name = %s LIMIT 1", (main_info['fabric_name'],))
-                res = cursor.fetchone()
-                if res: fabric_id = res[0]
+            fabric_id = self._resolve_fabric_id(cursor, main_info.get('fabric_name'))
             
             cursor.execute("""
                 UPDATE inspection_tickets 
@@ -245,9 +242,9 @@ class InspectionService:
             
             inspector_name = "N/A"
             if data['inspector_id']:
-                cursor.execute("SELECT full_name FROM personnel WHERE personnel_id = %s", (data['inspector_id'],))
-                res = cursor.fetchone()
-                if res: inspector_name = res[0]
+                inspector_name = personnel_name_cache.get_or_load(
+                    data['inspector_id'], lambda: self._load_personnel_name(cursor, data['inspector_id'])
+                ) or "N/A"
             
             return {
                 "ticket_id": data['ticket_id'],
@@ -268,6 +265,24 @@ class InspectionService:
         finally:
             if conn: db_release_connection(conn)
 
+    # --- TRA CỨU DANH MỤC (CÓ CACHE) ---
+    def _resolve_fabric_id(self, cursor, fabric_name):
+        """fabric_name -> fabrics.id, dùng cache để không tốn 1 round-trip mỗi cây."""
+        if not fabric_name:
+            return None
+
+        def _load():
+            cursor.execute("SELECT id FROM fabrics WHERE fabric_name = %s LIMIT 1", (fabric_name,))
+            res = cursor.fetchone()
+            return res[0] if res else None
+
+        return fabric_id_cache.get_or_load(fabric_name, _load)
+
+    def _load_personnel_name(self, cursor, personnel_id):
+        cursor.execute("SELECT full_name FROM personnel WHERE personnel_id = %s", (personnel_id,))
+        res = cursor.fetchone()
+        return res[0] if res else None
+
     def check_roll_code_exists(self, roll_code):
         conn = None
         try:
@@ -315,135 +330,13 @@ class InspectionService:
             conn.autocommit = False # [IMPORTANT] Start Transaction
             cursor = conn.cursor()
 
-            # --- 1. Lấy dữ liệu cơ bản ---
-            ticket_id = data.get('ticket_id')
-            roll_code = data.get('roll_code')
-            fabric_name = data.get('fabric_name')
-            machine_id = data.get('machine_id')
-            inspector_id = data.get('inspector_id')
-            order_number = data.get('order_number')
-            deployment_ticket_id = data.get('deployment_ticket_id')
-            inspection_date = data.get('inspection_date')
-            status = data.get('status', 'New')
-            
-            total_g1 = float(data.get('meters_grade1', 0) or 0)
-            total_g2 = float(data.get('meters_grade2', 0) or 0)
-            
-            workers_list = data.get('workers_log', []) 
-
-            # --- 2. Resolve Fabric ID (Giữ nguyên) ---
-            fabric_id = None
-            if fabric_name:
-                cursor.execute("SELECT id FROM fabrics WHERE fabric_name = %s LIMIT 1", (fabric_name,))
-                res = cursor.fetchone()
-                if res: fabric_id = res[0]
-
-            # --- 3. Insert/Upsert Inspection Ticket (Giữ nguyên) ---
-            # Thêm DO UPDATE để cập nhật ngày hoặc người kiểm nếu có thay đổi
-            cursor.execute("""
-                INSERT INTO inspection_tickets 
-                (ticket_id, inspection_date, order_number, machine_id, inspector_id, fabric_id, deployment_ticket_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (ticket_id) 
-                DO UPDATE SET 
-                    inspection_date = EXCLUDED.inspection_date,
-                    inspector_id = EXCLUDED.inspector_id,
-                    machine_id = EXCLUDED.machine_id
-            """, (ticket_id, inspection_date, order_number, machine_id, inspector_id, fabric_id, deployment_ticket_id))
-
-            # --- 4. Insert/Upsert Fabric Roll ---
-            # Cần UPDATE status và meters nếu trùng ID
-            cursor.execute("""
-                INSERT INTO fabric_rolls 
-                (id, ticket_id, roll_number, meters_grade1, meters_grade2, status)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (id) 
-                DO UPDATE SET 
-                    status = EXCLUDED.status,
-                    meters_grade1 = EXCLUDED.meters_grade1,
-                    meters_grade2 = EXCLUDED.meters_grade2
-            """, (ticket_id, ticket_id, roll_code, total_g1, total_g2, status))
-
-            # --- 5. Loop Workers & UPSERT Individual Productions (CRITICAL FIX) ---
-            for worker_entry in workers_list:
-                w_info = worker_entry.get('worker', {})
-                w_id = w_info.get('id') if isinstance(w_info, dict) else w_info
-                shift = str(worker_entry.get('shift', '')) # Ép kiểu string để tránh lỗi nếu None
-                
-                # Mapping meters
-                raw_g1 = worker_entry.get('meters_g1') if worker_entry.get('meters_g1') is not None else worker_entry.get('meters_grade1', 0)
-                val_g1 = float(raw_g1 or 0)
-
-                raw_g2 = worker_entry.get('meters_g2') if worker_entry.get('meters_g2') is not None else worker_entry.get('meters_grade2', 0)
-                val_g2 = float(raw_g2 or 0)
-
-                # [FIXED LOGIC]: Dùng ON CONFLICT (...) DO UPDATE
-                # Ràng buộc idx_unique_prod_log phải được tạo trên (roll_id, worker_id, shift)
-                cursor.execute("""
-                    INSERT INTO individual_productions 
-                    (roll_id, worker_id, shift, production_date, meters_grade1, meters_grade2) 
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (roll_id, worker_id, shift) 
-                    DO UPDATE SET
-                        meters_grade1 = EXCLUDED.meters_grade1,
-                        meters_grade2 = EXCLUDED.meters_grade2,
-                        production_date = EXCLUDED.production_date
-                    RETURNING id
-                """, (
-                    ticket_id,    # roll_id
-                    w_id,         # worker_id
-                    shift,        # shift
-                    inspection_date,
-                    val_g1,
-                    val_g2
-                ))
-                
-                # Lấy ID (Dù Insert mới hay Update cũ đều trả về ID nhờ RETURNING)
-                row = cursor.fetchone()
-                if not row: continue
-                production_id = row[0]
+            ticket_id = self._write_roll(cursor, data)
 
-                # --- 6. Handle Errors (Clean & Re-insert Strategy) ---
-                w_errors = worker_entry.get('errors', [])
-                
-                # Bước 1: Xóa lỗi cũ của phiên sản xuất này (để tránh trùng lặp hoặc lỗi dư thừa)
-                cursor.execute("DELETE FROM production_errors WHERE production_id = %s", (production_id,))
-                
-                # Bước 2: Insert lại danh sách lỗi mới nhất (nếu có)
-                if w_errors:
-                    error_values = []
-                    for err in w_errors:
-                        error_values.append((
-                            production_id,
-                            err.get('error_type'),
-                            float(err.get('meter_location', 0)),
-                            int(err.get('points', 1)),
-                            1,
-                            err.get('is_fixed', False)
-                        ))
-                    
-                    if error_values:
-                        sql_err = """
-                            INSERT INTO production_errors 
-                            (production_id, error_type, meter_location, points, occurrences, is_fixed)
-                            VALUES (%s, %s, %s, %s, %s, %s)
-                        """
-                        cursor.executemany(sql_err, error_values)
+            # Auto-update total meters: tính trong CÙNG transaction
+            self._recalc_roll_totals(cursor, ticket_id)
 
             # --- 7. Final Commit ---
             conn.commit()
-            
-            # Auto-update total meters (Giữ nguyên logic tính tổng lại cho chắc chắn)
-            try:
-                cursor.execute("""
-                    UPDATE fabric_rolls 
-                    SET meters_grade1 = (SELECT COALESCE(SUM(meters_grade1),0) FROM individual_productions WHERE roll_id = %s),
-                        meters_grade2 = (SELECT COALESCE(SUM(meters_grade2),0) FROM individual_productions WHERE roll_id = %s)
-                    WHERE id = %s
-                """, (ticket_id, ticket_id, ticket_id))
-                conn.commit()
-            except Exception:
-                pass # Bỏ qua lỗi phụ này nếu transaction chính đã xong
 
             return {"status": "success", "ticket_id": ticket_id}
 
@@ -454,6 +347,184 @@ class InspectionService:
         finally:
             if conn: db_release_connection(conn)
 
+    def persist_roll_batch(self, payloads):
+        """
+        [NEW] Ghi một lô gói tin từ Queue trong MỘT transaction (Worker chế độ Batch).
+        Mỗi cây vải được bọc trong SAVEPOINT riêng: gói tin lỗi chỉ rollback phần của nó,
+        các cây còn lại vẫn được commit.
+
+        Args:
+            payloads (list): Danh sách dict (đã parse JSON) lấy từ Queue.
+
+        Returns:
+            dict: {"persisted": [ticket_id, ...], "failed": [(index, error_str), ...]}
+                  `index` là vị trí gói tin lỗi trong `payloads`.
+
+        Raises:
+            Exception: Lỗi hạ tầng (mất kết nối DB, commit thất bại...) -> cả lô chưa được ghi.
+        """
+        conn = None
+        persisted, failed = [], []
+        try:
+            conn = db_get_connection()
+            conn.autocommit = False
+            cursor = conn.cursor()
+
+            for index, data in enumerate(payloads):
+                cursor.execute("SAVEPOINT sp_roll")
+                try:
+                    ticket_id = self._write_roll(cursor, data)
+                    self._recalc_roll_totals(cursor, ticket_id)
+                    cursor.execute("RELEASE SAVEPOINT sp_roll")
+                    persisted.append(ticket_id)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # Mất kết nối -> không thể rollback từng phần, bỏ cả lô
+                    raise
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT sp_roll")
+                    logger.error(f"[PERSIST_BATCH_ERROR] Ticket: {data.get('ticket_id')} | Error: {e}")
+                    failed.append((index, str(e)))
+
+            conn.commit()
+            return {"persisted": persisted, "failed": failed}
+
+        except Exception as e:
+            if conn:
+                try: conn.rollback()
+                except Exception: pass
+            logger.error(f"[PERSIST_BATCH_ERROR] Batch of {len(payloads)} aborted | Error: {e}")
+            raise e
+        finally:
+            if conn: db_release_connection(conn)
+
+    def _write_roll(self, cursor, data):
+        """
+        Ghi phiếu + cây vải + sản lượng công nhân + lỗi của một gói tin Queue.
+        Không commit: transaction do hàm gọi quản lý. Trả về ticket_id.
+        """
+        # --- 1. Lấy dữ liệu cơ bản ---
+        ticket_id = data.get('ticket_id')
+        roll_code = data.get('roll_code')
+        fabric_name = data.get('fabric_name')
+        machine_id = data.get('machine_id')
+        inspector_id = data.get('inspector_id')
+        order_number = data.get('order_number')
+        deployment_ticket_id = data.get('deployment_ticket_id')
+        inspection_date = data.get('inspection_date')
+        status = data.get('status', 'New')
+        
+        total_g1 = float(data.get('meters_grade1', 0) or 0)
+        total_g2 = float(data.get('meters_grade2', 0) or 0)
+        
+        workers_list = data.get('workers_log', []) 
+
+        # --- 2. Resolve Fabric ID (Cache danh mục) ---
+        fabric_id = self._resolve_fabric_id(cursor, fabric_name)
+
+        # --- 3. Insert/Upsert Inspection Ticket (Giữ nguyên) ---
+        # Thêm DO UPDATE để cập nhật ngày hoặc người kiểm nếu có thay đổi
+        cursor.execute("""
+            INSERT INTO inspection_tickets 
+            (ticket_id, inspection_date, order_number, machine_id, inspector_id, fabric_id, deployment_ticket_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (ticket_id) 
+            DO UPDATE SET 
+                inspection_date = EXCLUDED.inspection_date,
+                inspector_id = EXCLUDED.inspector_id,
+                machine_id = EXCLUDED.machine_id
+        """, (ticket_id, inspection_date, order_number, machine_id, inspector_id, fabric_id, deployment_ticket_id))
+
+        # --- 4. Insert/Upsert Fabric Roll ---
+        # Cần UPDATE status và meters nếu trùng ID
+        cursor.execute("""
+            INSERT INTO fabric_rolls 
+            (id, ticket_id, roll_number, meters_grade1, meters_grade2, status)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (id) 
+            DO UPDATE SET 
+                status = EXCLUDED.status,
+                meters_grade1 = EXCLUDED.meters_grade1,
+                meters_grade2 = EXCLUDED.meters_grade2
+        """, (ticket_id, ticket_id, roll_code, total_g1, total_g2, status))
+
+        # --- 5. UPSERT Individual Productions: 1 câu lệnh nhiều dòng (execute_values) ---
+        # Gom theo khóa (worker_id, shift): 1 câu ON CONFLICT không được cập nhật cùng 1 dòng 2 lần.
+        # Trùng khóa -> bản ghi sau thắng (giống vòng lặp UPSERT từng dòng trước đây).
+        productions = {}
+        for worker_entry in workers_list:
+            w_info = worker_entry.get('worker', {})
+            w_id = w_info.get('id') if isinstance(w_info, dict) else w_info
+            shift = str(worker_entry.get('shift', '')) # Ép kiểu string để tránh lỗi nếu None
+            
+            # Mapping meters
+            raw_g1 = worker_entry.get('meters_g1') if worker_entry.get('meters_g1') is not None else worker_entry.get('meters_grade1', 0)
+            val_g1 = float(raw_g1 or 0)
+
+            raw_g2 = worker_entry.get('meters_g2') if worker_entry.get('meters_g2') is not None else worker_entry.get('meters_grade2', 0)
+            val_g2 = float(raw_g2 or 0)
+
+            key = (str(w_id) if w_id is not None else None, shift)
+            productions[key] = (w_id, val_g1, val_g2, worker_entry.get('errors', []))
+
+        if not productions:
+            return ticket_id
+
+        # Ràng buộc idx_unique_prod_log phải được tạo trên (roll_id, worker_id, shift)
+        returned = psycopg2.extras.execute_values(cursor, """
+            INSERT INTO individual_productions 
+            (roll_id, worker_id, shift, production_date, meters_grade1, meters_grade2) 
+            VALUES %s
+            ON CONFLICT (roll_id, worker_id, shift) 
+            DO UPDATE SET
+                meters_grade1 = EXCLUDED.meters_grade1,
+                meters_grade2 = EXCLUDED.meters_grade2,
+                production_date = EXCLUDED.production_date
+            RETURNING id, worker_id, shift
+        """, [
+            (ticket_id, w_id, shift, inspection_date, val_g1, val_g2)
+            for (_, shift), (w_id, val_g1, val_g2, _) in productions.items()
+        ], fetch=True)
+
+        # --- 6. Handle Errors (Clean & Re-insert Strategy) - 1 DELETE + 1 INSERT cho cả cây ---
+        production_ids = []
+        error_values = []
+        for production_id, r_worker_id, r_shift in returned:
+            production_ids.append(production_id)
+            key = (str(r_worker_id) if r_worker_id is not None else None, r_shift)
+            if key not in productions:
+                continue
+            for err in productions[key][3]:
+                error_values.append((
+                    production_id,
+                    err.get('error_type'),
+                    float(err.get('meter_location', 0)),
+                    int(err.get('points', 1)),
+                    1,
+                    err.get('is_fixed', False)
+                ))
+
+        # Xóa lỗi cũ của các phiên sản xuất này (để tránh trùng lặp hoặc lỗi dư thừa)
+        cursor.execute("DELETE FROM production_errors WHERE production_id = ANY(%s)", (production_ids,))
+
+        # Insert lại danh sách lỗi mới nhất (nếu có)
+        if error_values:
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO production_errors 
+                (production_id, error_type, meter_location, points, occurrences, is_fixed)
+                VALUES %s
+            """, error_values, page_size=500)
+
+        return ticket_id
+
+    def _recalc_roll_totals(self, cursor, ticket_id):
+        """Tính lại tổng mét của cây vải từ bảng individual_productions."""
+        cursor.execute("""
+            UPDATE fabric_rolls 
+            SET meters_grade1 = (SELECT COALESCE(SUM(meters_grade1),0) FROM individual_productions WHERE roll_id = %s),
+                meters_grade2 = (SELECT COALESCE(SUM(meters_grade2),0) FROM individual_productions WHERE roll_id = %s)
+            WHERE id = %s
+        """, (ticket_id, ticket_id, ticket_id))
+
     # --- 7. HÀM RETROACTIVE ---
     def update_pending_worker_from_previous_roll(self, current_ticket_id, worker_info):
         conn = None
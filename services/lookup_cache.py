@@ -0,0 +1,81 @@
+# --- File: services/lookup_cache.py ---
+import time
+import threading
+from collections import OrderedDict
+
+class LookupCache:
+    """
+    Cache trong tiến trình cho dữ liệu danh mục (Master Data) ít thay đổi.
+    - Giới hạn kích thước (LRU): vượt `max_size` thì bỏ phần tử ít dùng nhất.
+    - Hết hạn theo thời gian (TTL) để tự làm mới khi dữ liệu đổi từ hệ thống khác.
+    - Thread-safe (Flask + SocketIO + Worker dùng chung).
+    - Không cache kết quả None (chưa có trong DB) để bản ghi mới tạo được thấy ngay.
+    """
+    def __init__(self, name, max_size=1024, ttl=600):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, loader):
+        """
+        Trả về giá trị trong cache; nếu thiếu/hết hạn thì gọi `loader()` (truy vấn DB) rồi lưu lại.
+        Lỗi của loader được ném ra nguyên vẹn cho hàm gọi xử lý.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+
+        # Gọi DB ngoài lock để không chặn các luồng khác
+        value = loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Xóa 1 khóa, hoặc toàn bộ cache nếu key=None."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+# --- CÁC CACHE DÙNG CHUNG ---
+# fabric_name -> fabrics.id (Worker persist + Sửa phiếu)
+fabric_id_cache = LookupCache("fabric_id", max_size=2048, ttl=600)
+# personnel_id -> full_name (In tem)
+personnel_name_cache = LookupCache("personnel_name", max_size=4096, ttl=1800)
+
+def get_cache_stats():
+    """Thống kê hit/miss của tất cả cache (hiển thị qua /api/system/sync_status)."""
+    return {cache.name: cache.stats() for cache in (fabric_id_cache, personnel_name_cache)}
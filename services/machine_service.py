@@ -2,6 +2,7 @@
 import psycopg2
 import psycopg2.extras
 from services.db_connection import db_get_connection, db_release_connection
+from services.lookup_cache import fabric_id_cache
 
 class MachineService:
     def get_all_weaving_machine_status(self):
@@ -173,9 +174,11 @@ class MachineService:
             res_fab = cursor.fetchone()
             
             new_fabric_id = None
+            created_fabric = False
             if res_fab:
                 new_fabric_id = res_fab[0]
             else:
+                created_fabric = True
                 cursor.execute("""
                     INSERT INTO fabrics (
                         order_number, item_name, fabric_name, fabric_type, warp_lot, weft_lot, notes
@@ -190,6 +193,10 @@ class MachineService:
             cursor.execute("UPDATE inspection_tickets SET fabric_id = %s WHERE deployment_ticket_id = %s", (new_fabric_id, deployment_ticket_id))
             
             conn.commit() 
+
+            # Có Fabric mới -> bỏ cache fabric_name -> id cũ
+            if created_fabric:
+                fabric_id_cache.invalidate(new_fabric_name)
             return True
             
         except Exception as e:
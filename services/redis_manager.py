@@ -2,7 +2,12 @@
 import redis
 import json
 import logging
-from redis.exceptions import ConnectionError, RedisError
+import time
+import threading
+from contextlib import contextmanager
+from redis.exceptions import ConnectionError, RedisError, ResponseError, TimeoutError as RedisTimeoutError
+
+from services.circuit_breaker import CircuitBreaker, STATE_OPEN
 
 # Cấu hình mặc định (Sẽ được ghi đè bởi config.ini từ app.py)
 DEFAULT_HOST = '127.0.0.1'
@@ -10,9 +15,86 @@ DEFAULT_PORT = 6379
 REDIS_DB = 0
 REDIS_PASSWORD = None     # Điền mật khẩu nếu có
 
+# [NEW] Circuit Breaker + Heartbeat: khi Redis đã biết là chết, lệnh thất bại ngay thay vì chờ socket_timeout
+HEARTBEAT_INTERVAL = 2.0        # Giây giữa 2 lần PING nền (ghi đè bởi [Network] REDIS_HEARTBEAT)
+BREAKER_FAILURE_THRESHOLD = 3   # Lỗi kết nối liên tiếp -> ngắt mạch
+BREAKER_RESET_TIMEOUT = 5.0     # Giây ngắt mạch trước lần thăm dò đầu tiên (tăng dần tới 60s)
+
 # Tên Queue cố định
 QUEUE_INSPECTION_NAME = "queue:inspection_data"
 
+# [NEW] Reliable Queue: Danh sách "đang xử lý" riêng cho từng Worker + Heartbeat
+QUEUE_PROCESSING_PREFIX = "queue:inspection_data:processing:"   # + consumer_id (LIST)
+QUEUE_HEARTBEAT_PREFIX = "queue:inspection_data:heartbeat:"     # + consumer_id (STRING, có TTL)
+QUEUE_CONSUMERS_SET = "queue:inspection_data:consumers"         # SET các consumer_id đã đăng ký
+QUEUE_DEAD_LETTER_NAME = "queue:inspection_data:dead"           # Gói tin hỏng (không parse được JSON)
+CONSUMER_HEARTBEAT_TTL = 60                                     # Giây (Worker gia hạn ở luồng nền mỗi TTL/4)
+
+# Lệnh blocking (BLPOP/BLMOVE/XREADGROUP BLOCK) phải trả về TRƯỚC socket_timeout (2s),
+# nếu không client báo Timeout trong khi Server có thể đã chuyển gói tin đi.
+BLOCKING_TIMEOUT_MAX = 1
+
+# [NEW] Redis Streams backend (Consumer Group + XACK + XAUTOCLAIM)
+QUEUE_BACKEND_LIST = "list"
+QUEUE_BACKEND_STREAM = "stream"
+QUEUE_BACKEND = QUEUE_BACKEND_LIST                   # Ghi đè bởi [Queue] BACKEND trong config.ini
+STREAM_INSPECTION_NAME = "stream:inspection_data"
+STREAM_GROUP_NAME = "flis_workers"
+STREAM_DEAD_LETTER_NAME = "stream:inspection_data:dead"
+STREAM_MAXLEN = 100000          # Trim xấp xỉ (MAXLEN ~) để giới hạn bộ nhớ
+STREAM_CLAIM_IDLE_MS = 60000    # Gói tin pending quá 60s (Worker chết) sẽ bị XAUTOCLAIM
+STREAM_MAX_DELIVERIES = 5       # Lỗi dữ liệu lặp lại quá số lần này -> Dead Letter
+STREAM_ERRORS_KEY = "stream:inspection_data:errors"   # HASH msg_id -> lỗi dữ liệu gần nhất (auto_recovery đọc)
+STREAM_ERRORS_TTL = 7 * 24 * 3600                     # Gia hạn mỗi lần ghi; field bị xóa khi ACK / Dead Letter
+
+# --- [NEW] TRẠNG THÁI PHIÊN KIỂM VẢI DÙNG CHUNG (State Backend = redis) ---
+STATE_KEY_PREFIX = "state:station:"          # + station_id (HASH: version, doc, op, ts)
+STATE_STATIONS_SET = "state:stations"        # SET các station_id đang có phiên
+STATE_KEY_TTL = 7 * 24 * 3600                # Phiên bỏ dở quá 7 ngày tự hết hạn
+
+# [NEW] Màn hình giám sát xưởng: trạm phát frame trạng thái gọn, Server tổng hợp
+FLOOR_CHANNEL = "floor:status"               # Pub/Sub: frame JSON của từng trạm
+FLOOR_LATEST_KEY = "floor:latest"            # HASH station_id -> frame JSON mới nhất (Server khởi động lại vẫn có ảnh chụp)
+
+# Lua: Chuyển 1 gói tin từ List cũ sang Stream (Migration, nguyên tử)
+_LUA_LIST_TO_STREAM = """
+local v = redis.call('LPOP', KEYS[1])
+if v then redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], '*', 'payload', v) end
+return v
+"""
+
+# [NEW] Thuê khối số thứ tự mã cây: dùng chung key với get_next_roll_sequence (seq:roll:<prefix>)
+SEQUENCE_KEY_PREFIX = "seq:roll:"
+SEQUENCE_FREE_SUFFIX = ":free"               # LIST "start-end" các khối trạm đã trả lại (chưa dùng)
+SEQUENCE_FREE_TTL = 40 * 24 * 3600           # prefix có yymm -> sau 1 tháng các khối trả lại vô dụng
+
+# Lua: Lấy khối đã trả lại trước, hết thì INCRBY khối mới (nguyên tử, 1 round-trip)
+_LUA_LEASE_SEQUENCE = """
+local v = redis.call('LPOP', KEYS[2])
+if v then return v end
+local last = redis.call('INCRBY', KEYS[1], ARGV[1])
+return (last - tonumber(ARGV[1]) + 1) .. '-' .. last
+"""
+
+# Lua: Trả lại khoảng chưa dùng. Khối cuối cùng (chưa ai thuê sau) -> lùi bộ đếm; ngược lại -> danh sách khối trống
+_LUA_RETURN_SEQUENCE = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current == tonumber(ARGV[2]) then
+    redis.call('SET', KEYS[1], tonumber(ARGV[1]) - 1)
+    return 1
+end
+redis.call('RPUSH', KEYS[2], ARGV[1] .. '-' .. ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 0
+"""
+
+# Lua: LPOP + RPUSH nguyên tử (thay LMOVE cho Redis < 6.2)
+_LUA_MOVE_LEFT_TO_RIGHT = """
+local v = redis.call('LPOP', KEYS[1])
+if v then redis.call('RPUSH', KEYS[2], v) end
+return v
+"""
+
 class RedisManager:
     def __init__(self):
         """
@@ -28,6 +110,18 @@ class RedisManager:
         # Biến chứa Connection Pool và Client
         self.pool = None
         self.client = None
+
+        # Redis >= 6.2 hỗ trợ BLMOVE/LMOVE; tự chuyển sang Lua nếu server cũ hơn
+        self._has_lmove = True
+
+        # Kiểu hàng đợi: 'list' (mặc định) hoặc 'stream'
+        self.queue_backend = QUEUE_BACKEND
+
+        # [NEW] Circuit Breaker + trạng thái sức khỏe do luồng Heartbeat cập nhật
+        self.breaker = CircuitBreaker("redis", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self._healthy = None            # None = chưa kiểm tra lần nào
+        self._last_ping = None          # (thời điểm, độ trễ ms) của lần PING gần nhất
+        self._heartbeat_thread = None
         
         # Khởi tạo kết nối mặc định ngay lập tức
         self._init_connection()
@@ -64,20 +158,99 @@ class RedisManager:
             # Buộc khởi tạo lại kết nối
             self._init_connection()
 
-    def check_connection(self):
+    # ==========================================================
+    # [NEW] CIRCUIT BREAKER / HEARTBEAT
+    # ==========================================================
+    def _record_success(self):
+        if self.breaker.record_success() or self._healthy is False:
+            self.logger.info(f"Redis Server tại {self.redis_host} đã kết nối lại.")
+        self._healthy = True
+
+    def _record_failure(self, error):
+        tripped = self.breaker.record_failure(error)
+        if tripped or self._healthy is not False:
+            # Chỉ log CRITICAL khi chuyển trạng thái (không lặp lại ở mỗi lần gọi)
+            self.logger.error(f"CRITICAL: Không thể kết nối tới Redis Server tại {self.redis_host}! ({error})")
+        self._healthy = False
+
+    @contextmanager
+    def guard(self):
         """
-        Kiểm tra kết nối tới Redis (Health check).
-        Trả về True nếu sống, False nếu chết.
+        Bọc 1 thao tác Redis bằng Circuit Breaker:
+            with redis_manager.guard() as client: client.incr(key)
+        Mạch đang ngắt -> ném ConnectionError ngay (vài micro giây), không chạm tới socket.
+        Chỉ lỗi kết nối / timeout mới tính là thất bại; lỗi lệnh (ResponseError...) thì Redis vẫn sống.
         """
+        if not self.breaker.allow():
+            raise ConnectionError(f"Redis tại {self.redis_host} đang mất kết nối (circuit open)")
+        if not self.client:
+            self._init_connection()
         try:
-            # Nếu vì lý do nào đó client chưa khởi tạo, thử khởi tạo lại
-            if not self.client:
-                self._init_connection()
-            return self.client.ping()
+            yield self.client
+        except (ConnectionError, RedisTimeoutError) as e:
+            self._record_failure(e)
+            raise
+        except RedisError:
+            self._record_success()
+            raise
+        self._record_success()
+
+    def run_pipeline(self, build, transaction=False):
+        """
+        Gom nhiều lệnh vào 1 round-trip (qua Circuit Breaker):
+            results = redis_manager.run_pipeline(lambda p: [p.hget(k, 'v') for k in keys])
+        """
+        with self.guard() as client:
+            pipe = client.pipeline(transaction=transaction)
+            build(pipe)
+            return pipe.execute()
+
+    def ping(self):
+        """PING thật tới Redis (qua Circuit Breaker). Trả về True / False."""
+        try:
+            t0 = time.perf_counter()
+            with self.guard() as client:
+                client.ping()
+            self._last_ping = (time.time(), round((time.perf_counter() - t0) * 1000, 2))
+            return True
         except Exception:
-            self.logger.error(f"CRITICAL: Không thể kết nối tới Redis Server tại {self.redis_host}!")
             return False
 
+    def _heartbeat_loop(self, interval):
+        # Mạch ngắt: guard() từ chối ngay, chỉ cho 1 lần thăm dò khi hết thời gian chờ (half-open)
+        while True:
+            self.ping()
+            time.sleep(interval)
+
+    def start_heartbeat(self, interval=HEARTBEAT_INTERVAL):
+        """Chạy PING nền để check_connection() chỉ đọc trạng thái đã lưu (không I/O trên request)."""
+        if self._heartbeat_thread and self._heartbeat_thread.is_alive():
+            return
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, args=(interval,),
+                                                  daemon=True, name="RedisHeartbeat")
+        self._heartbeat_thread.start()
+
+    def check_connection(self):
+        """
+        Kiểm tra kết nối tới Redis (Health check).
+        Trả về True nếu sống, False nếu chết.
+        [UPDATED] Có Heartbeat: trả về trạng thái đã lưu, không chặn request.
+        Không có Heartbeat (script / Worker): PING qua Circuit Breaker (mạch ngắt -> False ngay).
+        """
+        if self._heartbeat_thread and self._heartbeat_thread.is_alive() and self._healthy is not None:
+            return self._healthy and self.breaker.state != STATE_OPEN
+        return self.ping()
+
+    def get_health(self):
+        """Trạng thái Redis cho /api/system/sync_status."""
+        return {
+            "healthy": self._healthy,
+            "heartbeat": bool(self._heartbeat_thread and self._heartbeat_thread.is_alive()),
+            "last_ping_at": self._last_ping[0] if self._last_ping else None,
+            "last_ping_ms": self._last_ping[1] if self._last_ping else None,
+            "breaker": self.breaker.get_stats(),
+        }
+
     def get_next_roll_sequence(self, prefix):
         """
         Lấy số thứ tự (Sequence) tiếp theo cho mã cây.
@@ -90,14 +263,15 @@ class RedisManager:
         Returns:
             str: Số thứ tự tiếp theo được format 4 chữ số (VD: '0001', '0150').
         """
-        key = f"seq:roll:{prefix}"
+        key = SEQUENCE_KEY_PREFIX + prefix
         try:
             # [REFACTORED] Atomic Increment
             # Lệnh incr thực hiện 2 việc cùng lúc:
             # 1. Nếu key chưa có -> tạo mới = 0
             # 2. Tăng giá trị lên 1 và trả về giá trị mới ngay lập tức
             # Redis xử lý đơn luồng nên không bao giờ bị Duplicate.
-            seq_int = self.client.incr(key)
+            with self.guard() as client:
+                seq_int = client.incr(key)
             
             # Format về chuỗi 4 ký tự (0001, 0002...) theo yêu cầu
             return str(seq_int).zfill(4)
@@ -106,6 +280,26 @@ class RedisManager:
             self.logger.error(f"Redis INCR Error: {str(e)}")
             raise Exception("Lỗi hệ thống: Không thể cấp mã cây (Redis Offline). Vui lòng thử lại.")
 
+    def lease_roll_sequence_block(self, prefix, size):
+        """
+        Thuê 1 khối `size` số thứ tự liên tiếp cho prefix (trạm tự cấp dần, kể cả khi mất Redis).
+        Cùng bộ đếm với get_next_roll_sequence nên không trùng với trạm cấp từng số.
+        Trả về (start, end) - cả 2 đầu đều dùng được.
+        """
+        key = SEQUENCE_KEY_PREFIX + prefix
+        with self.guard() as client:
+            block = client.eval(_LUA_LEASE_SEQUENCE, 2, key, key + SEQUENCE_FREE_SUFFIX, int(size))
+        start, end = (int(part) for part in block.split('-'))
+        return start, end
+
+    def return_roll_sequence_block(self, prefix, start, end):
+        """Trả lại khoảng [start, end] chưa dùng. True nếu bộ đếm được lùi lại, False nếu đưa vào danh sách khối trống."""
+        key = SEQUENCE_KEY_PREFIX + prefix
+        with self.guard() as client:
+            rewound = client.eval(_LUA_RETURN_SEQUENCE, 2, key, key + SEQUENCE_FREE_SUFFIX,
+                                  int(start), int(end), SEQUENCE_FREE_TTL)
+        return bool(rewound)
+
     def push_inspection_data(self, data):
         """
         Đẩy dữ liệu kiểm tra vải vào hàng đợi (Queue) để Worker xử lý sau.
@@ -117,8 +311,14 @@ class RedisManager:
             # Chuyển đổi Dict sang JSON string
             json_data = json.dumps(data)
             
-            # Đẩy vào cuối hàng đợi (Right Push)
-            self.client.rpush(QUEUE_INSPECTION_NAME, json_data)
+            with self.guard() as client:
+                if self.queue_backend == QUEUE_BACKEND_STREAM:
+                    # [NEW] Streams: XADD kèm trim xấp xỉ để giới hạn bộ nhớ
+                    client.xadd(STREAM_INSPECTION_NAME, {"payload": json_data},
+                                maxlen=STREAM_MAXLEN, approximate=True)
+                else:
+                    # Đẩy vào cuối hàng đợi (Right Push)
+                    client.rpush(QUEUE_INSPECTION_NAME, json_data)
             
             return True
         except TypeError as e:
@@ -141,7 +341,7 @@ class RedisManager:
                 return None
                 
             # BLPOP trả về tuple: (queue_name, item) hoặc None nếu timeout
-            result = self.client.blpop(QUEUE_INSPECTION_NAME, timeout=timeout)
+            result = self.client.blpop(QUEUE_INSPECTION_NAME, timeout=min(timeout, BLOCKING_TIMEOUT_MAX))
             if result:
                 json_data = result[1]
                 return json.loads(json_data)
@@ -153,5 +353,484 @@ class RedisManager:
             self.logger.error("Lỗi parse JSON từ Redis Queue.")
             return None
 
+    def pop_inspection_batch(self, max_items=20, timeout=5):
+        """
+        [NEW] Dùng cho Worker chế độ Batch: Lấy tối đa `max_items` gói tin trong 1 chu kỳ.
+        - BLPOP chờ gói đầu tiên (không tốn CPU khi Queue rỗng).
+        - LPOP count lấy tiếp phần còn lại trong 1 round-trip (Redis >= 6.2).
+          Redis cũ hơn: dùng MULTI + LRANGE/LTRIM (vẫn đảm bảo Atomic).
+
+        Returns:
+            list: Danh sách tuple (raw_json, data_dict) theo đúng thứ tự Queue.
+                  Gói tin lỗi JSON bị bỏ qua (ghi log) giống `pop_inspection_data`.
+        """
+        try:
+            if not self.client:
+                return []
+
+            result = self.client.blpop(QUEUE_INSPECTION_NAME, timeout=min(timeout, BLOCKING_TIMEOUT_MAX))
+            if not result:
+                return []
+            raw_items = [result[1]]
+
+            remaining = max_items - 1
+            if remaining > 0:
+                try:
+                    more = self.client.lpop(QUEUE_INSPECTION_NAME, remaining)
+                except ResponseError:
+                    # Redis < 6.2 không hỗ trợ tham số count cho LPOP
+                    pipe = self.client.pipeline(transaction=True)
+                    pipe.lrange(QUEUE_INSPECTION_NAME, 0, remaining - 1)
+                    pipe.ltrim(QUEUE_INSPECTION_NAME, remaining, -1)
+                    more = pipe.execute()[0]
+                if more:
+                    raw_items.extend(more)
+        except RedisError:
+            # Lỗi kết nối Redis (tạm thời) -> Trả về rỗng để Worker thử lại sau
+            return []
+
+        batch = []
+        for raw in raw_items:
+            try:
+                batch.append((raw, json.loads(raw)))
+            except json.JSONDecodeError:
+                self.logger.error(f"Lỗi parse JSON từ Redis Queue (bỏ qua gói tin): {raw[:200]}")
+        return batch
+
+    def requeue_inspection_data(self, raw_items, front=True):
+        """
+        [NEW] Trả các gói tin (JSON string) về lại Queue khi xử lý thất bại.
+        - front=True : Đẩy về ĐẦU hàng đợi, giữ nguyên thứ tự ban đầu (lỗi hạ tầng: DB chết...).
+        - front=False: Đẩy về CUỐI hàng đợi để gói lỗi không chặn các gói phía sau.
+        """
+        if not raw_items:
+            return
+        if front:
+            # LPUSH chèn từng phần tử lên đầu -> đảo ngược để giữ thứ tự
+            self.client.lpush(QUEUE_INSPECTION_NAME, *reversed(raw_items))
+        else:
+            self.client.rpush(QUEUE_INSPECTION_NAME, *raw_items)
+
+    # --- [NEW] RELIABLE QUEUE (In-flight list + ACK) ---
+    def register_consumer(self, consumer_id, ttl=CONSUMER_HEARTBEAT_TTL):
+        """
+        Đăng ký / gia hạn Heartbeat cho một Worker.
+        Worker phải gọi lại hàm này mỗi chu kỳ; nếu Heartbeat hết hạn, Reaper coi Worker đã chết.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(QUEUE_CONSUMERS_SET, consumer_id)
+        pipe.set(QUEUE_HEARTBEAT_PREFIX + consumer_id, int(time.time()), ex=ttl)
+        pipe.execute()
+
+    def unregister_consumer(self, consumer_id):
+        """Worker dừng có kiểm soát: trả các gói đang xử lý về Queue rồi hủy đăng ký."""
+        self._return_inflight(consumer_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.srem(QUEUE_CONSUMERS_SET, consumer_id)
+        pipe.delete(QUEUE_HEARTBEAT_PREFIX + consumer_id)
+        pipe.execute()
+
+    def _move_to_processing(self, processing_key, timeout=None):
+        """
+        Chuyển 1 gói tin từ đầu Queue sang cuối danh sách xử lý của Worker.
+        timeout=None: không chờ. Trả về JSON string hoặc None.
+        """
+        if self._has_lmove:
+            try:
+                if timeout is None:
+                    return self.client.lmove(QUEUE_INSPECTION_NAME, processing_key, 'LEFT', 'RIGHT')
+                return self.client.blmove(QUEUE_INSPECTION_NAME, processing_key, timeout, 'LEFT', 'RIGHT')
+            except ResponseError:
+                self.logger.warning("Redis Server không hỗ trợ LMOVE (< 6.2). Chuyển sang Lua script + polling.")
+                self._has_lmove = False
+
+        # Fallback: Lua nguyên tử nhưng không blocking -> tự polling
+        deadline = time.time() + (timeout or 0)
+        while True:
+            raw = self.client.eval(_LUA_MOVE_LEFT_TO_RIGHT, 2, QUEUE_INSPECTION_NAME, processing_key)
+            if raw is not None or time.time() >= deadline:
+                return raw
+            time.sleep(0.2)
+
+    def reliable_pop_inspection_batch(self, consumer_id, max_items=20, timeout=5):
+        """
+        Lấy tối đa `max_items` gói tin theo chế độ Reliable Queue:
+        gói tin được CHUYỂN (BLMOVE) sang `processing:<consumer_id>` thay vì bị xóa,
+        và chỉ biến mất khỏi Redis khi Worker gọi `ack_inspection_data` sau khi commit DB.
+
+        Returns:
+            list: Danh sách tuple (raw_json, data_dict). Gói tin hỏng JSON được chuyển sang Dead Letter.
+        """
+        processing_key = QUEUE_PROCESSING_PREFIX + consumer_id
+        try:
+            if not self.client:
+                return []
+
+            raw = self._move_to_processing(processing_key, timeout=min(timeout, BLOCKING_TIMEOUT_MAX))
+            if raw is None:
+                return []
+            raw_items = [raw]
+
+            if max_items > 1 and self._has_lmove:
+                # Lấy phần còn lại trong 1 round-trip
+                pipe = self.client.pipeline(transaction=False)
+                for _ in range(max_items - 1):
+                    pipe.lmove(QUEUE_INSPECTION_NAME, processing_key, 'LEFT', 'RIGHT')
+                raw_items.extend(r for r in pipe.execute() if r is not None)
+            else:
+                while len(raw_items) < max_items:
+                    raw = self._move_to_processing(processing_key)
+                    if raw is None:
+                        break
+                    raw_items.append(raw)
+        except RedisError as e:
+            self.logger.error(f"Redis BLMOVE Error: {str(e)}")
+            return []
+
+        batch = []
+        for raw in raw_items:
+            try:
+                batch.append((raw, json.loads(raw)))
+            except json.JSONDecodeError:
+                self.logger.error(f"Lỗi parse JSON từ Redis Queue -> Dead Letter: {raw[:200]}")
+                try:
+                    pipe = self.client.pipeline(transaction=True)
+                    pipe.lrem(processing_key, 1, raw)
+                    pipe.rpush(QUEUE_DEAD_LETTER_NAME, raw)
+                    pipe.execute()
+                except RedisError:
+                    pass # Reaper sẽ trả lại gói tin, lần sau xử lý tiếp
+        return batch
+
+    def ack_inspection_data(self, consumer_id, raw_items):
+        """Xác nhận đã ghi DB thành công: xóa các gói tin khỏi danh sách xử lý."""
+        if not raw_items:
+            return
+        processing_key = QUEUE_PROCESSING_PREFIX + consumer_id
+        pipe = self.client.pipeline(transaction=True)
+        for raw in raw_items:
+            pipe.lrem(processing_key, 1, raw)
+        pipe.execute()
+
+    def nack_inspection_data(self, consumer_id, raw_items, front=True):
+        """
+        Trả các gói tin đang xử lý về Queue (Atomic: LREM + PUSH trong MULTI).
+        front=True giữ nguyên thứ tự ở đầu hàng đợi; front=False đẩy về cuối.
+        """
+        if not raw_items:
+            return
+        processing_key = QUEUE_PROCESSING_PREFIX + consumer_id
+        pipe = self.client.pipeline(transaction=True)
+        for raw in raw_items:
+            pipe.lrem(processing_key, 1, raw)
+        if front:
+            pipe.lpush(QUEUE_INSPECTION_NAME, *reversed(raw_items))
+        else:
+            pipe.rpush(QUEUE_INSPECTION_NAME, *raw_items)
+        pipe.execute()
+
+    def return_own_inflight(self, consumer_id):
+        """
+        Worker gọi đầu mỗi chu kỳ: giữa 2 lô, danh sách xử lý của chính nó phải rỗng.
+        Phần tử còn sót (mất phản hồi BLMOVE do rớt mạng) được trả về ĐẦU Queue.
+        """
+        moved = self._return_inflight(consumer_id)
+        if moved:
+            self.logger.warning(f"Trả {moved} gói tin mồ côi của worker '{consumer_id}' về Queue.")
+        return moved
+
+    def _return_inflight(self, consumer_id):
+        """Trả toàn bộ danh sách xử lý của một consumer về ĐẦU Queue, giữ nguyên thứ tự."""
+        processing_key = QUEUE_PROCESSING_PREFIX + consumer_id
+        moved = 0
+        while True:
+            # Lấy từ CUỐI danh sách xử lý, đẩy lên ĐẦU Queue -> thứ tự được bảo toàn
+            if self._has_lmove:
+                raw = self.client.lmove(processing_key, QUEUE_INSPECTION_NAME, 'RIGHT', 'LEFT')
+            else:
+                raw = self.client.rpoplpush(processing_key, QUEUE_INSPECTION_NAME)
+            if raw is None:
+                return moved
+            moved += 1
+
+    def reap_stale_inflight(self):
+        """
+        Reaper: Tìm các Worker đã chết (Heartbeat hết hạn) và trả gói tin đang xử lý dở về Queue.
+        An toàn khi chạy song song từ nhiều Worker (mỗi lần chuyển 1 phần tử là Atomic).
+        Lưu ý: Gói tin có thể được xử lý lại 2 lần -> persist phải Idempotent (đã dùng UPSERT).
+
+        Returns:
+            int: Số gói tin đã trả về Queue.
+        """
+        total = 0
+        try:
+            for consumer_id in self.client.smembers(QUEUE_CONSUMERS_SET):
+                if self.client.exists(QUEUE_HEARTBEAT_PREFIX + consumer_id):
+                    continue
+                moved = self._return_inflight(consumer_id)
+                self.client.srem(QUEUE_CONSUMERS_SET, consumer_id)
+                if moved:
+                    self.logger.warning(f"Reaper: Trả {moved} gói tin của worker '{consumer_id}' (mất heartbeat) về Queue.")
+                total += moved
+        except RedisError as e:
+            self.logger.error(f"Reaper Error: {str(e)}")
+        return total
+
+    # --- [NEW] STREAMS BACKEND (Consumer Group) ---
+    def ensure_stream_group(self):
+        """Tạo Stream + Consumer Group nếu chưa có (an toàn khi gọi nhiều lần)."""
+        try:
+            self.client.xgroup_create(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def migrate_list_to_stream(self):
+        """
+        Chuyển các gói tin còn tồn trong List cũ (`queue:inspection_data`) sang Stream.
+        Dùng khi chuyển đổi backend: Client cũ có thể vẫn RPUSH vào List trong lúc nâng cấp.
+        """
+        moved = 0
+        while self.client.eval(_LUA_LIST_TO_STREAM, 2, QUEUE_INSPECTION_NAME,
+                               STREAM_INSPECTION_NAME, STREAM_MAXLEN) is not None:
+            moved += 1
+        if moved:
+            self.logger.info(f"Đã chuyển {moved} gói tin từ List sang Stream.")
+        return moved
+
+    def _parse_stream_entries(self, entries):
+        """[(msg_id, fields)] -> [(msg_id, data)]. Gói tin hỏng JSON được đưa vào Dead Letter ngay."""
+        batch = []
+        for msg_id, fields in entries:
+            if not fields:
+                continue # Entry đã bị xóa/trim khỏi Stream
+            raw = fields.get('payload')
+            try:
+                batch.append((msg_id, json.loads(raw)))
+            except (TypeError, json.JSONDecodeError):
+                self.logger.error(f"Lỗi parse JSON từ Stream (id {msg_id}) -> Dead Letter.")
+                self.dead_letter_stream_message(msg_id, raw, "JSON_DECODE_ERROR")
+        return batch
+
+    def stream_read_batch(self, consumer_name, max_items=20, block_ms=5000, own_pending=False):
+        """
+        Lấy tối đa `max_items` gói tin cho một consumer trong Group.
+        Thứ tự ưu tiên:
+          1. own_pending=True: đọc lại các gói của chính consumer này chưa ACK (sau lỗi hạ tầng).
+          2. XAUTOCLAIM: nhận các gói bị bỏ rơi (pending > STREAM_CLAIM_IDLE_MS) của consumer đã chết.
+          3. XREADGROUP '>': gói tin mới (blocking tối đa block_ms).
+
+        Returns:
+            list: Danh sách tuple (msg_id, data_dict).
+        """
+        try:
+            if own_pending:
+                resp = self.client.xreadgroup(STREAM_GROUP_NAME, consumer_name,
+                                              {STREAM_INSPECTION_NAME: '0'}, count=max_items)
+                entries = resp[0][1] if resp else []
+                if entries:
+                    return self._parse_stream_entries(entries)
+
+            claimed = self.client.xautoclaim(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME, consumer_name,
+                                             min_idle_time=STREAM_CLAIM_IDLE_MS, start_id='0-0', count=max_items)
+            entries = list(claimed[1]) if claimed else []
+            if entries:
+                self.logger.warning(f"XAUTOCLAIM: Nhận lại {len(entries)} gói tin bị bỏ rơi.")
+
+            if len(entries) < max_items:
+                resp = self.client.xreadgroup(STREAM_GROUP_NAME, consumer_name,
+                                              {STREAM_INSPECTION_NAME: '>'},
+                                              count=max_items - len(entries),
+                                              block=None if entries else min(block_ms, BLOCKING_TIMEOUT_MAX * 1000))
+                if resp:
+                    entries.extend(resp[0][1])
+            return self._parse_stream_entries(entries)
+        except RedisError as e:
+            self.logger.error(f"Redis XREADGROUP Error: {str(e)}")
+            return []
+
+    def stream_ack(self, msg_ids):
+        """XACK + XDEL: Stream chỉ giữ các gói chưa xử lý xong (MAXLEN chỉ là giới hạn an toàn)."""
+        if not msg_ids:
+            return
+        pipe = self.client.pipeline(transaction=True)
+        pipe.xack(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME, *msg_ids)
+        pipe.xdel(STREAM_INSPECTION_NAME, *msg_ids)
+        pipe.hdel(STREAM_ERRORS_KEY, *msg_ids)
+        pipe.execute()
+
+    def record_stream_errors(self, errors):
+        """Lưu lỗi dữ liệu gần nhất của từng gói pending ({msg_id: error}) để công cụ cứu hộ phân loại."""
+        if not errors:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(STREAM_ERRORS_KEY, mapping={msg_id: str(error)[:500] for msg_id, error in errors.items()})
+        pipe.expire(STREAM_ERRORS_KEY, STREAM_ERRORS_TTL)
+        pipe.execute()
+
+    def get_stream_delivery_counts(self, msg_ids):
+        """Đọc số lần đã giao (times_delivered) của các gói tin pending từ XPENDING."""
+        counts = {}
+        for msg_id in msg_ids:
+            rows = self.client.xpending_range(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME,
+                                              min=msg_id, max=msg_id, count=1)
+            if rows:
+                counts[msg_id] = rows[0]['times_delivered']
+        return counts
+
+    def get_stream_poison_messages(self, min_deliveries, count=100):
+        """
+        Liệt kê các gói pending đã bị giao >= min_deliveries lần (nghi "gói tin độc").
+        last_error: lỗi dữ liệu Worker ghi lần gần nhất (None nếu chỉ bị giao lại do Worker chết / mất kết nối DB).
+        Returns: list of dict {message_id, consumer, times_delivered, last_error, data}
+        """
+        result = []
+        for row in self.client.xpending_range(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME,
+                                              min='-', max='+', count=count):
+            if row['times_delivered'] < min_deliveries:
+                continue
+            entries = self.client.xrange(STREAM_INSPECTION_NAME, min=row['message_id'],
+                                         max=row['message_id'], count=1)
+            if not entries:
+                continue
+            try:
+                data = json.loads(entries[0][1].get('payload'))
+            except (TypeError, json.JSONDecodeError):
+                data = None
+            result.append({
+                "message_id": row['message_id'],
+                "consumer": row['consumer'],
+                "times_delivered": row['times_delivered'],
+                "last_error": self.client.hget(STREAM_ERRORS_KEY, row['message_id']),
+                "data": data,
+            })
+        return result
+
+    def stream_remove_consumer(self, consumer_name):
+        """Xóa consumer khỏi Group khi dừng có kiểm soát (chỉ khi không còn gói pending)."""
+        pending = self.client.xpending_range(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME,
+                                             min='-', max='+', count=1, consumername=consumer_name)
+        if not pending:
+            self.client.xgroup_delconsumer(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME, consumer_name)
+
+    def dead_letter_stream_message(self, msg_id, raw_payload, reason, deliveries=None):
+        """Chuyển gói tin độc sang Dead Letter Stream và ACK để không bị giao lại nữa."""
+        fields = {
+            "payload": raw_payload or "",
+            "original_id": msg_id,
+            "reason": str(reason)[:500],
+            "deliveries": deliveries if deliveries is not None else "",
+            "dead_at": int(time.time()),
+        }
+        pipe = self.client.pipeline(transaction=True)
+        pipe.xadd(STREAM_DEAD_LETTER_NAME, fields, maxlen=STREAM_MAXLEN, approximate=True)
+        pipe.xack(STREAM_INSPECTION_NAME, STREAM_GROUP_NAME, msg_id)
+        pipe.xdel(STREAM_INSPECTION_NAME, msg_id)
+        pipe.hdel(STREAM_ERRORS_KEY, msg_id)
+        pipe.execute()
+
+    # ==========================================================
+    # [NEW] TRẠNG THÁI PHIÊN DÙNG CHUNG (Optimistic Locking: WATCH/MULTI + version)
+    # ==========================================================
+    def get_station_state_version(self, station_id):
+        """Version hiện tại của phiên (None nếu trạm không có phiên)."""
+        with self.guard() as client:
+            version = client.hget(STATE_KEY_PREFIX + station_id, "version")
+        return int(version) if version is not None else None
+
+    def get_station_state(self, station_id):
+        """Trả về (version, doc_json) hoặc (None, None)."""
+        with self.guard() as client:
+            version, doc = client.hmget(STATE_KEY_PREFIX + station_id, "version", "doc")
+        if version is None:
+            return None, None
+        return int(version), doc
+
+    def save_station_state(self, station_id, doc_json, expected_version, op=None):
+        """
+        Ghi phiên với kiểm tra version (Compare-And-Set).
+        expected_version = None nghĩa là phiên chưa tồn tại trên Redis.
+        Trả về version mới, hoặc None nếu bị xung đột (tiến trình khác đã ghi trước).
+        """
+        key = STATE_KEY_PREFIX + station_id
+        with self.guard() as client, client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.hget(key, "version")
+                current = int(current) if current is not None else None
+                if current != expected_version:
+                    pipe.unwatch()
+                    return None
+
+                new_version = (current or 0) + 1
+                pipe.multi()
+                pipe.hset(key, mapping={"version": new_version, "doc": doc_json, "op": op or "", "ts": time.time()})
+                pipe.expire(key, STATE_KEY_TTL)
+                pipe.sadd(STATE_STATIONS_SET, station_id)
+                pipe.execute()
+                return new_version
+            except redis.WatchError:
+                return None
+
+    def delete_station_state(self, station_id, expected_version):
+        """Xóa phiên (end_session) với kiểm tra version. Trả về False nếu xung đột."""
+        key = STATE_KEY_PREFIX + station_id
+        with self.guard() as client, client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.hget(key, "version")
+                current = int(current) if current is not None else None
+                if current is not None and current != expected_version:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                pipe.srem(STATE_STATIONS_SET, station_id)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def list_station_states(self):
+        """Tất cả phiên đang lưu: {station_id: (version, doc_json)} (màn hình giám sát)."""
+        with self.guard() as client:
+            stations = sorted(client.smembers(STATE_STATIONS_SET))
+        if not stations:
+            return {}
+        rows = self.run_pipeline(lambda pipe: [pipe.hmget(STATE_KEY_PREFIX + sid, "version", "doc") for sid in stations])
+        result = {}
+        stale = []
+        for station_id, (version, doc) in zip(stations, rows):
+            if version is None:
+                stale.append(station_id)   # Key đã hết hạn TTL
+                continue
+            result[station_id] = (int(version), doc)
+        if stale:
+            with self.guard() as client:
+                client.srem(STATE_STATIONS_SET, *stale)
+        return result
+
+    # ==========================================================
+    # [NEW] TRẠNG THÁI XƯỞNG (Pub/Sub + frame mới nhất của mỗi trạm)
+    # ==========================================================
+    def publish_floor_status(self, station_id, frame_json):
+        """Lưu frame mới nhất của trạm và phát lên kênh giám sát. Trả về số subscriber nhận được."""
+        results = self.run_pipeline(lambda pipe: (pipe.hset(FLOOR_LATEST_KEY, station_id, frame_json),
+                                                  pipe.publish(FLOOR_CHANNEL, frame_json)))
+        return results[1]
+
+    def get_floor_snapshot(self):
+        """{station_id: frame_json} của tất cả trạm đã từng phát."""
+        with self.guard() as client:
+            return client.hgetall(FLOOR_LATEST_KEY)
+
+    def subscribe_floor_status(self):
+        """PubSub đã đăng ký kênh giám sát (đọc bằng get_message(timeout=...))."""
+        if not self.client:
+            self._init_connection()
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(FLOOR_CHANNEL)
+        return pubsub
+
 # Khởi tạo một instance duy nhất
 redis_manager = RedisManager()
\ No newline at end of file
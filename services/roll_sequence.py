@@ -0,0 +1,204 @@
+# --- File: services/roll_sequence.py ---
+"""
+Cấp số thứ tự mã cây (prefix + 4 số) cho trạm - 1 chỗ duy nhất thay cho chuỗi fallback lặp lại ở các route.
+- Có Redis: thuê trước khối `block_size` số (INCRBY trên seq:roll:<prefix>), lưu vào SQLite (sequence_leases),
+  rồi cấp từng số từ khối trong bộ nhớ (+1 lệnh ghi SQLite) -> không còn round-trip mạng mỗi lần tạo cây.
+- Khối còn <= `low_water` số: thuê thêm khối kế tiếp ở luồng nền.
+- Mất Redis: tiếp tục cấp từ khối đã thuê (không trùng giữa các trạm). Hết khối mới dùng fallback cũ
+  (Server DB, rồi CSDL cục bộ) - 2 nguồn này có thể trùng giữa các trạm nên được ghi cảnh báo.
+- Khối của tháng cũ (prefix yymm khác tháng hiện tại) và phần dư khi tắt ứng dụng được trả lại Redis.
+"""
+import logging
+import threading
+from datetime import datetime
+
+from local_db_manager import local_db_manager
+from services.redis_manager import redis_manager
+from services.inspection_service import inspection_service
+
+DEFAULT_BLOCK_SIZE = 20
+DEFAULT_LOW_WATER = 5
+
+logger = logging.getLogger(__name__)
+
+class RollSequenceAllocator:
+    def __init__(self, redis_manager, local_db, server_fallback=None,
+                 block_size=DEFAULT_BLOCK_SIZE, low_water=DEFAULT_LOW_WATER):
+        self.redis_manager = redis_manager
+        self.local_db = local_db
+        self.server_fallback = server_fallback     # callable(prefix) -> int | None
+        self.block_size = block_size
+        self.low_water = low_water
+
+        self._lock = threading.Lock()
+        self._leases = None         # prefix -> [[start, end, next], ...] (nạp từ SQLite lần đầu dùng)
+        self._refilling = set()
+
+        # Thống kê
+        self.issued = 0
+        self.leased_blocks = 0
+        self.returned_blocks = 0
+        self.fallback_server = 0
+        self.fallback_local = 0
+        self.lease_errors = 0
+
+    def configure(self, block_size=None, low_water=None):
+        if block_size:
+            self.block_size = max(1, int(block_size))
+        if low_water is not None:
+            self.low_water = max(0, int(low_water))
+
+    def _load(self):
+        """Gọi khi đang giữ lock."""
+        if self._leases is None:
+            self._leases = {}
+            for row in self.local_db.load_sequence_leases():
+                self._leases.setdefault(row['prefix'], []).append([row['start_seq'], row['end_seq'], row['next_seq']])
+
+    def _take(self, prefix):
+        """Lấy 1 số từ khối nhỏ nhất của prefix (gọi khi đang giữ lock). Ghi SQLite TRƯỚC khi trả số."""
+        blocks = self._leases.get(prefix)
+        while blocks:
+            block = blocks[0]
+            start, end, seq = block
+            if seq >= end:
+                # Số cuối của khối (hoặc khối đã hết): xóa khối = ghi nhận đã cấp
+                self.local_db.delete_sequence_lease(prefix, start)
+                blocks.pop(0)
+                if seq > end:
+                    continue
+            else:
+                self.local_db.advance_sequence_lease(prefix, start, seq + 1)
+                block[2] = seq + 1
+            return seq
+        return None
+
+    def _remaining(self, prefix):
+        return sum(end - seq + 1 for _, end, seq in self._leases.get(prefix) or ())
+
+    def _lease(self, prefix):
+        """Thuê 1 khối mới từ Redis (ngoài lock: có I/O mạng)."""
+        start, end = self.redis_manager.lease_roll_sequence_block(prefix, self.block_size)
+        self.local_db.add_sequence_lease(prefix, start, end)
+        with self._lock:
+            self._load()
+            blocks = self._leases.setdefault(prefix, [])
+            blocks.append([start, end, start])
+            blocks.sort()
+            self.leased_blocks += 1
+        logger.info(f"[SEQUENCE] Đã thuê khối {prefix}: {start:04d} - {end:04d}")
+
+    def _refill(self, prefix):
+        try:
+            self._lease(prefix)
+            self.release_stale()
+        except Exception as e:
+            self.lease_errors += 1
+            logger.warning(f"[SEQUENCE] Không thuê thêm được khối cho {prefix}: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(prefix)
+
+    def _refill_async(self, prefix):
+        with self._lock:
+            if prefix in self._refilling:
+                return
+            self._refilling.add(prefix)
+        threading.Thread(target=self._refill, args=(prefix,), daemon=True, name="SequenceLease").start()
+
+    def _fallback(self, prefix):
+        """Hết khối và không thuê được: nguồn cũ (có thể trùng giữa các trạm)."""
+        sequence = None
+        if self.server_fallback:
+            try:
+                sequence = self.server_fallback(prefix)
+            except Exception as e:
+                logger.error(f"DB SEQUENCE ERROR: {e}")
+        if sequence is not None:
+            self.fallback_server += 1
+        else:
+            sequence = self.local_db.get_next_sequence_by_prefix(prefix) or 1
+            self.fallback_local += 1
+        logger.warning(f"[SEQUENCE] Không còn khối đã thuê cho {prefix}, dùng số dự phòng {sequence} (có thể trùng giữa các trạm)")
+        return int(sequence)
+
+    def next_sequence(self, prefix):
+        with self._lock:
+            self._load()
+            sequence = self._take(prefix)
+            remaining = self._remaining(prefix)
+            if sequence is not None:
+                self.issued += 1
+        if sequence is not None:
+            if remaining <= self.low_water:
+                self._refill_async(prefix)
+            return sequence
+
+        # Chưa có / hết khối: thuê ngay (Redis mất kết nối -> Circuit Breaker từ chối tức thì)
+        try:
+            self._lease(prefix)
+        except Exception as e:
+            self.lease_errors += 1
+            logger.error(f"REDIS SEQUENCE ERROR: {e}")
+        else:
+            with self._lock:
+                sequence = self._take(prefix)
+                if sequence is not None:
+                    self.issued += 1
+            if sequence is not None:
+                return sequence
+        return self._fallback(prefix)
+
+    def next_roll_code(self, prefix):
+        """Mã cây đầy đủ: prefix + 4 số (VD: 2601ABC0007)."""
+        return f"{prefix}{self.next_sequence(prefix):04d}"
+
+    def _release(self, predicate):
+        """Trả lại Redis phần chưa cấp của các khối có prefix thỏa predicate. Lỗi -> giữ khối, lần sau thử lại."""
+        with self._lock:
+            self._load()
+            taken = []
+            for prefix in [p for p in self._leases if predicate(p)]:
+                taken.extend((prefix, block) for block in self._leases.pop(prefix))
+        released = 0
+        for prefix, (start, end, seq) in taken:
+            try:
+                if seq <= end:
+                    self.redis_manager.return_roll_sequence_block(prefix, seq, end)
+                self.local_db.delete_sequence_lease(prefix, start)
+                released += 1
+            except Exception as e:
+                logger.warning(f"[SEQUENCE] Chưa trả được khối {prefix} {seq:04d}-{end:04d}: {e}")
+                with self._lock:
+                    blocks = self._leases.setdefault(prefix, [])
+                    blocks.append([start, end, seq])
+                    blocks.sort()
+        with self._lock:
+            self.returned_blocks += released
+        return released
+
+    def release_stale(self, now=None):
+        """Trả các khối thuộc tháng cũ (4 ký tự đầu prefix = yymm)."""
+        current = (now or datetime.now()).strftime('%y%m')
+        return self._release(lambda prefix: not prefix.startswith(current))
+
+    def release_all(self):
+        """Trả toàn bộ phần chưa cấp (gọi khi tắt ứng dụng)."""
+        return self._release(lambda prefix: True)
+
+    def get_stats(self):
+        with self._lock:
+            leases = {prefix: self._remaining(prefix) for prefix in self._leases or {}}
+            return {
+                "block_size": self.block_size,
+                "low_water": self.low_water,
+                "available": leases,
+                "issued": self.issued,
+                "leased_blocks": self.leased_blocks,
+                "returned_blocks": self.returned_blocks,
+                "fallback_server": self.fallback_server,
+                "fallback_local": self.fallback_local,
+                "lease_errors": self.lease_errors,
+            }
+
+roll_sequence = RollSequenceAllocator(redis_manager, local_db_manager, inspection_service.get_next_sequence_from_server)
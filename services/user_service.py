@@ -2,6 +2,7 @@
 import psycopg2.extras
 import logging
 from services.db_connection import db_get_connection, db_release_connection
+from services.lookup_cache import personnel_name_cache
 
 # Setup basic logging
 logger = logging.getLogger(__name__)
@@ -37,6 +38,28 @@ class UserService:
             if conn:
                 db_release_connection(conn)
 
+    def get_personnel_name(self, personnel_id):
+        """
+        [NEW] Lấy họ tên nhân sự (dùng khi in tem). Có cache LRU/TTL trong tiến trình.
+        Trả về None nếu không tìm thấy hoặc lỗi DB.
+        """
+        def _load():
+            conn = None
+            try:
+                conn = db_get_connection()
+                cursor = conn.cursor()
+                cursor.execute("SELECT full_name FROM personnel WHERE personnel_id = %s", (personnel_id,))
+                res = cursor.fetchone()
+                return res[0] if res else None
+            except Exception as e:
+                logger.error(f"Error in get_personnel_name for {personnel_id}: {e}")
+                return None
+            finally:
+                if conn:
+                    db_release_connection(conn)
+
+        return personnel_name_cache.get_or_load(personnel_id, _load)
+
     def get_worker_info_by_barcode(self, barcode):
         """
         Lấy thông tin nhanh qua việc quét mã vạch.
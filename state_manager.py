@@ -1,9 +1,192 @@
 # --- File: state_manager.py (FULL & UPDATED) ---
-import copy
+import functools
+import time
+from collections import OrderedDict, Counter
+
+from state_store import StateStore, StateConflictError
+
+# Số lần chạy lại 1 thao tác khi backend dùng chung (Redis) báo xung đột version
+CONFLICT_RETRIES = 3
+# Đọc phiên từ backend dùng chung: chỉ hỏi lại version nếu lần đồng bộ gần nhất cũ hơn ngần này (giây).
+# Ghi vẫn an toàn vì CAS ở backend báo xung đột và @_optimistic nạp lại ngay.
+STATE_REFRESH_TTL = 1.0
+
+def _optimistic(method):
+    """
+    Chạy lại thao tác khi backend báo StateConflictError: nạp lại phiên mới nhất rồi thử lại.
+    Thay đổi trên bản cũ bị bỏ đi vì refresh thay thế toàn bộ dict của trạm
+    (kể cả lần thử cuối: cache cục bộ không bị lệch khỏi backend khi ném lỗi ra ngoài).
+    """
+    @functools.wraps(method)
+    def wrapper(self, station_id, *args, **kwargs):
+        for attempt in range(CONFLICT_RETRIES):
+            try:
+                return method(self, station_id, *args, **kwargs)
+            except StateConflictError:
+                self._refresh(station_id)
+                if attempt == CONFLICT_RETRIES - 1:
+                    raise
+    return wrapper
+
+def _copy_errors(errors):
+    """Sao chép danh sách lỗi (mỗi lỗi là dict phẳng -> copy nông từng phần tử, không cần deepcopy)."""
+    return [dict(e) for e in (errors or [])]
+
+class DefectIndex:
+    """
+    Chỉ mục lỗi cho công nhân đang làm việc, đi kèm (không thay thế) list `current_errors` trong state.
+    - by_id: OrderedDict error_id -> entry (cùng object với phần tử trong list).
+    - Bộ đếm theo loại lỗi, tổng điểm, số lỗi / điểm chưa sửa: cập nhật tăng dần, không tính lại cả list.
+    List trong state vẫn là nguồn dữ liệu để serialize (Journal/Redis) và trả về Frontend.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        self.by_id = OrderedDict()
+        self.type_counts = Counter()
+        self.total_points = 0
+        self.open_count = 0
+        self.open_points = 0
+        for entry in errors:
+            self._index(entry)
+
+    @staticmethod
+    def _points(entry):
+        try:
+            return int(entry.get('points', 1) or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def _index(self, entry):
+        self.by_id[str(entry.get('id'))] = entry
+        points = self._points(entry)
+        self.type_counts[entry.get('error_type')] += 1
+        self.total_points += points
+        if not entry.get('is_fixed'):
+            self.open_count += 1
+            self.open_points += points
+
+    def _unindex(self, entry):
+        points = self._points(entry)
+        error_type = entry.get('error_type')
+        self.type_counts[error_type] -= 1
+        if self.type_counts[error_type] <= 0:
+            del self.type_counts[error_type]
+        self.total_points -= points
+        if not entry.get('is_fixed'):
+            self.open_count -= 1
+            self.open_points -= points
+
+    def is_current_for(self, errors):
+        """Chỉ mục còn khớp với list hay không (list bị thay thế sau refresh / end shift / route sửa trực tiếp)."""
+        return self.errors is errors and len(self.by_id) == len(errors)
+
+    def add(self, entry):
+        self.errors.append(entry)
+        self._index(entry)
+
+    def remove(self, error_id):
+        entry = self.by_id.pop(str(error_id), None)
+        if entry is None:
+            return None
+        self._unindex(entry)
+        # Thường là lỗi vừa bấm nhầm -> tìm từ cuối list, so sánh định danh object (không so sánh dict)
+        for i in range(len(self.errors) - 1, -1, -1):
+            if self.errors[i] is entry:
+                del self.errors[i]
+                break
+        return entry
+
+    def mark_fixed(self, error_id):
+        entry = self.by_id.get(str(error_id))
+        if entry is None or entry.get('is_fixed'):
+            return entry
+        entry['is_fixed'] = True
+        self.open_count -= 1
+        self.open_points -= self._points(entry)
+        return entry
+
+    def summary(self):
+        return {
+            "total_count": len(self.by_id),
+            "total_points": self.total_points,
+            "open_count": self.open_count,
+            "open_points": self.open_points,
+            "fixed_count": len(self.by_id) - self.open_count,
+            "by_type": dict(self.type_counts),
+        }
 
 class InspectionState:
-    def __init__(self):
+    def __init__(self, store=None):
         self._states = {}
+        self._store = store or StateStore()
+        self._defect_index = {}   # station_id -> DefectIndex của công nhân hiện tại
+        self._refreshed = {}      # station_id -> time.monotonic() lần đồng bộ gần nhất với backend
+
+    # --- BACKEND LƯU TRẠNG THÁI ---
+    def attach_store(self, store):
+        """
+        Gắn backend lưu trạng thái (VD: JournalStateStore) và khôi phục các phiên đã lưu.
+        Trả về số phiên được khôi phục.
+        """
+        self._store = store
+        self._refreshed.clear()
+        restored = store.load_all()
+        self._states.update(restored)
+        return len(restored)
+
+    def _commit(self, station_id, op):
+        """
+        Tăng version của phiên rồi ghi xuống backend. Lỗi ghi không làm hỏng thao tác trên RAM.
+        Version giúp Frontend biết bản state của mình có còn khớp để áp dụng delta hay không.
+        """
+        try:
+            state = self._states.get(station_id)
+            if state is not None:
+                state['version'] = state.get('version', 0) + 1
+            if state is None:
+                self._store.delete(station_id, op)
+            else:
+                self._store.save(station_id, state, op)
+            self._refreshed[station_id] = time.monotonic()
+        except StateConflictError:
+            raise
+        except Exception as e:
+            print(f"[STATE STORE] Lỗi lưu trạng thái trạm {station_id} ({op}): {e}")
+
+    @staticmethod
+    def _delta(state, op, **changes):
+        """
+        Mô tả thay đổi của 1 thao tác (trả về cho route thay vì toàn bộ state).
+        changes có thể gồm: worker (header CN hiện tại, không kèm lỗi, None = không còn CN),
+        errors (thay toàn bộ list lỗi), errors_added, errors_removed, errors_updated,
+        completed_worker_added (không kèm lỗi: client lấy từ list lỗi hiện tại), last_end_meter.
+        """
+        version = state.get('version', 0)
+        return {"delta": True, "op": op, "base_version": version - 1, "version": version, "changes": changes}
+
+    @staticmethod
+    def _worker_header(details):
+        return {k: v for k, v in details.items() if k != 'current_errors'}
+
+    @property
+    def backend_name(self):
+        return self._store.name
+
+    def get_all_states(self):
+        """Tất cả phiên đang hoạt động (màn hình giám sát). Backend dùng chung: đọc từ Redis."""
+        if self._store.shared:
+            # Cập nhật luôn cache cục bộ để version và dữ liệu luôn đi cùng nhau
+            self._states.update(self._store.load_all())
+        return dict(self._states)
+
+    def _get_defect_index(self, station_id, details):
+        """Lấy chỉ mục lỗi của công nhân hiện tại; dựng lại nếu list current_errors đã đổi."""
+        errors = details['current_errors']
+        index = self._defect_index.get(station_id)
+        if index is None or not index.is_current_for(errors):
+            index = DefectIndex(errors)
+            self._defect_index[station_id] = index
+        return index
 
     def _get_default_state_v2(self):
         """
@@ -35,6 +218,7 @@ class InspectionState:
             "initial_error_count": 0       # Tổng số lỗi ban đầu
         }
 
+    @_optimistic
     def start_session_v2(self, station_id, machine_id, ticket_id, fabric_name, inspector_id, order_number, deployment_ticket_id, current_meter, roll_code=None):
         """
         Khởi tạo một phiên làm việc ONLINE (Dệt mới).
@@ -53,8 +237,10 @@ class InspectionState:
         state["is_manual"] = False
         state["last_end_meter"] = 0 
         
+        self._commit(station_id, "start_session")
         print(f"SESSION V2 (ONLINE) STARTED for station {station_id}. Roll Code: {roll_code}")
 
+    @_optimistic
     def start_manual_session(self, station_id, ticket_id, inspector_id, machine_id, order_number, fabric_name, roll_code=None):
         """
         Khởi tạo một phiên làm việc THỦ CÔNG.
@@ -73,9 +259,11 @@ class InspectionState:
         state["is_manual"] = True
         state["last_end_meter"] = 0 
         
+        self._commit(station_id, "start_manual_session")
         print(f"SESSION (MANUAL) STARTED for station {station_id}. Roll Code: {roll_code}")
 
     # --- HÀM START REPAIR SESSION (CẬP NHẬT: THÊM STANDARD_ID & LOGIC WORKER NONE) ---
+    @_optimistic
     def start_repair_session(self, station_id, ticket_id, roll_code, fabric_name, machine_id, order_number, repair_worker, existing_errors, standard_id):
         """
         Khởi tạo phiên làm việc SỬA CHỮA (Repair Mode).
@@ -109,7 +297,7 @@ class InspectionState:
         state["is_repair_mode"] = True
         
         # 4. Xử lý dữ liệu lỗi cũ
-        errors_backup = copy.deepcopy(existing_errors)
+        errors_backup = _copy_errors(existing_errors)
         state["original_errors"] = errors_backup
         state["initial_error_count"] = len(errors_backup)
 
@@ -120,13 +308,15 @@ class InspectionState:
                 "worker": repair_worker,
                 "shift": "REPAIR", 
                 "start_meter": 0,
-                "current_errors": copy.deepcopy(existing_errors) 
+                "current_errors": _copy_errors(errors_backup)
             }
         else:
             state["current_worker_details"] = None
         
+        self._commit(station_id, "start_repair_session")
         print(f"REPAIR SESSION STARTED. Station: {station_id}. Standard ID: {standard_id}. Worker assigned: {repair_worker is not None}")
 
+    @_optimistic
     def clone_session_for_split(self, station_id, new_ticket_id, roll_code=None):
         """
         Nhân bản phiên làm việc cho chức năng Tách Cây.
@@ -156,16 +346,20 @@ class InspectionState:
         
         # Xử lý công nhân
         if old_state.get('current_worker_details'):
-            worker_clone = copy.deepcopy(old_state['current_worker_details'])
+            # Cây mới bắt đầu với danh sách lỗi rỗng -> không cần sao chép lỗi của cây cũ
+            worker_clone = dict(old_state['current_worker_details'])
+            worker_clone['worker'] = dict(worker_clone['worker'])
             worker_clone['start_meter'] = 0      
             worker_clone['current_errors'] = []  
             new_state['current_worker_details'] = worker_clone
         
         self._states[station_id] = new_state
+        self._commit(station_id, "split_roll")
         print(f"SESSION CLONED (SPLIT) for station {station_id}. New Ticket: {new_ticket_id}")
         
         return new_state
 
+    @_optimistic
     def finalize_unassigned_meters(self, station_id, current_machine_meter):
         state = self.get_state(station_id)
         if not state or not state['active']: return
@@ -188,8 +382,10 @@ class InspectionState:
             }
             state['completed_workers_log'].append(orphan_entry)
             state['last_end_meter'] = current_machine_meter
+            self._commit(station_id, "finalize_unassigned_meters")
             print(f"[GAP HANDLED] Station {station_id}: {gap:.2f}m")
 
+    @_optimistic
     def assign_new_worker(self, station_id, worker_info, shift, start_meter):
         state = self.get_state(station_id)
         if not state or not state['active']:
@@ -200,7 +396,8 @@ class InspectionState:
             if current_details['worker'].get('id') == "UNASSIGNED":
                 current_details['worker'] = worker_info
                 current_details['shift'] = shift
-                return
+                self._commit(station_id, "assign_worker")
+                return self._delta(state, "assign_worker", worker=self._worker_header(current_details))
             else:
                 raise ValueError("Đã có công nhân đang làm việc. Phải kết thúc ca trước.")
             
@@ -209,7 +406,7 @@ class InspectionState:
         # [REPAIR MODE] Load lại lỗi gốc nếu người mới vào sửa từ đầu
         initial_errors_for_worker = []
         if state.get('is_repair_mode') and not state['completed_workers_log']:
-             initial_errors_for_worker = copy.deepcopy(state.get('original_errors', []))
+             initial_errors_for_worker = _copy_errors(state.get('original_errors'))
 
         state['current_worker_details'] = {
             "worker": worker_info,
@@ -217,7 +414,11 @@ class InspectionState:
             "start_meter": continuous_start_meter, 
             "current_errors": initial_errors_for_worker
         }
+        self._commit(station_id, "assign_worker")
+        details = state['current_worker_details']
+        return self._delta(state, "assign_worker", worker=self._worker_header(details), errors=details['current_errors'])
 
+    @_optimistic
     def complete_current_worker_shift(self, station_id, meters_g1, meters_g2, end_meter):
         state = self.get_state(station_id)
         if not state or not state.get('current_worker_details'):
@@ -244,17 +445,22 @@ class InspectionState:
         state['last_end_meter'] = end_meter
         state['completed_workers_log'].append(completed_log_entry)
         state['current_worker_details'] = None 
+        self._commit(station_id, "end_shift")
+        completed_header = {k: v for k, v in completed_log_entry.items() if k != 'errors'}
+        return self._delta(state, "end_shift", worker=None, completed_worker_added=completed_header, last_end_meter=end_meter)
 
+    @_optimistic
     def log_error_for_current_worker(self, station_id, error_entry):
         state = self.get_state(station_id)
         if not state: raise ValueError("Không có phiên làm việc.")
         
-        if not state.get('current_worker_details'):
+        created_details = not state.get('current_worker_details')
+        if created_details:
             continuous_start_meter = state.get('last_end_meter', 0)
             initial_errors = []
             # [REPAIR MODE] Load lỗi cũ nếu log lỗi khi chưa ai đăng nhập
             if state.get('is_repair_mode'):
-                initial_errors = copy.deepcopy(state.get('original_errors', []))
+                initial_errors = _copy_errors(state.get('original_errors'))
 
             state['current_worker_details'] = {
                 "worker": {"id": "UNASSIGNED", "name": "Chưa phân công"},
@@ -267,27 +473,98 @@ class InspectionState:
         if state.get('is_repair_mode'):
             error_entry['is_new'] = True
 
-        state['current_worker_details']['current_errors'].append(error_entry)
+        details = state['current_worker_details']
+        self._get_defect_index(station_id, details).add(error_entry)
+        self._commit(station_id, "log_error")
+        if created_details:
+            return self._delta(state, "log_error", worker=self._worker_header(details), errors=details['current_errors'])
+        return self._delta(state, "log_error", errors_added=[error_entry])
 
+    @_optimistic
     def delete_error_for_current_worker(self, station_id, error_id_to_delete):
         state = self.get_state(station_id)
         if state and state.get('current_worker_details'):
-            errors_list = state['current_worker_details']['current_errors']
-            state['current_worker_details']['current_errors'] = [
-                e for e in errors_list if str(e.get('id')) != str(error_id_to_delete)
-            ]
+            index = self._get_defect_index(station_id, state['current_worker_details'])
+            removed = index.remove(error_id_to_delete)
+            if removed is not None:
+                self._commit(station_id, "delete_error")
+                return self._delta(state, "delete_error", errors_removed=[removed.get('id')])
+        return None
+
+    @_optimistic
+    def mark_error_fixed(self, station_id, error_id):
+        """[REPAIR MODE] Đánh dấu lỗi đã sửa. Trả về True nếu tìm thấy lỗi."""
+        state = self.get_state(station_id)
+        if not state or not state.get('current_worker_details'):
+            return False
+        index = self._get_defect_index(station_id, state['current_worker_details'])
+        if index.mark_fixed(error_id) is None:
+            return False
+        self._commit(station_id, "mark_fixed")
+        return True
+
+    def get_defect_summary(self, station_id):
+        """Tổng hợp lỗi của công nhân hiện tại (số lỗi, điểm, lỗi chưa sửa, theo loại)."""
+        state = self.get_state(station_id)
+        if not state or not state.get('current_worker_details'):
+            return DefectIndex([]).summary()
+        return self._get_defect_index(station_id, state['current_worker_details']).summary()
+
+    def _refresh(self, station_id):
+        self._store.refresh(station_id, self._states)
+        self._refreshed[station_id] = time.monotonic()
 
-    def get_state(self, station_id):
+    def get_state(self, station_id, max_age=STATE_REFRESH_TTL):
+        """
+        Phiên của trạm. Backend dùng chung (Redis) chỉ được hỏi lại khi bản cache cũ hơn `max_age` giây
+        (max_age=0: luôn đồng bộ); backend cục bộ không cần đồng bộ.
+        """
+        if self._store.shared:
+            last = self._refreshed.get(station_id)
+            if last is None or time.monotonic() - last >= max_age:
+                self._refresh(station_id)
         return self._states.get(station_id)
         
+    @_optimistic
     def end_session(self, station_id):
-        if station_id in self._states:
+        if self.get_state(station_id) is not None:
             del self._states[station_id]
+            self._defect_index.pop(station_id, None)
+            self._commit(station_id, "end_session")
             print(f"SESSION ENDED for station {station_id}")
     
-    def update_fabric_name(self, station_id, new_fabric_name):
+    @_optimistic
+    def update_fabric_name(self, station_id, new_fabric_name, roll_code=None):
+        """Đổi loại vải (kèm mã cây mới nếu có) trong 1 lần ghi."""
         state = self.get_state(station_id)
         if state and state['active']:
             state['fabric_name'] = new_fabric_name
+            if roll_code:
+                state['roll_code'] = roll_code
+            self._commit(station_id, "update_fabric")
+        return state
+
+    @_optimistic
+    def update_settings(self, station_id, standard_id, unit='m', min_length=0):
+        """Cập nhật tiêu chuẩn / đơn vị / chiều dài tối thiểu của phiên. Không có phiên -> None."""
+        state = self.get_state(station_id)
+        if not state:
+            return None
+        state['standard_id'] = standard_id
+        state['unit'] = unit
+        state['min_length'] = min_length
+        self._commit(station_id, "update_settings")
+        return state
+
+    @_optimistic
+    def downgrade(self, station_id, notes=''):
+        """Hạ loại cây đang kiểm (ghi chú nối thêm). Không có phiên đang chạy -> None."""
+        state = self.get_state(station_id)
+        if not state or not state['active']:
+            return None
+        state['status'] = 'DOWNGRADED'
+        state['notes'] = (state.get('notes', '') + " " + notes + " [ĐÃ HẠ LOẠI]").strip()
+        self._commit(station_id, "downgrade")
+        return state
 
 state_manager = InspectionState()
\ No newline at end of file
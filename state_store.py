@@ -0,0 +1,239 @@
+# --- File: state_store.py ---
+"""
+Backend lưu trạng thái phiên kiểm vải (InspectionState) ra ngoài RAM.
+
+- StateStore: mặc định, chỉ giữ trong RAM (hành vi cũ).
+- JournalStateStore: ghi nối tiếp (append-only) mỗi thay đổi vào file journal cục bộ,
+  định kỳ nén (compact) thành 1 file snapshot. Khi Flask khởi động lại / mất điện,
+  các phiên đang dở được khôi phục từ đĩa, không cần Postgres.
+- RedisStateStore: lưu phiên trên Redis (dùng chung giữa nhiều tiến trình / node),
+  khóa lạc quan bằng version (WATCH/MULTI) + cache đọc cục bộ.
+"""
+import os
+import json
+import time
+import threading
+
+from services.redis_manager import redis_manager
+
+class StateConflictError(ValueError):
+    """Phiên đã bị tiến trình / node khác cập nhật trước (version lệch)."""
+    pass
+
+class StateStore:
+    """Giao diện backend lưu trạng thái (mặc định: không lưu gì, chỉ RAM)."""
+    name = "memory"
+    # True: nguồn dữ liệu chính nằm ngoài tiến trình -> phải refresh trước khi đọc
+    shared = False
+
+    def load_all(self):
+        """Trả về dict {station_id: state} đã lưu."""
+        return {}
+
+    def refresh(self, station_id, local_states):
+        """Đồng bộ bản cache cục bộ `local_states[station_id]` với backend (backend dùng chung)."""
+        pass
+
+    def save(self, station_id, state, op=None):
+        pass
+
+    def delete(self, station_id, op=None):
+        pass
+
+    def close(self):
+        pass
+
+class JournalStateStore(StateStore):
+    """
+    Write-ahead journal cho trạng thái phiên.
+    Mỗi bản ghi journal là 1 dòng JSON chứa toàn bộ state của 1 trạm sau thay đổi
+    (không phải thao tác) -> khôi phục chỉ cần lấy bản ghi cuối của mỗi trạm, idempotent.
+    """
+    name = "journal"
+
+    JOURNAL_FILE = "state_journal.jsonl"
+    SNAPSHOT_FILE = "state_snapshot.json"
+
+    def __init__(self, directory, fsync=True, compact_every=200):
+        self.directory = directory
+        self.fsync = fsync
+        self.compact_every = max(1, compact_every)
+        self.journal_path = os.path.join(directory, self.JOURNAL_FILE)
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_FILE)
+
+        self._lock = threading.Lock()
+        self._latest = {}          # station_id -> state đã serialize (dùng khi compact)
+        self._records_since_compact = 0
+        self._fh = None
+        os.makedirs(directory, exist_ok=True)
+
+    # --- KHÔI PHỤC ---
+    def load_all(self):
+        """Đọc snapshot + replay journal, sau đó compact ngay để journal bắt đầu rỗng."""
+        with self._lock:
+            states = {}
+            if os.path.exists(self.snapshot_path):
+                try:
+                    with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                        states = json.load(f).get('states', {})
+                except (OSError, ValueError) as e:
+                    print(f"[STATE JOURNAL] Snapshot lỗi, bỏ qua: {e}")
+
+            replayed = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r', encoding='utf-8') as f:
+                    for line_no, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # Dòng cuối bị cắt dở do mất điện giữa lúc ghi -> dừng replay
+                            print(f"[STATE JOURNAL] Bản ghi hỏng tại dòng {line_no}, bỏ phần còn lại.")
+                            break
+                        if record.get('state') is None:
+                            states.pop(record.get('station'), None)
+                        else:
+                            states[record['station']] = record['state']
+                        replayed += 1
+
+            self._latest = {sid: json.dumps(st, ensure_ascii=False, default=str) for sid, st in states.items()}
+            self._compact_locked()
+            print(f"[STATE JOURNAL] Khôi phục {len(states)} phiên (replay {replayed} bản ghi).")
+            return states
+
+    # --- GHI ---
+    def save(self, station_id, state, op=None):
+        with self._lock:
+            state_json = json.dumps(state, ensure_ascii=False, default=str)
+            self._latest[station_id] = state_json
+            self._append_locked(station_id, op, state_json)
+
+    def delete(self, station_id, op="end_session"):
+        with self._lock:
+            self._latest.pop(station_id, None)
+            self._append_locked(station_id, op, "null")
+
+    def _append_locked(self, station_id, op, state_json):
+        if self._fh is None:
+            self._fh = open(self.journal_path, 'a', encoding='utf-8')
+
+        # Ghép chuỗi thủ công để không serialize state 2 lần
+        line = '{"ts": %s, "op": %s, "station": %s, "state": %s}\n' % (
+            json.dumps(time.time()), json.dumps(op), json.dumps(station_id, ensure_ascii=False), state_json
+        )
+        self._fh.write(line)
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+
+        self._records_since_compact += 1
+        if self._records_since_compact >= self.compact_every:
+            self._compact_locked()
+
+    # --- NÉN JOURNAL ---
+    def compact(self):
+        with self._lock:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        """
+        Ghi snapshot mới (tmp + fsync + os.replace, nguyên tử) rồi mới làm rỗng journal.
+        Nếu mất điện giữa 2 bước: replay journal cũ trên snapshot mới vẫn cho kết quả đúng.
+        """
+        tmp_path = self.snapshot_path + ".tmp"
+        body = ", ".join(f"{json.dumps(sid, ensure_ascii=False)}: {st}" for sid, st in self._latest.items())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{"ts": %s, "states": {%s}}' % (json.dumps(time.time()), body))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = open(self.journal_path, 'w', encoding='utf-8')
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+        self._records_since_compact = 0
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+class RedisStateStore(StateStore):
+    """
+    Lưu mỗi phiên thành 1 HASH trên Redis (version + JSON document).
+    - Ghi: Compare-And-Set theo version (WATCH/MULTI). Lệch version -> StateConflictError,
+      InspectionState sẽ nạp lại bản mới nhất và chạy lại thao tác.
+    - Đọc: cache cục bộ; mỗi lần đọc chỉ hỏi version (1 HGET), chỉ tải lại document khi version đổi.
+    - Redis mất kết nối khi đọc: tạm dùng bản cache cục bộ.
+    """
+    name = "redis"
+    shared = True
+
+    def __init__(self, manager=None):
+        self._manager = manager or redis_manager
+        self._versions = {}          # station_id -> version của bản cache cục bộ
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def load_all(self):
+        states = {}
+        with self._lock:
+            for station_id, (version, doc) in self._manager.list_station_states().items():
+                states[station_id] = json.loads(doc)
+                self._versions[station_id] = version
+        return states
+
+    def refresh(self, station_id, local_states):
+        try:
+            version = self._manager.get_station_state_version(station_id)
+            with self._lock:
+                if version is None:
+                    local_states.pop(station_id, None)
+                    self._versions.pop(station_id, None)
+                    return
+                if self._versions.get(station_id) == version and station_id in local_states:
+                    self.cache_hits += 1
+                    return
+                self.cache_misses += 1
+
+            version, doc = self._manager.get_station_state(station_id)
+            with self._lock:
+                if version is None:
+                    local_states.pop(station_id, None)
+                    self._versions.pop(station_id, None)
+                else:
+                    local_states[station_id] = json.loads(doc)
+                    self._versions[station_id] = version
+        except Exception as e:
+            print(f"[STATE REDIS] Không đọc được phiên {station_id}, dùng bản cục bộ: {e}")
+
+    def save(self, station_id, state, op=None):
+        state_json = json.dumps(state, ensure_ascii=False, default=str)
+        with self._lock:
+            expected = self._versions.get(station_id)
+        new_version = self._manager.save_station_state(station_id, state_json, expected, op)
+        with self._lock:
+            if new_version is None:
+                self._versions.pop(station_id, None)
+                raise StateConflictError(f"Phiên trạm {station_id} đã bị cập nhật ở nơi khác (version {expected}).")
+            self._versions[station_id] = new_version
+
+    def delete(self, station_id, op="end_session"):
+        with self._lock:
+            expected = self._versions.get(station_id)
+        if not self._manager.delete_station_state(station_id, expected):
+            with self._lock:
+                self._versions.pop(station_id, None)
+            raise StateConflictError(f"Phiên trạm {station_id} đã bị cập nhật ở nơi khác (version {expected}).")
+        with self._lock:
+            self._versions.pop(station_id, None)
+
+    def get_version(self, station_id):
+        with self._lock:
+            return self._versions.get(station_id)
@@ -6,6 +6,9 @@ let SELECT_MACHINE_URL = '';
 let socket = null;
 let lastMeterValue = -1;
 let animationTimeout = null;
+// [NEW] Theo dõi số thứ tự frame đồng hồ mét để phát hiện mất frame
+let lastModbusSeq = null;
+let modbusGapCount = 0;
 
 // [NEW] Biến lưu loại hành động đang chờ xác nhận (DOWNGRADE hoặc REPAIR)
 let currentActionType = null; 
@@ -163,6 +166,7 @@ function bindEvents() {
 // 4. MAIN RENDER
 function renderUI(state) {
     serverState = state; 
+    window.api.setState(state);
 
     if (state.roll_code) {
         document.getElementById('display-roll-code').textContent = state.roll_code;
@@ -214,6 +218,15 @@ function renderErrorLog(state) {
 function initSocket() {
     socket = io();
     socket.on('modbus_data', (data) => {
+        if (data.seq !== undefined) {
+            // seq nhỏ hơn = Poller vừa khởi động lại -> bắt đầu đếm lại
+            if (lastModbusSeq !== null && data.seq > lastModbusSeq + 1) {
+                modbusGapCount += data.seq - lastModbusSeq - 1;
+                console.warn(`modbus_data: mất ${data.seq - lastModbusSeq - 1} frame (tổng ${modbusGapCount}).`);
+            }
+            lastModbusSeq = data.seq;
+        }
+
         if (data.error) {
             window.ui.updateConnectionStatus(false);
             window.ui.toggleMachineAnimation(false);
@@ -3,11 +3,19 @@
  * Chịu trách nhiệm giao tiếp với Backend (Routes).
  * Không xử lý DOM, chỉ trả về Data.
  * Cập nhật V2: Tích hợp logic safeFetch để xử lý an toàn lỗi 500 và session.
+ * Cập nhật V3: Các thao tác ghi lỗi / ca làm việc nhận về delta (chỉ phần thay đổi) theo version,
+ *              tự đồng bộ lại toàn bộ state khi version bị lệch.
  */
 
 class InspectionAPI {
     constructor() {
         this.baseUrl = '/api';
+        // Bản state mới nhất mà client đang giữ (dùng để áp dụng delta)
+        this.state = null;
+    }
+
+    setState(state) {
+        this.state = state;
     }
 
     /**
@@ -72,6 +80,75 @@ class InspectionAPI {
         }
     }
 
+    /**
+     * Gửi thao tác thay đổi phiên kèm version hiện tại.
+     * Server trả delta nếu version khớp, ngược lại trả toàn bộ state.
+     * Luôn trả về state đầy đủ (đã áp dụng delta) cho lớp UI.
+     */
+    async _mutate(endpoint, body = {}) {
+        const payload = Object.assign({}, body);
+        if (this.state && this.state.version !== undefined) payload.version = this.state.version;
+
+        const data = await this._fetch(endpoint, 'POST', payload);
+        if (!data || !data.delta) {
+            // Chỉ thay state khi server trả về đúng 1 bản state; payload lỗi giữ nguyên bản đang có
+            if (data && (data.version !== undefined || data.roll_code !== undefined)) this.state = data;
+            return data;
+        }
+
+        if (!this.state || this.state.version !== data.base_version) {
+            // Client đang giữ bản cũ (VD: 2 request chồng nhau) -> lấy lại toàn bộ
+            return await this.resyncState();
+        }
+        this._applyDelta(this.state, data);
+        return this.state;
+    }
+
+    _applyDelta(state, delta) {
+        const c = delta.changes || {};
+        const prevDetails = state.current_worker_details;
+
+        if (c.completed_worker_added) {
+            const entry = Object.assign({}, c.completed_worker_added);
+            entry.errors = prevDetails ? (prevDetails.current_errors || []) : [];
+            state.completed_workers_log = state.completed_workers_log || [];
+            state.completed_workers_log.push(entry);
+        }
+        if ('last_end_meter' in c) state.last_end_meter = c.last_end_meter;
+
+        if ('worker' in c) {
+            if (c.worker === null) {
+                state.current_worker_details = null;
+            } else {
+                const errors = c.errors || (prevDetails ? (prevDetails.current_errors || []) : []);
+                state.current_worker_details = Object.assign({}, c.worker, { current_errors: errors });
+            }
+        } else if (c.errors && state.current_worker_details) {
+            state.current_worker_details.current_errors = c.errors;
+        }
+
+        const details = state.current_worker_details;
+        if (details) {
+            const errors = details.current_errors = details.current_errors || [];
+            (c.errors_added || []).forEach(e => errors.push(e));
+            if (c.errors_removed && c.errors_removed.length) {
+                const removed = new Set(c.errors_removed.map(String));
+                details.current_errors = errors.filter(e => !removed.has(String(e.id)));
+            }
+            (c.errors_updated || []).forEach(u => {
+                const err = details.current_errors.find(e => String(e.id) === String(u.id));
+                if (err) Object.assign(err, u);
+            });
+        }
+
+        state.version = delta.version;
+    }
+
+    async resyncState() {
+        this.state = await this._fetch(`${this.baseUrl}/session/state`);
+        return this.state;
+    }
+
     // --- 1. Nhóm Standard & Settings ---
     async getStandardDetails(standardId) {
         return await this._fetch(`${this.baseUrl}/standard/details/${standardId}`);
@@ -116,19 +193,19 @@ class InspectionAPI {
     }
 
     async startShift(workerId, shift) {
-        return await this._fetch(`${this.baseUrl}/worker/start_shift`, 'POST', { worker_id: workerId, shift });
+        return await this._mutate(`${this.baseUrl}/worker/start_shift`, { worker_id: workerId, shift });
     }
 
     async endShift(grade1, grade2) {
-        return await this._fetch(`${this.baseUrl}/worker/end_shift`, 'POST', { meters_g1: grade1, meters_g2: grade2 });
+        return await this._mutate(`${this.baseUrl}/worker/end_shift`, { meters_g1: grade1, meters_g2: grade2 });
     }
 
     async logError(errorType, points) {
-        return await this._fetch(`${this.baseUrl}/log_error`, 'POST', { error_type: errorType, points });
+        return await this._mutate(`${this.baseUrl}/log_error`, { error_type: errorType, points });
     }
 
     async deleteError(errorId) {
-        return await this._fetch(`${this.baseUrl}/delete_error`, 'POST', { error_id: errorId });
+        return await this._mutate(`${this.baseUrl}/delete_error`, { error_id: errorId });
     }
 
     async markErrorFixed(errorId) {
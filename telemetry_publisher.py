@@ -0,0 +1,105 @@
+# --- File: telemetry_publisher.py ---
+"""
+Lớp phát dữ liệu đồng hồ mét (Modbus) qua Socket.IO.
+- Chỉ phát khi giá trị đổi vượt ngưỡng (deadband), khi trạng thái lỗi đổi, hoặc khi tới nhịp heartbeat.
+- Phát vào room riêng của trạm thay vì broadcast cho mọi client.
+- Mỗi frame có `seq` tăng dần và `ts` để HMI phát hiện mất frame.
+- relay (tùy chọn): SocketIO chỉ-ghi nối vào message queue Redis ([SocketIO] MESSAGE_QUEUE),
+  chuyển tiếp frame lên Server để màn hình giám sát nhận dữ liệu mọi trạm.
+"""
+import time
+import threading
+
+DEFAULT_DEADBAND = 0.05     # mét
+DEFAULT_HEARTBEAT = 5.0     # giây: phát lại giá trị cũ để HMI biết kết nối vẫn sống
+EVENT_NAME = 'modbus_data'
+
+def station_room(station_id):
+    """Tên room Socket.IO của 1 trạm."""
+    return f"station:{station_id}"
+
+class TelemetryPublisher:
+    def __init__(self, socketio, station_id=None, deadband=DEFAULT_DEADBAND, heartbeat=DEFAULT_HEARTBEAT, event=EVENT_NAME, relay=None):
+        self.socketio = socketio
+        self.relay = relay
+        self.station_id = station_id
+        self.room = station_room(station_id) if station_id else None
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self.event = event
+
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._last_meters = None
+        self._last_error = None
+        self._last_emit = 0.0
+
+        # Thống kê
+        self.emitted = 0
+        self.suppressed = 0
+        self.relay_errors = 0
+
+    def _should_emit(self, packet, now):
+        if self._seq == 0:
+            return True
+        if packet.get('error') != self._last_error:
+            return True
+        if now - self._last_emit >= self.heartbeat:
+            return True
+        meters = packet.get('meters')
+        if meters is None:
+            return False
+        if self._last_meters is None:
+            return True
+        return abs(meters - self._last_meters) >= self.deadband
+
+    def publish(self, packet, force=False):
+        """
+        Phát 1 gói dữ liệu nếu đủ điều kiện. Trả về frame đã phát, hoặc None nếu bị lọc.
+        force=True: luôn phát (VD: ngay sau khi reset đồng hồ).
+        """
+        now = time.time()
+        with self._lock:
+            if not force and not self._should_emit(packet, now):
+                self.suppressed += 1
+                return None
+
+            self._seq += 1
+            frame = dict(packet)
+            frame['seq'] = self._seq
+            frame['ts'] = now
+            if self.station_id:
+                frame['station_id'] = self.station_id
+
+            if packet.get('meters') is not None:
+                self._last_meters = packet['meters']
+            self._last_error = packet.get('error')
+            self._last_emit = now
+            self.emitted += 1
+
+        try:
+            if self.room:
+                self.socketio.server.emit(self.event, frame, room=self.room, namespace='/')
+            else:
+                self.socketio.server.emit(self.event, frame, namespace='/')
+        except Exception:
+            pass
+        if self.relay is not None:
+            try:
+                self.relay.emit(self.event, frame, room=self.room, namespace='/')
+            except Exception:
+                self.relay_errors += 1
+        return frame
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "room": self.room,
+                "seq": self._seq,
+                "emitted": self.emitted,
+                "suppressed": self.suppressed,
+                "relay": self.relay is not None,
+                "relay_errors": self.relay_errors,
+                "deadband": self.deadband,
+                "heartbeat": self.heartbeat,
+            }
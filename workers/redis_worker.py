@@ -4,6 +4,8 @@ import json
 import logging
 import sys
 import os
+import socket
+import threading
 
 # Thêm đường dẫn thư mục gốc vào sys.path để import được các services
 # Giả sử cấu trúc: /app/workers/redis_worker.py -> cần add /app/
@@ -11,7 +13,9 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-from services.redis_manager import redis_manager, QUEUE_INSPECTION_NAME
+from services.redis_manager import (
+    redis_manager, QUEUE_INSPECTION_NAME, QUEUE_BACKEND_STREAM, STREAM_MAX_DELIVERIES, CONSUMER_HEARTBEAT_TTL
+)
 from services.inspection_service import inspection_service
 
 # Cấu hình Logging riêng cho Worker
@@ -25,26 +29,257 @@ logging.basicConfig(
 )
 logger = logging.getLogger("RedisWorker")
 
-def run_worker():
+# --- CẤU HÌNH BATCH ---
+# BATCH_SIZE: Số gói tin tối đa lấy ra và ghi trong 1 transaction.
+# Đặt = 1 để quay về chế độ cũ (xử lý từng gói tin).
+BATCH_SIZE = 20
+POP_TIMEOUT = 5      # Giây chờ BLPOP khi Queue rỗng
+RETRY_SLEEP = 5      # Giây nghỉ khi DB/Redis gặp sự cố
+
+# --- CẤU HÌNH RELIABLE QUEUE ---
+# True: Gói tin được chuyển sang danh sách "đang xử lý" của Worker và chỉ bị xóa sau khi commit DB.
+# Worker chết giữa chừng -> Reaper (chạy trong các Worker còn sống) trả gói tin về Queue.
+RELIABLE_QUEUE = True
+REAP_INTERVAL = 30   # Giây giữa 2 lần quét Worker chết
+# Heartbeat được gia hạn ở luồng nền (kể cả khi đang ghi DB một lô dài), nhiều lần trong 1 TTL
+HEARTBEAT_REFRESH = CONSUMER_HEARTBEAT_TTL / 4
+
+def make_consumer_id():
+    """Định danh duy nhất cho mỗi Worker (máy + tiến trình + luồng)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def run_worker(batch_size=BATCH_SIZE, reliable=RELIABLE_QUEUE, stop_event=None):
     """
     Hàm chính của Worker:
     - Liên tục lấy dữ liệu từ Redis Queue.
     - Gọi Service để ghi xuống PostgreSQL.
     - Xử lý lỗi và Retry nếu DB chết.
+    - stop_event (threading.Event): Dừng có kiểm soát sau khi lô hiện tại đã commit + ACK.
     """
-    logger.info(">>> Worker started. Waiting for inspection data from Redis...")
+    if stop_event is None:
+        stop_event = threading.Event()
+    consumer_id = make_consumer_id() if reliable else None
+    logger.info(f">>> Worker started (batch_size={batch_size}, reliable={reliable}, id={consumer_id}). Waiting for inspection data from Redis...")
 
     # Kiểm tra kết nối Redis lần đầu
     if not redis_manager.check_connection():
         logger.error("CRITICAL: Cannot connect to Redis on startup. Worker exiting...")
         return
 
-    while True:
+    if redis_manager.queue_backend == QUEUE_BACKEND_STREAM:
+        _run_stream_loop(batch_size, consumer_id or make_consumer_id(), stop_event)
+    elif reliable or batch_size > 1:
+        _run_batch_loop(batch_size, consumer_id, stop_event)
+    else:
+        _run_single_loop(stop_event)
+    logger.info(">>> Worker stopped.")
+
+def _return_to_queue(consumer_id, raw_items, front):
+    """Trả gói tin về Queue: NACK (Reliable) hoặc đẩy lại (chế độ thường)."""
+    if consumer_id:
+        redis_manager.nack_inspection_data(consumer_id, raw_items, front=front)
+    else:
+        redis_manager.requeue_inspection_data(raw_items, front=front)
+
+def _log_requeue_failure(consumer_id, error, raw_items):
+    if consumer_id:
+        # Reliable: gói tin vẫn nằm trong danh sách xử lý, Reaper sẽ trả lại sau
+        logger.error(f" -> NACK failed ({error}). {len(raw_items)} items stay in-flight until reaped.")
+    else:
+        logger.critical(f"FATAL: Failed to re-queue data! Data might be lost. Error: {error} | Payloads: {raw_items}")
+
+def _log_batch_stats(size, ok, failed, t_start, t_popped):
+    """Thông lượng & độ trễ của từng lô."""
+    t_done = time.perf_counter()
+    persist_ms = (t_done - t_popped) * 1000
+    total_s = t_done - t_start
+    rate = size / total_s if total_s > 0 else 0.0
+    logger.info(
+        f"Batch: {size} rolls | OK {ok} | FAILED {failed} | "
+        f"pop {(t_popped - t_start) * 1000:.1f}ms | persist {persist_ms:.1f}ms "
+        f"({persist_ms / size:.1f}ms/roll) | {rate:.1f} rolls/s"
+    )
+
+def _keep_consumer_alive(consumer_id, done, interval=HEARTBEAT_REFRESH):
+    """
+    Luồng nền gia hạn Heartbeat trong suốt vòng đời Worker: lô ghi DB lâu hơn CONSUMER_HEARTBEAT_TTL
+    không còn bị Reaper coi là Worker chết (trả gói đang xử lý về Queue -> ghi 2 lần).
+    Tiến trình chết thì luồng chết theo -> Heartbeat hết hạn như cũ.
+    """
+    while not done.wait(interval):
+        try:
+            redis_manager.register_consumer(consumer_id)
+        except Exception as e:
+            logger.error(f" -> Redis heartbeat refresh error: {e}")
+
+def _run_batch_loop(batch_size, consumer_id, stop_event):
+    """
+    [NEW] Chế độ Batch: Mỗi chu kỳ lấy tối đa `batch_size` gói tin và ghi trong 1 transaction
+    (SAVEPOINT cho từng cây). Gói tin lỗi dữ liệu được đẩy về CUỐI hàng đợi để không chặn lô sau;
+    lỗi hạ tầng (DB chết) trả cả lô về ĐẦU hàng đợi theo đúng thứ tự.
+    Có consumer_id -> chạy Reliable Queue (BLMOVE + ACK + Reaper).
+    """
+    last_reap = 0.0
+    heartbeat_done = threading.Event()
+    heartbeat = None
+    if consumer_id:
+        heartbeat = threading.Thread(target=_keep_consumer_alive, args=(consumer_id, heartbeat_done),
+                                     daemon=True, name="ConsumerHeartbeat")
+        heartbeat.start()
+    try:
+        while not stop_event.is_set():
+            if consumer_id:
+                try:
+                    redis_manager.register_consumer(consumer_id)
+                    redis_manager.return_own_inflight(consumer_id)
+                    if time.time() - last_reap >= REAP_INTERVAL:
+                        redis_manager.reap_stale_inflight()
+                        last_reap = time.time()
+                except Exception as e:
+                    logger.error(f" -> Redis heartbeat error: {e}. Waiting {RETRY_SLEEP}s...")
+                    stop_event.wait(RETRY_SLEEP)
+                    continue
+
+            t_start = time.perf_counter()
+            if consumer_id:
+                batch = redis_manager.reliable_pop_inspection_batch(consumer_id, max_items=batch_size, timeout=POP_TIMEOUT)
+            else:
+                batch = redis_manager.pop_inspection_batch(max_items=batch_size, timeout=POP_TIMEOUT)
+            if not batch:
+                continue
+            t_popped = time.perf_counter()
+
+            raw_items = [raw for raw, _ in batch]
+            payloads = [data for _, data in batch]
+
+            try:
+                result = inspection_service.persist_roll_batch(payloads)
+            except Exception as e:
+                logger.error(f" -> ERROR persisting batch of {len(batch)}: {e}")
+                logger.warning(f" -> RE-QUEUING {len(batch)} items to front and waiting {RETRY_SLEEP}s...")
+                try:
+                    _return_to_queue(consumer_id, raw_items, front=True)
+                except Exception as redis_e:
+                    _log_requeue_failure(consumer_id, redis_e, raw_items)
+                stop_event.wait(RETRY_SLEEP)
+                continue
+
+            failed = result['failed']
+            failed_indexes = {index for index, _ in failed}
+            if consumer_id:
+                try:
+                    redis_manager.ack_inspection_data(
+                        consumer_id, [raw for i, raw in enumerate(raw_items) if i not in failed_indexes]
+                    )
+                except Exception as redis_e:
+                    # Chưa ACK được -> gói tin sẽ bị Reaper trả lại và ghi lại (UPSERT nên an toàn)
+                    logger.error(f" -> ACK failed: {redis_e}")
+            if failed:
+                failed_raw = [raw_items[index] for index, _ in failed]
+                logger.warning(f" -> RE-QUEUING {len(failed_raw)} failed items to back of queue...")
+                try:
+                    _return_to_queue(consumer_id, failed_raw, front=False)
+                except Exception as redis_e:
+                    _log_requeue_failure(consumer_id, redis_e, failed_raw)
+
+            _log_batch_stats(len(batch), len(result['persisted']), len(failed), t_start, t_popped)
+    finally:
+        if heartbeat:
+            # Dừng gia hạn trước khi hủy đăng ký, tránh đăng ký lại consumer vừa xóa
+            heartbeat_done.set()
+            heartbeat.join(timeout=5)
+        if consumer_id:
+            try:
+                redis_manager.unregister_consumer(consumer_id)
+            except Exception as e:
+                logger.error(f" -> Failed to unregister consumer {consumer_id}: {e}")
+
+def _run_stream_loop(batch_size, consumer_name, stop_event):
+    """
+    [NEW] Backend Redis Streams: XREADGROUP -> ghi DB theo lô -> XACK.
+    - Lỗi hạ tầng: không ACK, lần sau đọc lại pending của chính mình.
+    - Lỗi dữ liệu: để pending; XAUTOCLAIM giao lại sau STREAM_CLAIM_IDLE_MS. Khi số lần giao
+      (XPENDING) đạt STREAM_MAX_DELIVERIES -> chuyển sang Dead Letter Stream.
+    """
+    try:
+        redis_manager.ensure_stream_group()
+    except Exception as e:
+        logger.error(f"CRITICAL: Cannot create stream consumer group: {e}. Worker exiting...")
+        return
+
+    retry_own_pending = False
+    last_migrate = 0.0
+    try:
+        while not stop_event.is_set():
+            if time.time() - last_migrate >= REAP_INTERVAL:
+                # Client chưa nâng cấp vẫn có thể RPUSH vào List cũ
+                try:
+                    redis_manager.migrate_list_to_stream()
+                except Exception as e:
+                    logger.error(f" -> List->Stream migration error: {e}")
+                last_migrate = time.time()
+
+            t_start = time.perf_counter()
+            batch = redis_manager.stream_read_batch(consumer_name, max_items=batch_size,
+                                                    block_ms=POP_TIMEOUT * 1000,
+                                                    own_pending=retry_own_pending)
+            retry_own_pending = False
+            if not batch:
+                continue
+            t_popped = time.perf_counter()
+
+            msg_ids = [msg_id for msg_id, _ in batch]
+            payloads = [data for _, data in batch]
+
+            try:
+                result = inspection_service.persist_roll_batch(payloads)
+            except Exception as e:
+                logger.error(f" -> ERROR persisting batch of {len(batch)}: {e}. Retrying in {RETRY_SLEEP}s...")
+                retry_own_pending = True
+                stop_event.wait(RETRY_SLEEP)
+                continue
+
+            failed = result['failed']
+            failed_indexes = {index for index, _ in failed}
+            try:
+                redis_manager.stream_ack([m for i, m in enumerate(msg_ids) if i not in failed_indexes])
+                if failed:
+                    _handle_stream_failures(batch, failed)
+            except Exception as redis_e:
+                # Chưa ACK -> gói tin sẽ được giao lại (UPSERT nên an toàn)
+                logger.error(f" -> XACK failed: {redis_e}")
+
+            _log_batch_stats(len(batch), len(result['persisted']), len(failed), t_start, t_popped)
+    finally:
+        try:
+            redis_manager.stream_remove_consumer(consumer_name)
+        except Exception:
+            pass
+
+def _handle_stream_failures(batch, failed):
+    """Gói lỗi dữ liệu: Dead Letter nếu đã giao quá nhiều lần, ngược lại để chờ giao lại."""
+    failed_ids = [batch[index][0] for index, _ in failed]
+    deliveries = redis_manager.get_stream_delivery_counts(failed_ids)
+    pending_errors = {}
+    for index, error in failed:
+        msg_id, data = batch[index]
+        count = deliveries.get(msg_id, 0)
+        if count >= STREAM_MAX_DELIVERIES:
+            logger.error(f" -> POISON message {msg_id} (Ticket {data.get('ticket_id')}) delivered {count} times -> Dead Letter.")
+            redis_manager.dead_letter_stream_message(msg_id, json.dumps(data), error, deliveries=count)
+        else:
+            logger.warning(f" -> Message {msg_id} failed (delivery {count}/{STREAM_MAX_DELIVERIES}), will be re-claimed.")
+            pending_errors[msg_id] = error
+    redis_manager.record_stream_errors(pending_errors)
+
+def _run_single_loop(stop_event):
+    """Chế độ cũ: Xử lý từng gói tin, mỗi gói 1 transaction."""
+    while not stop_event.is_set():
         data = None
         try:
             # 1. Lấy dữ liệu từ Queue (Blocking call - Tiết kiệm CPU)
             # timeout=5s: Cứ 5s sẽ nhả ra kiểm tra 1 lần nếu ko có data
-            data = redis_manager.pop_inspection_data(timeout=5)
+            data = redis_manager.pop_inspection_data(timeout=POP_TIMEOUT)
 
             if data is None:
                 # Không có dữ liệu, tiếp tục vòng lặp
@@ -76,7 +311,7 @@ def run_worker():
                     # Ở production, nên ghi data này ra file text dự phòng (fallback)
             
             # Ngủ 5 giây để tránh spam DB khi DB đang chết
-            time.sleep(5)
+            stop_event.wait(RETRY_SLEEP)
 
 if __name__ == "__main__":
     try:
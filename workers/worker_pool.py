@@ -0,0 +1,138 @@
+# --- File: workers/worker_pool.py ---
+"""
+Entry point độc lập cho Worker ghi dữ liệu kiểm vải (chạy trên Server, NGOÀI tiến trình Flask).
+
+    python workers/worker_pool.py
+
+- Fork N tiến trình Worker (cấu hình [Worker] PROCESSES trong config.ini).
+- Mỗi tiến trình có Pool psycopg2 nhỏ riêng và kết nối Redis riêng.
+- SIGTERM / Ctrl+C: các Worker hoàn tất lô đang ghi (commit + ACK) rồi mới thoát.
+- Tiến trình con chết bất thường sẽ được khởi động lại.
+Khi dùng entry point này, đặt [Worker] EMBEDDED = false để Flask không chạy Worker trong luồng web.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import configparser
+import multiprocessing
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from services import db_connection
+from services.redis_manager import redis_manager
+from workers.redis_worker import run_worker, BATCH_SIZE, RELIABLE_QUEUE
+
+logger = logging.getLogger("WorkerPool")
+
+# --- CẤU HÌNH MẶC ĐỊNH (Ghi đè bởi [Worker] trong config.ini) ---
+DEFAULT_PROCESSES = 4
+DEFAULT_POOL_MIN_CONN = 1
+DEFAULT_POOL_MAX_CONN = 3
+SHUTDOWN_TIMEOUT = 30    # Giây chờ Worker con hoàn tất lô trước khi kill
+RESTART_DELAY = 5        # Giây tối thiểu giữa 2 lần khởi động lại một Worker
+
+def load_settings(config_path=None):
+    """Đọc cấu hình Worker Pool từ config.ini."""
+    config = configparser.ConfigParser()
+    config.read(config_path or os.path.join(parent_dir, 'config.ini'), encoding='utf-8')
+
+    return {
+        'processes': config.getint('Worker', 'PROCESSES', fallback=DEFAULT_PROCESSES),
+        'batch_size': config.getint('Worker', 'BATCH_SIZE', fallback=BATCH_SIZE),
+        'reliable': config.getboolean('Worker', 'RELIABLE', fallback=RELIABLE_QUEUE),
+        'pool_min': config.getint('Worker', 'POOL_MIN_CONN', fallback=DEFAULT_POOL_MIN_CONN),
+        'pool_max': config.getint('Worker', 'POOL_MAX_CONN', fallback=DEFAULT_POOL_MAX_CONN),
+        # Worker Pool chạy trên chính máy Server -> kết nối Redis local như app.py
+        'redis_host': config.get('Worker', 'REDIS_HOST', fallback='127.0.0.1'),
+        'redis_port': config.getint('Network', 'REDIS_PORT', fallback=6379),
+        'queue_backend': config.get('Queue', 'BACKEND', fallback='list').strip().lower(),
+    }
+
+def _worker_process(index, settings):
+    """Hàm chạy trong mỗi tiến trình con."""
+    stop_event = threading.Event()
+
+    def _handle_stop(signum, frame):
+        logger.info(f"[Worker-{index}] Signal {signum} received. Finishing current batch...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, _handle_stop)
+    signal.signal(signal.SIGINT, _handle_stop)
+
+    # Pool riêng cho tiến trình này (không dùng lại socket của tiến trình cha).
+    # Chế độ spawn (Windows): module được import lại và đã tạo Pool mặc định -> đóng trước.
+    db_connection.close_db_pool()
+    db_connection.init_db_pool(settings['pool_min'], settings['pool_max'])
+    redis_manager.configure(settings['redis_host'], settings['redis_port'])
+    redis_manager.queue_backend = settings['queue_backend']
+
+    try:
+        run_worker(batch_size=settings['batch_size'], reliable=settings['reliable'], stop_event=stop_event)
+    finally:
+        db_connection.close_db_pool()
+
+def _spawn(ctx, index, settings):
+    proc = ctx.Process(target=_worker_process, args=(index, settings), name=f"FLIS-Worker-{index}")
+    proc.start()
+    logger.info(f"Started Worker-{index} (pid {proc.pid}).")
+    return proc
+
+def run_pool(settings):
+    """Tiến trình cha: khởi tạo, giám sát và dừng có kiểm soát các Worker con."""
+    count = max(1, settings['processes'])
+    logger.info(f">>> Worker Pool starting: {count} processes | batch={settings['batch_size']} | "
+                f"reliable={settings['reliable']} | queue={settings['queue_backend']} | "
+                f"db pool {settings['pool_min']}-{settings['pool_max']}/process")
+
+    # Tiến trình cha không ghi DB: đóng Pool tạo lúc import TRƯỚC khi fork
+    db_connection.close_db_pool()
+
+    ctx = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    shutting_down = threading.Event()
+
+    def _handle_stop(signum, frame):
+        logger.info(f"Signal {signum} received. Shutting down Worker Pool...")
+        shutting_down.set()
+
+    signal.signal(signal.SIGTERM, _handle_stop)
+    signal.signal(signal.SIGINT, _handle_stop)
+
+    procs = {}
+    started_at = {}
+    for i in range(count):
+        procs[i] = _spawn(ctx, i, settings)
+        started_at[i] = time.time()
+
+    # Giám sát: khởi động lại Worker chết bất thường
+    while not shutting_down.wait(1.0):
+        for i, proc in list(procs.items()):
+            if proc.is_alive():
+                continue
+            if time.time() - started_at[i] < RESTART_DELAY:
+                continue
+            logger.warning(f"Worker-{i} (pid {proc.pid}) exited with code {proc.exitcode}. Restarting...")
+            procs[i] = _spawn(ctx, i, settings)
+            started_at[i] = time.time()
+
+    # Dừng có kiểm soát: SIGTERM -> chờ -> kill
+    for proc in procs.values():
+        if proc.is_alive():
+            proc.terminate()
+
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    for i, proc in procs.items():
+        proc.join(max(0.0, deadline - time.time()))
+        if proc.is_alive():
+            logger.error(f"Worker-{i} (pid {proc.pid}) did not stop in {SHUTDOWN_TIMEOUT}s. Killing.")
+            proc.kill()
+            proc.join()
+
+    logger.info(">>> Worker Pool stopped.")
+
+if __name__ == "__main__":
+    run_pool(load_settings())